@@ -0,0 +1,768 @@
+"""
+Benchmarks for ComfyUI-FramePackWrapper. Results are printed as JSON.
+
+Run with ComfyUI's python from the ComfyUI directory, e.g.
+
+    python custom_nodes/ComfyUI-FramePackWrapper/benchmark.py import
+    python custom_nodes/ComfyUI-FramePackWrapper/benchmark.py int8 --device cpu
+    python custom_nodes/ComfyUI-FramePackWrapper/benchmark.py quant --device cuda --output quant.json
+    python custom_nodes/ComfyUI-FramePackWrapper/benchmark.py swap
+    python custom_nodes/ComfyUI-FramePackWrapper/benchmark.py disk --cache_blocks 1 4 64
+    python custom_nodes/ComfyUI-FramePackWrapper/benchmark.py compress
+    python custom_nodes/ComfyUI-FramePackWrapper/benchmark.py reentrant --threads 4
+    python custom_nodes/ComfyUI-FramePackWrapper/benchmark.py cfg --negative_len 16
+    python custom_nodes/ComfyUI-FramePackWrapper/benchmark.py plan --budget_gb 10
+    python custom_nodes/ComfyUI-FramePackWrapper/benchmark.py preflight --vram_gb 16 --tflops 80 --bandwidth_gb_s 12
+    python custom_nodes/ComfyUI-FramePackWrapper/benchmark.py sensitivity --model <checkpoint> --device cuda --budget_gb 16
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import importlib.util
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_NAME = "framepack_benchmark_package"
+
+# modules ComfyUI has already imported by the time it loads custom nodes
+COMFY_STARTUP_MODULES = ["torch", "folder_paths", "comfy.model_management", "comfy.utils", "comfy.model_base", "comfy.latent_formats", "comfy.cli_args"]
+HEAVY_MODULES = ["diffusers", "accelerate", "transformers", "torchvision", "flash_attn", "sageattention", "safetensors", "einops"]
+
+
+def import_package(run_init=True):
+    """Imports the package the way ComfyUI loads custom nodes. With run_init=False only the package
+    shell is created, so submodules can be imported without pulling in nodes.py and ComfyUI."""
+    if PACKAGE_NAME in sys.modules:
+        return sys.modules[PACKAGE_NAME]
+    spec = importlib.util.spec_from_file_location(PACKAGE_NAME, os.path.join(PACKAGE_DIR, "__init__.py"), submodule_search_locations=[PACKAGE_DIR])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE_NAME] = module
+    if run_init:
+        spec.loader.exec_module(module)
+    return module
+
+
+def import_submodule(name):
+    import_package(run_init=False)
+    return importlib.import_module(f"{PACKAGE_NAME}.{name}")
+
+
+def _import_time_child():
+    sys.path.insert(0, os.getcwd())
+    start = time.perf_counter()
+    for name in COMFY_STARTUP_MODULES:
+        importlib.import_module(name)
+    baseline = time.perf_counter() - start
+    loaded_before = set(sys.modules)
+
+    start = time.perf_counter()
+    package = import_package()
+    package_time = time.perf_counter() - start
+
+    new_modules = set(sys.modules) - loaded_before
+    print(json.dumps({
+        "comfy_baseline_s": baseline,
+        "package_s": package_time,
+        "nodes": len(package.NODE_CLASS_MAPPINGS),
+        "new_modules": len(new_modules),
+        "heavy_modules_loaded": sorted(m for m in HEAVY_MODULES if m in new_modules),
+    }))
+
+
+def benchmark_import(repeats=5):
+    """Time added to ComfyUI startup by registering this package, measured in fresh interpreters."""
+    runs = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "_import_child"], capture_output=True, text=True, check=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {
+        "repeats": repeats,
+        "package_s_median": statistics.median(r["package_s"] for r in runs),
+        "package_s_min": min(r["package_s"] for r in runs),
+        "comfy_baseline_s_median": statistics.median(r["comfy_baseline_s"] for r in runs),
+        "nodes": runs[-1]["nodes"],
+        "new_modules": runs[-1]["new_modules"],
+        "heavy_modules_loaded": runs[-1]["heavy_modules_loaded"],
+    }
+
+
+# small enough to run on a CPU in seconds, same architecture as transformer_config.json
+TINY_TRANSFORMER_CONFIG = {
+    "in_channels": 16,
+    "out_channels": 16,
+    "num_attention_heads": 4,
+    "attention_head_dim": 64,
+    "num_layers": 2,
+    "num_single_layers": 4,
+    "num_refiner_layers": 1,
+    "mlp_ratio": 4.0,
+    "patch_size": 2,
+    "patch_size_t": 1,
+    "qk_norm": "rms_norm",
+    "guidance_embeds": True,
+    "text_embed_dim": 512,
+    "pooled_projection_dim": 128,
+    "rope_theta": 256.0,
+    "rope_axes_dim": [16, 24, 24],
+    "has_image_proj": True,
+    "image_proj_dim": 128,
+    "has_clean_x_embedder": True,
+}
+
+
+def build_tiny_transformer(quantization="disabled", base_dtype=None, device="cpu", fp8_scale="per_tensor", seed=0):
+    """
+    Randomly initialized tiny transformer, quantized through the same streaming load path the loader nodes use.
+    The random weights only depend on the seed, so every quantization mode gets the same model.
+    """
+    import torch
+    from accelerate import init_empty_weights
+    packed = import_submodule("diffusers_helper.models.hunyuan_video_packed")
+    model_loading = import_submodule("model_loading")
+    quantization_module = import_submodule("quantization")
+    base_dtype = base_dtype or torch.bfloat16
+
+    torch.manual_seed(seed)
+    reference = packed.HunyuanVideoTransformer3DModel(**TINY_TRANSFORMER_CONFIG)
+    source = model_loading.StateDictSource(reference.state_dict())
+    with init_empty_weights():
+        model = packed.HunyuanVideoTransformer3DModel(**TINY_TRANSFORMER_CONFIG)
+
+    params_to_keep = quantization_module.PARAMS_TO_KEEP
+    dtype = quantization_module.get_weight_dtype(quantization, base_dtype)
+    model_loading.load_state_dict_streaming(
+        model, source, device,
+        dtype_fn=lambda name: base_dtype if any(keyword in name for keyword in params_to_keep) else dtype,
+        quantize_fn=quantization_module.get_quantize_fn(model, quantization, fp8_scale),
+        num_workers=1,
+    )
+    quantization_module.convert_quantized_linear(model, quantization, base_dtype)
+    return model.eval()
+
+
+def load_transformer(model_path, dtype, device="cpu"):
+    """A FramePack checkpoint with every weight in `dtype`, for the benchmarks that need real weights."""
+    from accelerate import init_empty_weights
+    packed = import_submodule("diffusers_helper.models.hunyuan_video_packed")
+    model_loading = import_submodule("model_loading")
+    with open(os.path.join(PACKAGE_DIR, "transformer_config.json"), "r") as f:
+        config = json.load(f)
+    with init_empty_weights():
+        model = packed.HunyuanVideoTransformer3DModel(**config)
+    model_loading.load_state_dict_streaming(model, model_loading.open_state_dict(model_path), device, dtype_fn=lambda name: dtype)
+    return model.eval(), config
+
+
+def tiny_transformer_inputs(device="cpu", dtype=None, frames=9, height=256, width=256, text_len=64, seed=0, config=None):
+    """Conditioning for the tiny transformer (or another config), as sample_hunyuan kwargs."""
+    import torch
+    dtype = dtype or torch.bfloat16
+    g = torch.Generator().manual_seed(seed)
+    c = config or TINY_TRANSFORMER_CONFIG
+    randn = lambda *shape: torch.randn(*shape, generator=g).to(device, dtype)
+    return {
+        "width": width,
+        "height": height,
+        "frames": frames,
+        "prompt_embeds": randn(1, text_len, c["text_embed_dim"]),
+        "prompt_embeds_mask": torch.ones((1, text_len), dtype=torch.int64, device=device),
+        "prompt_poolers": randn(1, c["pooled_projection_dim"]),
+        "image_embeddings": randn(1, 16, c["image_proj_dim"]),
+    }
+
+
+def _forward_inputs(inputs, device, dtype, seed=0, config=None):
+    import torch
+    g = torch.Generator().manual_seed(seed)
+    latent_frames = (inputs["frames"] + 3) // 4
+    return {
+        "hidden_states": torch.randn(1, (config or TINY_TRANSFORMER_CONFIG)["in_channels"], latent_frames, inputs["height"] // 8, inputs["width"] // 8, generator=g).to(device, dtype),
+        "timestep": torch.tensor([500.0], device=device),
+        "encoder_hidden_states": inputs["prompt_embeds"],
+        "encoder_attention_mask": inputs["prompt_embeds_mask"],
+        "pooled_projections": inputs["prompt_poolers"],
+        "guidance": torch.tensor([10000.0], device=device, dtype=dtype),
+        "image_embeddings": inputs["image_embeddings"],
+        "return_dict": False,
+    }
+
+
+def _synchronize(device):
+    import torch
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def _rel_error(x, reference):
+    x, reference = x.float(), reference.float()
+    return ((x - reference).norm() / reference.norm().clamp(min=1e-12)).item()
+
+
+def get_model_bytes(model):
+    return sum(t.nelement() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def time_forward(model, inputs, repeats=5, warmup=1):
+    """Median seconds per forward, and the output of the last one."""
+    import torch
+    device = inputs["hidden_states"].device
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            _synchronize(device)
+            start = time.perf_counter()
+            out = model(**inputs)[0]
+            _synchronize(device)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    return statistics.median(times), out
+
+
+def capture_linear_io(model, inputs):
+    """Runs one forward and returns {Linear name: (input, output)}."""
+    import torch
+    captured = {}
+    hooks = [module.register_forward_hook(lambda m, args, out, name=name: captured.__setitem__(name, (args[0], out)))
+             for name, module in model.named_modules() if isinstance(module, torch.nn.Linear)]
+    try:
+        with torch.no_grad():
+            model(**inputs)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return captured
+
+
+def get_layer_errors(model, reference_io):
+    """Relative output error of every Linear of `model`, fed the reference model's input of that layer."""
+    import torch
+    modules = dict(model.named_modules())
+    errors = {}
+    with torch.no_grad():
+        for name, (inp, out) in reference_io.items():
+            errors[name] = _rel_error(modules[name](inp), out)
+    return errors
+
+
+def _is_unsupported(e):
+    """Whether an error means a quantization mode has no kernel on this device (e.g. fp8 matmul on the CPU), not that it is broken."""
+    message = str(e).lower()
+    return isinstance(e, NotImplementedError) or (isinstance(e, RuntimeError) and ("not implemented for" in message or "not supported" in message))
+
+
+def sample_tiny(model, inputs, steps, device, dtype, seed=0, run_context=None):
+    import torch
+    pipeline = import_submodule("diffusers_helper.pipelines.k_diffusion_hunyuan")
+    _synchronize(device)
+    start = time.perf_counter()
+    latents = pipeline.sample_hunyuan(
+        transformer=model, sampler="unipc_bh1", num_inference_steps=steps, real_guidance_scale=1.0,
+        generator=torch.Generator("cpu").manual_seed(seed), dtype=dtype, device=device, run_context=run_context, **inputs,
+    )
+    _synchronize(device)
+    return latents, (time.perf_counter() - start) / steps
+
+
+def benchmark_quantization(modes=None, base_precision="bf16", fp8_scale="per_tensor", device="cpu", steps=4, repeats=3,
+                           frames=9, height=256, width=256):
+    """
+    Accuracy and speed of each quantization mode on the tiny config, against the base_precision model:
+    per-Linear output error (each layer fed the reference input), transformer output error, final latent
+    error after `steps` sampler steps, forward and step latency, and model size.
+    """
+    import torch
+    quantization_module = import_submodule("quantization")
+    modes = modes or [m for m in quantization_module.QUANTIZATION_MODES if m != "disabled"]
+    dtype = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}[base_precision]
+    autocast = lambda: torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+    inputs = tiny_transformer_inputs(device, dtype, frames=frames, height=height, width=width)
+    forward_inputs = _forward_inputs(inputs, device, dtype)
+
+    def measure(model):
+        with autocast():
+            forward_s, out = time_forward(model, forward_inputs, repeats)
+            latents, step_s = sample_tiny(model, inputs, steps, device, dtype)
+        return {"model_mb": get_model_bytes(model) / 1024 ** 2, "forward_s": forward_s, "step_s": step_s}, out, latents
+
+    reference = build_tiny_transformer("disabled", dtype, device)
+    reference_result, reference_out, reference_latents = measure(reference)
+    with autocast():
+        reference_io = capture_linear_io(reference, forward_inputs)
+    del reference
+
+    results = {}
+    for quantization in modes:
+        try:
+            model = build_tiny_transformer(quantization, dtype, device, fp8_scale)
+            result, out, latents = measure(model)
+            with autocast():
+                layer_errors = get_layer_errors(model, reference_io)
+        except (NotImplementedError, RuntimeError) as e:
+            if not _is_unsupported(e):
+                raise
+            results[quantization] = {"unsupported": f"{type(e).__name__}: {e}"}
+            continue
+        worst = sorted(layer_errors, key=layer_errors.get, reverse=True)[:5]
+        result.update({
+            "output_rel_error": _rel_error(out, reference_out),
+            "latent_rel_error": _rel_error(latents, reference_latents),
+            "layer_rel_error_max": max(layer_errors.values()),
+            "layer_rel_error_mean": statistics.mean(layer_errors.values()),
+            "worst_layers": {name: layer_errors[name] for name in worst},
+            "layer_rel_error": layer_errors,
+        })
+        results[quantization] = result
+        del model
+
+    return {
+        "device": device,
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "base_precision": base_precision,
+        "fp8_scale": fp8_scale,
+        "steps": steps,
+        "config": TINY_TRANSFORMER_CONFIG,
+        "reference": reference_result,
+        "results": results,
+    }
+
+
+def benchmark_swap(cache_mb=(0, 16, 256), repeats=3, frames=9, height=256, width=256):
+    """
+    CPU microbenchmark of DynamicSwapInstaller. The tiny transformer is kept in float32 and swapped to bf16,
+    which stands in for the host to device copy: every swap of a weight is a real copy. Reports attribute
+    hook calls, transfers and seconds per forward, without a WeightCache and with one of each size.
+    """
+    import torch
+    memory = import_submodule("diffusers_helper.memory")
+    model = build_tiny_transformer("disabled", torch.float32, "cpu")
+    inputs = _forward_inputs(tiny_transformer_inputs("cpu", torch.bfloat16, frames=frames, height=height, width=width), "cpu", torch.bfloat16)
+
+    results = {}
+    for name, max_bytes in [("uncached", None)] + [(f"cache_{mb}mb", int(mb * 1024 ** 2)) for mb in cache_mb]:
+        weight_cache = memory.WeightCache(max_bytes)
+        memory.DynamicSwapInstaller.install_model(model, weight_cache=weight_cache, dtype=torch.bfloat16)
+        try:
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+                time_forward(model, inputs, repeats=1, warmup=0)
+                weight_cache.get_stats()
+                seconds, _ = time_forward(model, inputs, repeats=repeats, warmup=0)
+        finally:
+            memory.DynamicSwapInstaller.uninstall_model(model)
+        stats = weight_cache.get_stats()
+        results[name] = {
+            "forward_s": seconds,
+            "hook_calls": stats["hook_calls"] / repeats,
+            "transfers": stats["transfers"] / repeats,
+            "transferred_mb": stats["transferred_bytes"] / repeats / 1024 ** 2,
+            "evictions": stats["evictions"] / repeats,
+        }
+
+    return {
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "model_bf16_mb": get_model_bytes(model) / 2 / 1024 ** 2,
+        "per_forward": results,
+    }
+
+
+def benchmark_disk_offload(cache_blocks=(1, 4, 64), read_ahead=2, repeats=3, frames=9, height=256, width=256):
+    """
+    CPU benchmark of DiskOffloadTier: the tiny transformer is saved to a temporary .safetensors file and
+    loaded back memory-mapped, then run with host caches of the given number of blocks. The file's pages
+    are dropped from the OS cache before every run where the platform allows it, so the page-ins read the disk.
+    Reports the tier's hit rate and page-in bandwidth per forward, and that the output matches the in-memory model.
+    """
+    import tempfile
+    import torch
+    from accelerate import init_empty_weights
+    packed = import_submodule("diffusers_helper.models.hunyuan_video_packed")
+    model_loading = import_submodule("model_loading")
+    disk_offload = import_submodule("disk_offload")
+    reference = build_tiny_transformer("disabled", torch.bfloat16, "cpu")
+    inputs = _forward_inputs(tiny_transformer_inputs("cpu", torch.bfloat16, frames=frames, height=height, width=width), "cpu", torch.bfloat16)
+    with torch.no_grad(), torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+        expected = reference(**inputs)[0]
+    block_bytes = max(get_model_bytes(block) for block in list(reference.transformer_blocks) + list(reference.single_transformer_blocks))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "tiny.safetensors")
+        model_loading.save_safetensors_streaming({name: p for name, p in reference.named_parameters()}, path)
+        for blocks in cache_blocks:
+            if hasattr(os, "posix_fadvise"):
+                with open(path, "rb") as f:
+                    # dirty pages can't be dropped, write them out first
+                    os.fsync(f.fileno())
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            with init_empty_weights():
+                model = packed.HunyuanVideoTransformer3DModel(**TINY_TRANSFORMER_CONFIG)
+            model_loading.load_state_dict_streaming(model, model_loading.SafetensorsFile(path), "cpu", num_workers=1)
+            model.eval()
+            tier = disk_offload.DiskOffloadTier.install(model, model_loading.SafetensorsFile(path), blocks * block_bytes, read_ahead=read_ahead)
+            try:
+                with torch.no_grad(), torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+                    seconds, out = time_forward(model, inputs, repeats=repeats, warmup=0)
+            finally:
+                tier.remove()
+            stats = tier.get_stats()
+            stats.update({
+                "forward_s": seconds,
+                "paged_in_mb": stats.pop("paged_in_gb") * 1024 / repeats,
+                "rel_error": _rel_error(out, expected),
+            })
+            results[f"cache_{blocks}_blocks"] = stats
+
+    return {
+        "torch": torch.__version__,
+        "model_mb": get_model_bytes(reference) / 1024 ** 2,
+        "block_mb": block_bytes / 1024 ** 2,
+        "read_ahead": read_ahead,
+        "per_forward": results,
+    }
+
+
+def benchmark_transfer_compression(modes=("fp8", "int8"), frames=9, height=256, width=256):
+    """
+    Accuracy and transfer volume of the TransferCodec modes on the tiny transformer, on the CPU: every weight the
+    codec compresses is replaced by its dequantized compact copy, as BlockPrefetcher uploads it for streamed blocks.
+    """
+    import torch
+    transfer_compression = import_submodule("transfer_compression")
+    inputs = _forward_inputs(tiny_transformer_inputs("cpu", torch.bfloat16, frames=frames, height=height, width=width), "cpu", torch.bfloat16)
+    with torch.no_grad(), torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+        expected = build_tiny_transformer("disabled", torch.bfloat16, "cpu")(**inputs)[0]
+
+    results = {}
+    for mode in modes:
+        model = build_tiny_transformer("disabled", torch.bfloat16, "cpu")
+        codec = transfer_compression.TransferCodec(model, mode, pin_memory=False)
+        original_bytes = 0
+        with torch.no_grad():
+            for module in model.modules():
+                weight = module._parameters.get("weight")
+                if weight is None or not codec.compresses(module, "_parameters", "weight", weight):
+                    continue
+                original_bytes += weight.nelement() * weight.element_size()
+                codec.decode(*codec.encode(module, weight), out=weight.data)
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+                out = model(**inputs)[0]
+        results[mode] = {
+            "rel_error": _rel_error(out, expected),
+            "compressed_mb": original_bytes / 1024 ** 2,
+            "transferred_mb": codec.encoded_bytes / 1024 ** 2,
+            "ratio": codec.encoded_bytes / max(original_bytes, 1),
+        }
+    return {"torch": torch.__version__, "per_mode": results}
+
+
+def benchmark_reentrant(threads=4, steps=6, rel_l1_thresh=0.15, frames=9, height=256, width=256):
+    """
+    Samples with TeaCache from several threads at once against one tiny transformer, on the CPU, each with its
+    own TransformerRunContext and seed. Every thread has to reproduce the latents of the same run done alone,
+    the reentrant command exits non-zero when one doesn't.
+    """
+    import torch
+    from concurrent.futures import ThreadPoolExecutor
+    packed = import_submodule("diffusers_helper.models.hunyuan_video_packed")
+    model = build_tiny_transformer("disabled", torch.bfloat16, "cpu")
+    inputs = tiny_transformer_inputs("cpu", torch.bfloat16, frames=frames, height=height, width=width)
+
+    def run(seed):
+        run_context = packed.TransformerRunContext(enable_teacache=True, num_steps=steps, rel_l1_thresh=rel_l1_thresh)
+        with torch.no_grad(), torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+            latents, step_seconds = sample_tiny(model, inputs, steps, "cpu", torch.bfloat16, seed=seed, run_context=run_context)
+        return latents, step_seconds, run_context.cnt
+
+    seeds = list(range(threads))
+    start = time.perf_counter()
+    expected = [run(seed) for seed in seeds]
+    sequential_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        concurrent = list(executor.map(run, seeds))
+    concurrent_seconds = time.perf_counter() - start
+
+    per_thread = []
+    for seed, (latents, _, cnt), (expected_latents, _, _) in zip(seeds, concurrent, expected):
+        per_thread.append({
+            "seed": seed,
+            "max_abs_diff": (latents.float() - expected_latents.float()).abs().max().item(),
+            "teacache_cnt": cnt,
+        })
+    return {
+        "torch": torch.__version__,
+        "threads": threads,
+        "identical": all(r["max_abs_diff"] == 0 for r in per_thread),
+        "sequential_s": sequential_seconds,
+        "concurrent_s": concurrent_seconds,
+        "per_thread": per_thread,
+    }
+
+
+def benchmark_batched_cfg(cfg=3.0, negative_len=16, steps=4, device="cpu", frames=9, height=256, width=256):
+    """
+    Batched CFG (positive and negative as one forward) against separate forwards on the tiny transformer. The
+    negative prompt has negative_len of the positive's text tokens, so the batched forward has to mask its padding.
+    """
+    import torch
+    pipeline = import_submodule("diffusers_helper.pipelines.k_diffusion_hunyuan")
+    model = build_tiny_transformer("disabled", torch.bfloat16, device)
+    inputs = tiny_transformer_inputs(device, torch.bfloat16, frames=frames, height=height, width=width)
+    negative = tiny_transformer_inputs(device, torch.bfloat16, frames=frames, height=height, width=width, seed=1)
+    negative_mask = torch.zeros_like(negative["prompt_embeds_mask"])
+    negative_mask[:, :negative_len] = 1
+
+    results = {}
+    for batched_cfg in (False, True):
+        _synchronize(device)
+        start = time.perf_counter()
+        with torch.no_grad(), torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16):
+            latents = pipeline.sample_hunyuan(
+                transformer=model, sampler="unipc_bh1", num_inference_steps=steps, real_guidance_scale=cfg,
+                negative_prompt_embeds=negative["prompt_embeds"], negative_prompt_embeds_mask=negative_mask,
+                negative_prompt_poolers=negative["prompt_poolers"], batched_cfg=batched_cfg,
+                generator=torch.Generator("cpu").manual_seed(0), dtype=torch.bfloat16, device=device, **inputs,
+            )
+        _synchronize(device)
+        results["batched" if batched_cfg else "sequential"] = {"latents": latents, "step_s": (time.perf_counter() - start) / steps}
+    return {
+        "torch": torch.__version__,
+        "device": device,
+        # bf16 rounding differs between batch sizes, the masking has to keep it at that level
+        "rel_error": _rel_error(results["batched"]["latents"], results["sequential"]["latents"]),
+        "sequential_step_s": results["sequential"]["step_s"],
+        "batched_step_s": results["batched"]["step_s"],
+    }
+
+
+def benchmark_residency_plan(budget_gb, base_precision="bf16", stream_buffers=2, costs_path=None, tiny=False):
+    """
+    Residency plan of the full size transformer (or the tiny one) for a simulated device budget. The model
+    is built on the meta device, so this needs neither the weights nor a GPU.
+    """
+    import torch
+    from accelerate import init_empty_weights
+    packed = import_submodule("diffusers_helper.models.hunyuan_video_packed")
+    memory = import_submodule("diffusers_helper.memory")
+    dtype = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}[base_precision]
+    if tiny:
+        config = TINY_TRANSFORMER_CONFIG
+    else:
+        with open(os.path.join(PACKAGE_DIR, "transformer_config.json"), "r") as f:
+            config = json.load(f)
+    with init_empty_weights():
+        model = packed.HunyuanVideoTransformer3DModel(**config).to(dtype)
+    costs = None
+    if costs_path:
+        with open(costs_path, "r") as f:
+            costs = json.load(f)
+
+    plan = memory.plan_residency(model, int(budget_gb * 1024 ** 3), costs=costs, stream_buffers=stream_buffers)
+    result = plan.summary()
+    result.update({"model_gb": memory.get_tensor_bytes(model) / 1024 ** 3, "streamed": plan.streamed})
+    return result
+
+
+def benchmark_preflight(width, height, latent_window_size, cfg=1.0, use_teacache=True, gpu_memory_preservation=6.0, vram_gb=None,
+                        quantization="disabled", prefetch_blocks=2, tflops=None, bandwidth_gb_s=None, device=None, batched_cfg=True):
+    """Pre-flight estimate of the full size transformer for the given sampler settings, see preflight.estimate."""
+    import torch
+    preflight = import_submodule("preflight")
+    with open(os.path.join(PACKAGE_DIR, "transformer_config.json"), "r") as f:
+        config = json.load(f)
+    result = preflight.estimate(config, width, height, latent_window_size, cfg=cfg, use_teacache=use_teacache,
+                                gpu_memory_preservation=gpu_memory_preservation, vram_gb=vram_gb, quantization=quantization,
+                                prefetch_blocks=prefetch_blocks, device=torch.device(device) if device else None,
+                                flops_per_s=tflops * 1e12 if tflops else None,
+                                bandwidth=bandwidth_gb_s * 1024 ** 3 if bandwidth_gb_s else None, batched_cfg=batched_cfg)
+    result["report"] = preflight.format_report(result)
+    return result
+
+
+def benchmark_sensitivity(scheme="fp8_scaled", budget_gb=None, high_scheme="base", base_precision="bf16", fp8_scale="per_tensor",
+                          device="cpu", model_path=None, frames=9, height=256, width=256):
+    """
+    Ranks the blocks of the transformer by the output error they cause when only they are quantized to
+    `scheme`, and with budget_gb, generates the precision policy that keeps the most sensitive blocks in
+    `high_scheme` while the weights still fit in the budget. Uses the tiny random transformer unless
+    model_path points to a real checkpoint.
+    """
+    import torch
+    precision_policy = import_submodule("precision_policy")
+    dtype = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}[base_precision]
+
+    if model_path:
+        model, config = load_transformer(model_path, dtype, device)
+    else:
+        model, config = build_tiny_transformer("disabled", dtype, device), TINY_TRANSFORMER_CONFIG
+    inputs = tiny_transformer_inputs(device, dtype, frames=frames, height=height, width=width, config=config)
+    forward_inputs = _forward_inputs(inputs, device, dtype, config=config)
+
+    start = time.perf_counter()
+    with torch.autocast(device_type=torch.device(device).type, dtype=dtype):
+        sensitivity = precision_policy.block_sensitivity(model, forward_inputs, scheme, dtype, fp8_scale)
+    low = precision_policy.get_policy(scheme)
+    high = precision_policy.get_policy(high_scheme)
+    result = {
+        "model": model_path or "tiny",
+        "device": device,
+        "scheme": scheme,
+        "high_scheme": high_scheme,
+        "base_precision": base_precision,
+        "seconds": time.perf_counter() - start,
+        "model_gb": {scheme: precision_policy.get_model_bytes(model, low, dtype) / 1024 ** 3,
+                     high_scheme: precision_policy.get_model_bytes(model, high, dtype) / 1024 ** 3},
+        "sensitivity": sensitivity,
+    }
+    if budget_gb is not None:
+        policy, size = precision_policy.policy_for_budget(model, sensitivity, budget_gb * 1024 ** 3, scheme, dtype, high_scheme)
+        result["budget_gb"] = budget_gb
+        result["policy_gb"] = size / 1024 ** 3
+        result["policy"] = policy.to_text()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("import", help="time added to ComfyUI startup by importing this package")
+    p.add_argument("--repeats", type=int, default=5)
+
+    p = subparsers.add_parser("quant", help="accuracy and speed of the quantization modes on a tiny random transformer")
+    p.add_argument("--modes", nargs="+", default=None, help="quantization modes to compare, default all")
+    p.add_argument("--base_precision", default="bf16", choices=["fp32", "bf16", "fp16"])
+    p.add_argument("--fp8_scale", default="per_tensor", choices=["per_tensor", "per_channel"])
+    p.add_argument("--device", default="cpu")
+    p.add_argument("--steps", type=int, default=4)
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--frames", type=int, default=9)
+    p.add_argument("--height", type=int, default=256)
+    p.add_argument("--width", type=int, default=256)
+    p.add_argument("--output", default=None, help="also write the report to this file")
+
+    p = subparsers.add_parser("sensitivity", help="rank the transformer blocks by quantization error and generate a precision policy for a memory budget")
+    p.add_argument("--scheme", default="fp8_scaled", help="scheme the blocks are quantized to")
+    p.add_argument("--high_scheme", default="base", help="scheme the most sensitive blocks are kept in")
+    p.add_argument("--budget_gb", type=float, default=None, help="weight memory budget of the generated policy")
+    p.add_argument("--model", default=None, help="checkpoint to analyze instead of the tiny random transformer")
+    p.add_argument("--base_precision", default="bf16", choices=["fp32", "bf16", "fp16"])
+    p.add_argument("--fp8_scale", default="per_tensor", choices=["per_tensor", "per_channel"])
+    p.add_argument("--device", default="cpu")
+    p.add_argument("--frames", type=int, default=9)
+    p.add_argument("--height", type=int, default=256)
+    p.add_argument("--width", type=int, default=256)
+    p.add_argument("--output", default=None, help="also write the report to this file")
+
+    p = subparsers.add_parser("swap", help="attribute hook calls and weight transfers per forward of DynamicSwapInstaller, on the CPU")
+    p.add_argument("--cache_mb", type=float, nargs="+", default=[0, 16, 256], help="WeightCache sizes to compare")
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--frames", type=int, default=9)
+    p.add_argument("--height", type=int, default=256)
+    p.add_argument("--width", type=int, default=256)
+
+    p = subparsers.add_parser("disk", help="hit rate and page-in bandwidth of the disk offload tier for several host cache sizes, on the CPU")
+    p.add_argument("--cache_blocks", type=int, nargs="+", default=[1, 4, 64], help="host cache sizes to compare, in blocks")
+    p.add_argument("--read_ahead", type=int, default=2)
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--frames", type=int, default=9)
+    p.add_argument("--height", type=int, default=256)
+    p.add_argument("--width", type=int, default=256)
+    p.add_argument("--output", default=None, help="also write the report to this file")
+
+    p = subparsers.add_parser("compress", help="accuracy and transfer volume of the compressed uploads of streamed blocks, on the CPU")
+    p.add_argument("--modes", nargs="+", default=["fp8", "int8"])
+    p.add_argument("--frames", type=int, default=9)
+    p.add_argument("--height", type=int, default=256)
+    p.add_argument("--width", type=int, default=256)
+    p.add_argument("--output", default=None, help="also write the report to this file")
+
+    p = subparsers.add_parser("reentrant", help="concurrent TeaCache sampling from several threads against one tiny transformer, on the CPU")
+    p.add_argument("--threads", type=int, default=4)
+    p.add_argument("--steps", type=int, default=6)
+    p.add_argument("--rel_l1_thresh", type=float, default=0.15)
+    p.add_argument("--frames", type=int, default=9)
+    p.add_argument("--height", type=int, default=256)
+    p.add_argument("--width", type=int, default=256)
+
+    p = subparsers.add_parser("cfg", help="batched CFG against separate positive and negative forwards on the tiny transformer")
+    p.add_argument("--cfg", type=float, default=3.0)
+    p.add_argument("--negative_len", type=int, default=16, help="text tokens of the negative prompt, out of 64")
+    p.add_argument("--steps", type=int, default=4)
+    p.add_argument("--device", default="cpu")
+    p.add_argument("--frames", type=int, default=9)
+    p.add_argument("--height", type=int, default=256)
+    p.add_argument("--width", type=int, default=256)
+
+    p = subparsers.add_parser("plan", help="which transformer blocks stay resident for a simulated GPU memory budget")
+    p.add_argument("--budget_gb", type=float, required=True)
+    p.add_argument("--base_precision", default="bf16", choices=["fp32", "bf16", "fp16"])
+    p.add_argument("--stream_buffers", type=int, default=2)
+    p.add_argument("--costs", default=None, help="json of {block: stall ms}, as measured by BlockPrefetcher")
+    p.add_argument("--tiny", action="store_true", help="plan the tiny config instead of the full size one")
+
+    p = subparsers.add_parser("preflight", help="estimated peak memory, residency and step time of sampler settings, traced on the meta device")
+    p.add_argument("--width", type=int, default=640)
+    p.add_argument("--height", type=int, default=640)
+    p.add_argument("--latent_window_size", type=int, default=9)
+    p.add_argument("--cfg", type=float, default=1.0)
+    p.add_argument("--no_teacache", action="store_true")
+    p.add_argument("--no_batched_cfg", action="store_true", help="positive and negative as separate forwards")
+    p.add_argument("--gpu_memory_preservation", type=float, default=6.0)
+    p.add_argument("--vram_gb", type=float, default=None, help="card to estimate for, default the current device")
+    p.add_argument("--quantization", default="disabled")
+    p.add_argument("--prefetch_blocks", type=int, default=2)
+    p.add_argument("--tflops", type=float, default=None, help="matmul throughput to assume instead of measuring it")
+    p.add_argument("--bandwidth_gb_s", type=float, default=None, help="host to device bandwidth to assume instead of measuring it")
+    p.add_argument("--device", default=None)
+
+    p = subparsers.add_parser("int8", help="int8 quantized transformer against bf16 on the tiny config")
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--device", default="cpu")
+
+    subparsers.add_parser("_import_child")
+
+    args = parser.parse_args()
+    if args.command == "_import_child":
+        return _import_time_child()
+    if args.command == "import":
+        result = benchmark_import(args.repeats)
+    elif args.command == "quant":
+        result = benchmark_quantization(args.modes, args.base_precision, args.fp8_scale, args.device, args.steps, args.repeats,
+                                        args.frames, args.height, args.width)
+    elif args.command == "sensitivity":
+        result = benchmark_sensitivity(args.scheme, args.budget_gb, args.high_scheme, args.base_precision, args.fp8_scale,
+                                       args.device, args.model, args.frames, args.height, args.width)
+    elif args.command == "swap":
+        result = benchmark_swap(args.cache_mb, args.repeats, args.frames, args.height, args.width)
+    elif args.command == "disk":
+        result = benchmark_disk_offload(args.cache_blocks, args.read_ahead, args.repeats, args.frames, args.height, args.width)
+    elif args.command == "compress":
+        result = benchmark_transfer_compression(args.modes, args.frames, args.height, args.width)
+    elif args.command == "reentrant":
+        result = benchmark_reentrant(args.threads, args.steps, args.rel_l1_thresh, args.frames, args.height, args.width)
+    elif args.command == "cfg":
+        result = benchmark_batched_cfg(args.cfg, args.negative_len, args.steps, args.device, args.frames, args.height, args.width)
+    elif args.command == "plan":
+        result = benchmark_residency_plan(args.budget_gb, args.base_precision, args.stream_buffers, args.costs, args.tiny)
+    elif args.command == "preflight":
+        result = benchmark_preflight(args.width, args.height, args.latent_window_size, args.cfg, not args.no_teacache,
+                                     args.gpu_memory_preservation, args.vram_gb, args.quantization, args.prefetch_blocks,
+                                     args.tflops, args.bandwidth_gb_s, args.device, not args.no_batched_cfg)
+    elif args.command == "int8":
+        result = benchmark_quantization(["int8_weight_only", "int8_dynamic"], device=args.device, repeats=args.repeats)
+    if getattr(args, "output", None):
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    if args.command == "reentrant" and not result["identical"]:
+        sys.exit("Concurrent runs didn't reproduce the latents of the sequential runs")
+
+
+if __name__ == "__main__":
+    main()
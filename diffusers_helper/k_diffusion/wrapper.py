@@ -1,5 +1,7 @@
 import torch
 
+from ..utils import repeat_to_batch_size
+
 
 def append_dims(x, target_dims):
     return x[(...,) + (None,) * (target_dims - x.ndim)]
@@ -16,7 +18,58 @@ def rescale_noise_cfg(noise_cfg, noise_pred_text, guidance_rescale=1.0):
     return noise_cfg
 
 
-def fm_wrapper(transformer, t_scale=1000.0):
+def concat_cfg_kwargs(positive, negative, batch_size):
+    """The positive and negative transformer kwargs as one batch of 2 * batch_size, None if they can't be batched."""
+    if positive.keys() != negative.keys():
+        return None
+    batched = {}
+    for k, p in positive.items():
+        n = negative[k]
+        if isinstance(p, torch.Tensor) and isinstance(n, torch.Tensor):
+            try:
+                p, n = repeat_to_batch_size(p, batch_size), repeat_to_batch_size(n, batch_size)
+            except ValueError:
+                return None
+            if p.shape[1:] != n.shape[1:]:
+                return None
+            batched[k] = torch.cat([p, n], dim=0)
+        elif p is n:
+            batched[k] = p
+        else:
+            return None
+    return batched
+
+
+def fm_wrapper(transformer, t_scale=1000.0, run_context=None, batched_cfg=False):
+    # batched_cfg runs positive and negative as one forward of twice the batch, so offloaded weights stream once
+    # per step instead of twice. It falls back to separate forwards for the rest of the run when that runs out of memory.
+    state = dict(batched_cfg=batched_cfg, source=None, batched_kwargs=None)
+
+    def batched_forward(hidden_states, timestep, extra_args):
+        if state['source'] is not extra_args:
+            state['source'] = extra_args
+            state['batched_kwargs'] = concat_cfg_kwargs(extra_args['positive'], extra_args['negative'], hidden_states.shape[0])
+        if state['batched_kwargs'] is None:
+            return None
+
+        ctx = run_context if run_context is not None else transformer.default_run_context
+        saved = dict(vars(ctx))
+        try:
+            pred = transformer(hidden_states=torch.cat([hidden_states] * 2), timestep=torch.cat([timestep] * 2), return_dict=False,
+                               run_context=run_context, **state['batched_kwargs'])[0].float()
+        except torch.cuda.OutOfMemoryError:
+            print('Not enough memory for batched CFG, running positive and negative as separate forwards')
+            state['batched_cfg'] = False
+            state['batched_kwargs'] = None
+            # undo what the failed forward changed
+            vars(ctx).update(saved)
+            prefetcher = transformer.__dict__.get('block_prefetcher')
+            if prefetcher is not None:
+                prefetcher.release()
+            torch.cuda.empty_cache()
+            return None
+        return pred.chunk(2)
+
     def k_model(x, sigma, **extra_args):
         dtype = extra_args['dtype']
         cfg_scale = extra_args['cfg_scale']
@@ -34,12 +87,19 @@ def fm_wrapper(transformer, t_scale=1000.0):
         else:
             hidden_states = torch.cat([x, concat_latent.to(x)], dim=1)
 
-        pred_positive = transformer(hidden_states=hidden_states, timestep=timestep, return_dict=False, **extra_args['positive'])[0].float()
+        preds = None
+        if cfg_scale != 1.0 and state['batched_cfg']:
+            preds = batched_forward(hidden_states, timestep, extra_args)
 
-        if cfg_scale == 1.0:
-            pred_negative = torch.zeros_like(pred_positive)
+        if preds is not None:
+            pred_positive, pred_negative = preds
         else:
-            pred_negative = transformer(hidden_states=hidden_states, timestep=timestep, return_dict=False, **extra_args['negative'])[0].float()
+            pred_positive = transformer(hidden_states=hidden_states, timestep=timestep, return_dict=False, run_context=run_context, **extra_args['positive'])[0].float()
+
+            if cfg_scale == 1.0:
+                pred_negative = torch.zeros_like(pred_positive)
+            else:
+                pred_negative = transformer(hidden_states=hidden_states, timestep=timestep, return_dict=False, run_context=run_context, **extra_args['negative'])[0].float()
 
         pred_cfg = pred_negative + cfg_scale * (pred_positive - pred_negative)
         pred = rescale_noise_cfg(pred_cfg, pred_positive, guidance_rescale=cfg_rescale)
@@ -2,16 +2,216 @@
 
 
 import torch
+import threading
+
+from collections import OrderedDict
 
 
 cpu = torch.device('cpu')
-gpu = torch.device(f'cuda:{torch.cuda.current_device()}')
+gpu = torch.device(f'cuda:{torch.cuda.current_device()}') if torch.cuda.is_available() else cpu
 gpu_complete_modules = []
 
 
+class WeightCache:
+    """
+    Device copies handed out by DynamicSwapInstaller, reused from one forward of the model to the next.
+
+    Without it, every read of an offloaded weight makes a new copy, so a weight read twice in a forward is
+    transferred twice, and every read goes through the Python swap hook. Here the first read of a parameter,
+    buffer or submodule in a forward puts the result into the module's __dict__, so further reads, in this
+    forward and the following ones, are plain attribute lookups that never reach the hook. Copies are dropped
+    oldest first once max_bytes is exceeded. Whatever moves or patches the weights has to clear() the cache
+    (see clear_weight_cache), the copies would be stale otherwise. With max_bytes=None nothing is cached and
+    only the hook calls and transfers are counted.
+
+    The shadowed attributes are seen by every thread using the module, so caching is only on while a single
+    forward is in flight, a second concurrent forward turns it off and drops everything until the next begin.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.active = False
+        self.lock = threading.Lock()
+        self.forwards = set()
+        self.copies = OrderedDict()
+        self.shadows = []
+        self.bytes = 0
+        self.hook_calls = 0
+        self.transfers = 0
+        self.transferred_bytes = 0
+        self.evictions = 0
+
+    def _shadow(self, module, name, value):
+        if self.active:
+            module.__dict__[name] = value
+            self.shadows.append((module, name))
+        return value
+
+    def _put_copy(self, module, name, copy):
+        nbytes = copy.nelement() * copy.element_size()
+        self.transfers += 1
+        self.transferred_bytes += nbytes
+        if not self.active or nbytes > self.max_bytes:
+            return copy
+        while self.bytes + nbytes > self.max_bytes:
+            (old_module, old_name), old_nbytes = self.copies.popitem(last=False)
+            old_module.__dict__.pop(old_name, None)
+            self.bytes -= old_nbytes
+            self.evictions += 1
+        module.__dict__[name] = copy
+        self.copies[(module, name)] = nbytes
+        self.bytes += nbytes
+        return copy
+
+    def get_tensor(self, module, name, t, kwargs):
+        copy = t.to(**kwargs)
+        with self.lock:
+            self.hook_calls += 1
+            if copy is t:
+                # already where it should be: resident parameters are safe to keep, tensors swapped in by
+                # BlockPrefetcher are not, it takes them back after the block
+                return self._shadow(module, name, t) if t.__class__ == torch.nn.Parameter else t
+            return self._put_copy(module, name, copy)
+
+    def get_module(self, module, name, submodule):
+        with self.lock:
+            self.hook_calls += 1
+            return self._shadow(module, name, submodule)
+
+    def count_hook_call(self):
+        with self.lock:
+            self.hook_calls += 1
+
+    def begin(self):
+        with self.lock:
+            # a thread whose last forward raised never ended it, and a dead thread won't
+            self.forwards = {t for t in self.forwards if t is not threading.current_thread() and t.is_alive()}
+            self.forwards.add(threading.current_thread())
+            if len(self.forwards) > 1:
+                self._clear()
+            self.active = self.max_bytes is not None and len(self.forwards) == 1
+
+    def end(self):
+        with self.lock:
+            self.forwards.discard(threading.current_thread())
+            self.active = False
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def _clear(self):
+        for module, name in self.shadows:
+            module.__dict__.pop(name, None)
+        for module, name in self.copies:
+            module.__dict__.pop(name, None)
+        self.shadows.clear()
+        self.copies.clear()
+        self.bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            stats = {'hook_calls': self.hook_calls, 'transfers': self.transfers, 'transferred_bytes': self.transferred_bytes, 'evictions': self.evictions}
+            self.hook_calls = self.transfers = self.transferred_bytes = self.evictions = 0
+        return stats
+
+
+def clear_weight_cache(model):
+    """Drops the device copies a model's WeightCache holds, after its weights were moved or patched."""
+    weight_cache = model.__dict__.get('weight_cache')
+    if weight_cache is not None:
+        weight_cache.clear()
+
+
+class PinnedHostPool:
+    """
+    One pinned host allocation holding the offloaded weights of a model, each parameter and buffer a view into it.
+
+    Copies from pageable memory go through a staging buffer and block the host, copies from pinned memory
+    run asynchronously at full PCIe bandwidth. The arena is allocated once, sized to the model or max_bytes
+    whichever is smaller. Every tensor gets a slot in module order, tensors that don't fit stay pageable.
+    Tensors that are on the GPU when the pool is installed get their slot filled by offload().
+    """
+    ALIGNMENT = 64
+
+    def __init__(self, model, max_bytes):
+        tensors = []
+        for module in model.modules():
+            for kind in ('_parameters', '_buffers'):
+                for name, t in getattr(module, kind).items():
+                    if t is not None:
+                        tensors.append((module, kind, name, t))
+
+        sizes = [-(-t.nelement() * t.element_size() // self.ALIGNMENT) * self.ALIGNMENT for _, _, _, t in tensors]
+        self.arena = torch.empty(min(sum(sizes), max_bytes), dtype=torch.uint8, pin_memory=True)
+        self.slots = []
+        self.pageable_bytes = 0
+        offset = 0
+        for (module, kind, name, t), size in zip(tensors, sizes):
+            if offset + size > self.arena.numel():
+                self.pageable_bytes += t.nelement() * t.element_size()
+                continue
+            nbytes = t.nelement() * t.element_size()
+            slot = self.arena[offset:offset + nbytes].view(t.dtype).view(t.shape)
+            self.slots.append((module, kind, name, slot))
+            offset += size
+        self.pinned_bytes = offset
+        self.offload(host_only=True)
+
+    @staticmethod
+    def install(model, max_bytes):
+        """Moves the model's host weights into a pinned arena of at most max_bytes. Returns None where pinned memory isn't available."""
+        if 'pinned_host_pool' in model.__dict__ or max_bytes <= 0:
+            return model.__dict__.get('pinned_host_pool')
+        if not torch.cuda.is_available():
+            return None
+        try:
+            pool = PinnedHostPool(model, max_bytes)
+        except RuntimeError as e:
+            print(f'Could not allocate {max_bytes / (1024 ** 3):.2f} GB of pinned memory, keeping the weights in pageable memory: {e}')
+            return None
+        model.__dict__['pinned_host_pool'] = pool
+        print(f'Pinned {pool.pinned_bytes / (1024 ** 3):.2f} GB of weights, {pool.pageable_bytes / (1024 ** 3):.2f} GB stay pageable')
+        return pool
+
+    def offload(self, host_only=False, modules=None):
+        """Puts every tensor that has a slot (of `modules`, default all) back into it, copying the ones that were moved to the GPU (or replaced) since."""
+        copied = False
+        for module, kind, name, slot in self.slots:
+            if modules is not None and module not in modules:
+                continue
+            t = getattr(module, kind)[name]
+            if t is None or t.data_ptr() == slot.data_ptr() or (host_only and t.device.type != 'cpu'):
+                continue
+            if t.shape != slot.shape or t.dtype != slot.dtype:
+                # replaced by something else (e.g. requantized), it stays where it is
+                continue
+            slot.copy_(t.detach(), non_blocking=True)
+            copied = True
+            if kind == '_parameters':
+                t.data = slot
+            else:
+                getattr(module, kind)[name] = slot
+        if copied:
+            torch.cuda.synchronize()
+
+
+def get_host_stores(model):
+    """The pinned arena and the disk tier of a model, whichever it has, both offload(host_only, modules) into their own storage."""
+    return [store for store in (model.__dict__.get('pinned_host_pool'), model.__dict__.get('disk_tier')) if store is not None]
+
+
+def offload_model(model, offload_device):
+    """model.to(offload_device), into the model's pinned arena or disk tier when it has one."""
+    clear_weight_cache(model)
+    if torch.device(offload_device).type == 'cpu':
+        for store in get_host_stores(model):
+            store.offload()
+    model.to(offload_device)
+
+
 class DynamicSwapInstaller:
     @staticmethod
-    def _install_module(module: torch.nn.Module, **kwargs):
+    def _install_module(module: torch.nn.Module, weight_cache=None, **kwargs):
         original_class = module.__class__
         module.__dict__['forge_backup_original_class'] = original_class
 
@@ -22,6 +222,8 @@ class DynamicSwapInstaller:
                     p = _parameters[name]
                     if p is None:
                         return None
+                    if weight_cache is not None:
+                        return weight_cache.get_tensor(self, name, p, kwargs)
                     if p.__class__ == torch.nn.Parameter:
                         return torch.nn.Parameter(p.to(**kwargs), requires_grad=p.requires_grad)
                     else:
@@ -29,7 +231,14 @@ class DynamicSwapInstaller:
             if '_buffers' in self.__dict__:
                 _buffers = self.__dict__['_buffers']
                 if name in _buffers:
+                    if weight_cache is not None and _buffers[name] is not None:
+                        return weight_cache.get_tensor(self, name, _buffers[name], kwargs)
                     return _buffers[name].to(**kwargs)
+            if weight_cache is not None:
+                _modules = self.__dict__.get('_modules')
+                if _modules is not None and _modules.get(name) is not None:
+                    return weight_cache.get_module(self, name, _modules[name])
+                weight_cache.count_hook_call()
             return super(original_class, self).__getattr__(name)
 
         module.__class__ = type('DynamicSwap_' + original_class.__name__, (original_class,), {
@@ -45,18 +254,353 @@ class DynamicSwapInstaller:
         return
 
     @staticmethod
-    def install_model(model: torch.nn.Module, **kwargs):
+    def install_model(model: torch.nn.Module, weight_cache=None, **kwargs):
+        """With a WeightCache, device copies are reused within a forward of `model` instead of being made on every read."""
         for m in model.modules():
-            DynamicSwapInstaller._install_module(m, **kwargs)
+            DynamicSwapInstaller._install_module(m, weight_cache=weight_cache, **kwargs)
+        if weight_cache is not None:
+            model.__dict__['weight_cache'] = weight_cache
+            # only caches during a forward, reads outside of one get a fresh copy as before
+            model.__dict__['weight_cache_hooks'] = [
+                model.register_forward_pre_hook(lambda module, args: weight_cache.begin()),
+                model.register_forward_hook(lambda module, args, output: weight_cache.end()),
+            ]
         return
 
     @staticmethod
     def uninstall_model(model: torch.nn.Module):
+        weight_cache = model.__dict__.pop('weight_cache', None)
+        if weight_cache is not None:
+            weight_cache.end()
+            weight_cache.clear()
+            for hook in model.__dict__.pop('weight_cache_hooks'):
+                hook.remove()
         for m in model.modules():
             DynamicSwapInstaller._uninstall_module(m)
         return
 
 
+class BlockPrefetcher:
+    """
+    Streams the weights of offloaded transformer blocks to the GPU ahead of their use.
+
+    DynamicSwapInstaller copies every offloaded weight synchronously when it is accessed, so the GPU sits
+    idle during each transfer. Given the blocks in execution order, this copies the next offloaded blocks'
+    weights on a side stream while the current block computes, keeping at most num_buffers blocks of
+    weights on the device (the running block and num_buffers - 1 prefetched ones). After the last block
+    the first ones are prefetched again for the next step. Blocks that are already resident are skipped.
+
+    With a TransferCodec the weights it compresses are uploaded in their compact form and dequantized on the
+    side stream into device buffers that are reused once the block that had them has finished.
+
+    Nothing is pinned here: weights with a slot in the model's PinnedHostPool are uploaded from it, the
+    rest is copied from pageable memory, which the host waits for.
+    """
+    def __init__(self, blocks, device, num_buffers=2, host_pool=None, names=None, disk_tier=None, codec=None):
+        self.blocks = list(blocks)
+        self.names = list(names) if names is not None else [str(i) for i in range(len(self.blocks))]
+        self.device = device
+        self.disk_tier = disk_tier
+        self.codec = codec
+        self.free_buffers = {}
+        self.num_buffers = max(num_buffers, 1)
+        self.stream = torch.cuda.Stream(device)
+        self.hooks = []
+        self.pending = {}
+        self.active = {}
+        self.timings = []
+        self.transferred_bytes = 0
+        self.saved_bytes = 0
+
+        # the parameters and buffers that live off the device, per block
+        self.host_tensors = {}
+        for i, block in enumerate(self.blocks):
+            if host_pool is not None:
+                # weights replaced since they were offloaded (e.g. a LoRA fused in) go back into their slots
+                host_pool.offload(host_only=True, modules=set(block.modules()))
+            entries = []
+            for module in block.modules():
+                for kind in ('_parameters', '_buffers'):
+                    for name, t in getattr(module, kind).items():
+                        if t is None or t.device == device:
+                            continue
+                        entries.append((module, kind, name, t))
+            if entries:
+                self.host_tensors[i] = entries
+
+        if codec is not None:
+            # compress up front rather than during the first step, the compact copies are kept for later runs
+            for entries in self.host_tensors.values():
+                for entry in entries:
+                    if codec.compresses(*entry):
+                        codec.encode(entry[0], entry[3])
+
+        offloaded = sorted(self.host_tensors)
+        self.next_block = {i: offloaded[(k + 1) % len(offloaded)] for k, i in enumerate(offloaded)}
+
+        for i in offloaded:
+            self.hooks.append(self.blocks[i].register_forward_pre_hook(lambda module, args, i=i: self._before_block(i)))
+            self.hooks.append(self.blocks[i].register_forward_hook(lambda module, args, output, i=i: self._after_block(i)))
+
+    @staticmethod
+    def install(model, device, num_buffers=2):
+        """Installs a prefetcher for the transformer's blocks, replacing a previous one. Returns None when there is nothing to prefetch."""
+        BlockPrefetcher.uninstall(model)
+        if device.type != 'cuda' or num_buffers < 1:
+            return None
+        names = get_block_names(model)
+        # pinned only within the pinned_memory_gb budget, weights in a disk tier are paged into its own pinned cache
+        prefetcher = BlockPrefetcher([model.get_submodule(name) for name in names], device, num_buffers,
+                                     host_pool=model.__dict__.get('pinned_host_pool'), names=names,
+                                     disk_tier=model.__dict__.get('disk_tier'), codec=model.__dict__.get('transfer_codec'))
+        if not prefetcher.host_tensors:
+            return None
+        model.__dict__['block_prefetcher'] = prefetcher
+        print(f'Prefetching {len(prefetcher.host_tensors)} offloaded blocks with {num_buffers} buffers')
+        return prefetcher
+
+    @staticmethod
+    def uninstall(model):
+        prefetcher = model.__dict__.pop('block_prefetcher', None)
+        if prefetcher is not None:
+            prefetcher.remove()
+        return prefetcher
+
+    def remove(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks.clear()
+        self.release()
+        self.stream.synchronize()
+        self.pending.clear()
+
+    def release(self):
+        """Points the blocks that are still active back at their host weights, e.g. after a forward failed halfway."""
+        for i in list(self.active):
+            self._after_block(i)
+
+    def _get_buffer(self, t):
+        """A device buffer for a dequantized weight, waiting on the side stream until its last user is done with it."""
+        free = self.free_buffers.get((t.shape, t.dtype))
+        if free:
+            buffer, released = free.pop()
+            self.stream.wait_event(released)
+            return buffer
+        return torch.empty(t.shape, dtype=t.dtype, device=self.device)
+
+    def _upload(self, module, kind, name, t):
+        if self.codec is None or not self.codec.compresses(module, kind, name, t):
+            self.transferred_bytes += t.nelement() * t.element_size()
+            return t.to(self.device, non_blocking=True)
+        weight, scale = self.codec.encode(module, t)
+        compact_bytes = weight.nelement() * weight.element_size() + scale.nelement() * scale.element_size()
+        self.transferred_bytes += compact_bytes
+        self.saved_bytes += t.nelement() * t.element_size() - compact_bytes
+        return self.codec.decode(weight.to(self.device, non_blocking=True), scale.to(self.device, non_blocking=True), self._get_buffer(t))
+
+    def _prefetch(self, i):
+        if self.disk_tier is not None:
+            self.disk_tier.ensure(self.names[i], count=False)
+        start = torch.cuda.Event(enable_timing=True)
+        ready = torch.cuda.Event(enable_timing=True)
+        with torch.cuda.stream(self.stream):
+            start.record()
+            copies = [self._upload(*entry) for entry in self.host_tensors[i]]
+            ready.record()
+        self.pending[i] = (copies, start, ready)
+
+    def _before_block(self, i):
+        if i not in self.pending:
+            self._prefetch(i)
+        copies, start, ready = self.pending.pop(i)
+        stream = torch.cuda.current_stream(self.device)
+        needed = torch.cuda.Event(enable_timing=True)
+        needed.record(stream)
+        stream.wait_event(ready)
+        self.timings.append((i, start, ready, needed))
+
+        for (module, kind, name, _), copy in zip(self.host_tensors[i], copies):
+            # the copies were allocated on the side stream, keep their memory until this stream is done with them
+            copy.record_stream(stream)
+            getattr(module, kind)[name] = copy
+        self.active[i] = copies
+
+        # keep the ring filled: the running block plus num_buffers - 1 blocks in flight
+        j = i
+        while len(self.pending) < self.num_buffers - 1:
+            j = self.next_block[j]
+            if j == i or j in self.pending:
+                break
+            self._prefetch(j)
+
+    def _after_block(self, i):
+        copies = self.active.pop(i, None)
+        released = None
+        for entry, copy in zip(self.host_tensors[i], copies or ()):
+            module, kind, name, t = entry
+            if self.codec is not None and self.codec.compresses(*entry):
+                # the dequantized weight's buffer goes back to the pool once this stream has finished the block
+                if released is None:
+                    released = torch.cuda.Event()
+                    released.record(torch.cuda.current_stream(self.device))
+                self.free_buffers.setdefault((t.shape, t.dtype), []).append((copy, released))
+        for module, kind, name, t in self.host_tensors[i]:
+            getattr(module, kind)[name] = t
+            # don't let the fp8 weight cache hold on to the device copy
+            module.__dict__.pop('fp8_weight_cache', None)
+
+    def get_stats(self):
+        """
+        Transfer statistics since the last call. overlap_efficiency is the share of the transfer time that
+        was hidden behind compute, 1.0 when the blocks never had to wait for their weights.
+        """
+        torch.cuda.synchronize(self.device)
+        transfer_ms = sum(start.elapsed_time(ready) for _, start, ready, _ in self.timings)
+        block_stalls = {}
+        for i, _, ready, needed in self.timings:
+            block_stalls.setdefault(self.names[i], []).append(max(needed.elapsed_time(ready), 0.0))
+        stall_ms = sum(sum(stalls) for stalls in block_stalls.values())
+        stats = {
+            'blocks': len(self.host_tensors),
+            'transfers': len(self.timings),
+            'transferred_gb': self.transferred_bytes / (1024 ** 3),
+            # transfer volume the compact weights of a TransferCodec saved
+            'compression_saved_gb': self.saved_bytes / (1024 ** 3),
+            'transfer_ms': transfer_ms,
+            'stall_ms': stall_ms,
+            'overlap_efficiency': 1.0 - stall_ms / transfer_ms if transfer_ms > 0 else 1.0,
+            # average wait per use of each block, what plan_residency weighs blocks by
+            'block_stall_ms': {name: sum(stalls) / len(stalls) for name, stalls in block_stalls.items()},
+        }
+        self.timings.clear()
+        self.transferred_bytes = 0
+        self.saved_bytes = 0
+        return stats
+
+
+def get_block_names(model):
+    """The transformer blocks in execution order."""
+    return [f'transformer_blocks.{i}' for i in range(len(model.transformer_blocks))] + \
+           [f'single_transformer_blocks.{i}' for i in range(len(model.single_transformer_blocks))]
+
+
+def get_tensor_bytes(module, device=None):
+    """Bytes of a module's parameters and buffers, only counting the ones on `device` if given."""
+    tensors = [t for m in module.modules() for t in list(m._parameters.values()) + list(m._buffers.values()) if t is not None]
+    return sum(t.nelement() * t.element_size() for t in tensors if device is None or t.device == device)
+
+
+class ResidencyPlan:
+    """Which transformer blocks stay on the device and which are streamed, see plan_residency."""
+    def __init__(self, resident, streamed, block_bytes, other_bytes, reserved_bytes, budget_bytes):
+        self.resident = resident
+        self.streamed = streamed
+        self.block_bytes = block_bytes
+        self.other_bytes = other_bytes
+        self.reserved_bytes = reserved_bytes
+        self.budget_bytes = budget_bytes
+
+    @property
+    def resident_bytes(self):
+        return self.other_bytes + sum(self.block_bytes[name] for name in self.resident)
+
+    @property
+    def streamed_bytes(self):
+        return sum(self.block_bytes[name] for name in self.streamed)
+
+    def summary(self):
+        gb = 1024 ** 3
+        return {
+            'budget_gb': self.budget_bytes / gb,
+            'resident_gb': self.resident_bytes / gb,
+            'streamed_gb': self.streamed_bytes / gb,
+            'reserved_gb': self.reserved_bytes / gb,
+            'resident_blocks': len(self.resident),
+            'streamed_blocks': len(self.streamed),
+        }
+
+    def __repr__(self):
+        summary = self.summary()
+        return (f'ResidencyPlan({summary["resident_blocks"]} blocks resident ({summary["resident_gb"]:.2f} GB), '
+                f'{summary["streamed_blocks"]} streamed ({summary["streamed_gb"]:.2f} GB), budget {summary["budget_gb"]:.2f} GB)')
+
+
+def plan_residency(model, budget_bytes, costs=None, stream_buffers=2):
+    """
+    Decides which whole blocks of the transformer stay on the device within budget_bytes.
+
+    The modules outside the blocks (embedders, norm_out, proj_out) are small and always resident. If the
+    whole model doesn't fit, room for stream_buffers of the largest blocks is kept for streaming and the
+    rest of the budget goes to the blocks with the highest cost per byte, e.g. the stall time measured by
+    BlockPrefetcher when they were streamed. Blocks without a cost are assumed to have the average cost per
+    byte, and ties keep execution order. Only sizes are looked at, so this works on a meta device model.
+    """
+    names = get_block_names(model)
+    block_bytes = {name: get_tensor_bytes(model.get_submodule(name)) for name in names}
+    other_bytes = get_tensor_bytes(model) - sum(block_bytes.values())
+
+    if other_bytes + sum(block_bytes.values()) <= budget_bytes:
+        return ResidencyPlan(names, [], block_bytes, other_bytes, 0, budget_bytes)
+
+    costs = costs or {}
+    measured = [costs[name] / block_bytes[name] for name in names if name in costs and block_bytes[name] > 0]
+    default_density = sum(measured) / len(measured) if measured else 1.0
+    density = {name: costs[name] / block_bytes[name] if name in costs and block_bytes[name] > 0 else default_density for name in names}
+
+    reserved_bytes = stream_buffers * max(block_bytes.values(), default=0)
+    available = budget_bytes - other_bytes - reserved_bytes
+    resident = set()
+    for name in sorted(names, key=lambda name: -density[name]):
+        if block_bytes[name] <= available:
+            resident.add(name)
+            available -= block_bytes[name]
+    return ResidencyPlan([name for name in names if name in resident], [name for name in names if name not in resident],
+                         block_bytes, other_bytes, reserved_bytes, budget_bytes)
+
+
+def get_residency_budget(model, device, preserved_memory_gb=0):
+    """Free device memory plus what the model already occupies on it, minus the memory to preserve."""
+    if device.type != 'cuda':
+        return get_tensor_bytes(model)
+    free_bytes = get_cuda_free_memory_gb(device) * (1024 ** 3) + get_tensor_bytes(model, device)
+    return max(int(free_bytes - preserved_memory_gb * (1024 ** 3)), 0)
+
+
+def apply_residency_plan(model, plan, target_device, offload_device=cpu):
+    """Moves the resident blocks and the modules outside the blocks to target_device and the streamed blocks to offload_device, in one pass."""
+    clear_weight_cache(model)
+    stores = get_host_stores(model)
+    streamed = set(plan.streamed)
+    for name, module in model.named_children():
+        if isinstance(module, torch.nn.ModuleList):
+            for i, block in enumerate(module):
+                if f'{name}.{i}' in streamed:
+                    for store in stores:
+                        store.offload(modules=set(block.modules()))
+                    # blocking: a non_blocking copy to the host may not have landed yet when the block is read
+                    block.to(device=offload_device)
+                else:
+                    block.to(device=target_device, non_blocking=True)
+        else:
+            module.to(device=target_device, non_blocking=True)
+    for name, t in list(model._parameters.items()) + list(model._buffers.items()):
+        if t is not None:
+            t.data = t.data.to(target_device, non_blocking=True)
+    torch.cuda.empty_cache()
+
+
+def load_model_with_residency_plan(model, target_device, offload_device=cpu, preserved_memory_gb=0, stream_buffers=2):
+    """
+    Replaces move_model_to_device_with_memory_preservation: plans which blocks fit next to preserved_memory_gb,
+    weighted by the stalls BlockPrefetcher measured in earlier runs (model.block_costs), and applies the plan.
+    """
+    plan = plan_residency(model, get_residency_budget(model, target_device, preserved_memory_gb),
+                          costs=model.__dict__.get('block_costs'), stream_buffers=stream_buffers)
+    apply_residency_plan(model, plan, target_device, offload_device)
+    print(plan)
+    return plan
+
+
 def fake_diffusers_current_device(model: torch.nn.Module, target_device: torch.device):
     if hasattr(model, 'scale_shift_table'):
         model.scale_shift_table.data = model.scale_shift_table.data.to(target_device)
@@ -90,9 +634,9 @@ def move_model_to_device_with_memory_preservation(model, target_device, preserve
             return
 
         if hasattr(m, 'weight'):
-            m.to(device=target_device)
+            m.to(device=target_device, non_blocking=True)
 
-    model.to(device=target_device)
+    model.to(device=target_device, non_blocking=True)
     torch.cuda.empty_cache()
     return
 
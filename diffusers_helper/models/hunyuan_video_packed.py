@@ -69,7 +69,7 @@ def get_cu_seqlens(text_mask, img_len):
     text_len = text_mask.sum(dim=1)
     max_len = text_mask.shape[1] + img_len
 
-    cu_seqlens = torch.zeros([2 * batch_size + 1], dtype=torch.int32, device="cuda")
+    cu_seqlens = torch.zeros([2 * batch_size + 1], dtype=torch.int32, device=text_mask.device)
 
     for i in range(batch_size):
         s = text_len[i] + img_len
@@ -100,18 +100,23 @@ def attn_varlen_func(q, k, v, cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seq
             x = torch.nn.functional.scaled_dot_product_attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)).transpose(1, 2)
         return x
 
-    # batch_size = q.shape[0]
-    # q = q.view(q.shape[0] * q.shape[1], *q.shape[2:])
-    # k = k.view(k.shape[0] * k.shape[1], *k.shape[2:])
-    # v = v.view(v.shape[0] * v.shape[1], *v.shape[2:])
-    # if sageattn_varlen is not None:
-    #     x = sageattn_varlen(q, k, v, cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv)
-    # elif flash_attn_varlen_func is not None:
-    #     x = flash_attn_varlen_func(q, k, v, cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv)
-    # else:
-    #     raise NotImplementedError('No Attn Installed!')
-    # x = x.view(batch_size, max_seqlen_q, *x.shape[2:])
-    # return x
+    # batches (e.g. positive and negative of batched CFG) whose samples have different text lengths
+    batch_size = q.shape[0]
+    if attention_mode == "sageattn" and sageattn_varlen is not None:
+        varlen_func = sageattn_varlen
+    elif attention_mode == "flash_attn" and flash_attn_varlen_func is not None:
+        varlen_func = flash_attn_varlen_func
+    else:
+        varlen_func = None
+    if varlen_func is not None:
+        x = varlen_func(q.flatten(0, 1), k.flatten(0, 1), v.flatten(0, 1), cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv)
+        return x.unflatten(0, (batch_size, -1))
+
+    # sdpa masks the padding keys instead, sample i attends to its first cu_seqlens[2i+1] - cu_seqlens[2i] tokens
+    valid_len = cu_seqlens_kv[1::2] - cu_seqlens_kv[0:-1:2]
+    key_mask = torch.arange(k.shape[1], device=k.device)[None, :] < valid_len.to(k.device)[:, None]
+    x = torch.nn.functional.scaled_dot_product_attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), attn_mask=key_mask[:, None, None, :]).transpose(1, 2)
+    return x
 
 
 class HunyuanAttnProcessorFlashAttnDouble:
@@ -704,6 +709,24 @@ class HunyuanVideoPatchEmbedForCleanLatents(nn.Module):
         return
 
 
+TEACACHE_RESCALE_FUNC = np.poly1d([7.33226126e+02, -4.01131952e+02, 6.75869174e+01, -3.14987800e+00, 9.61237896e-02])
+
+
+class TransformerRunContext:
+    """
+    Per-run state of a transformer forward (TeaCache), so that several samplers can run concurrently,
+    from threads or on separate CUDA streams, against the same weights. One context per sampling run.
+    """
+    def __init__(self, enable_teacache=False, num_steps=25, rel_l1_thresh=0.15):
+        self.enable_teacache = enable_teacache
+        self.num_steps = num_steps
+        self.rel_l1_thresh = rel_l1_thresh  # 0.1 for 1.6x speedup, 0.15 for 2.1x speedup
+        self.cnt = 0
+        self.accumulated_rel_l1_distance = 0
+        self.previous_modulated_input = None
+        self.previous_residual = None
+
+
 class HunyuanVideoTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin, FromOriginalModelMixin):
     @register_to_config
     def __init__(
@@ -773,7 +796,8 @@ class HunyuanVideoTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin,
 
         self.inner_dim = inner_dim
         self.use_gradient_checkpointing = False
-        self.enable_teacache = False
+        # used by forwards that aren't given a run_context
+        self.default_run_context = TransformerRunContext()
 
         if has_image_proj:
             self.install_image_projection(image_proj_dim)
@@ -801,14 +825,8 @@ class HunyuanVideoTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin,
         print('self.use_gradient_checkpointing = False')
 
     def initialize_teacache(self, enable_teacache=True, num_steps=25, rel_l1_thresh=0.15):
-        self.enable_teacache = enable_teacache
-        self.cnt = 0
-        self.num_steps = num_steps
-        self.rel_l1_thresh = rel_l1_thresh  # 0.1 for 1.6x speedup, 0.15 for 2.1x speedup
-        self.accumulated_rel_l1_distance = 0
-        self.previous_modulated_input = None
-        self.previous_residual = None
-        self.teacache_rescale_func = np.poly1d([7.33226126e+02, -4.01131952e+02, 6.75869174e+01, -3.14987800e+00, 9.61237896e-02])
+        """Resets the state of the forwards without a run_context, concurrent runs each pass their own TransformerRunContext instead."""
+        self.default_run_context = TransformerRunContext(enable_teacache, num_steps, rel_l1_thresh)
 
     def gradient_checkpointing_method(self, block, *args):
         if self.use_gradient_checkpointing:
@@ -884,11 +902,13 @@ class HunyuanVideoTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin,
             clean_latents_2x=None, clean_latent_2x_indices=None,
             clean_latents_4x=None, clean_latent_4x_indices=None,
             image_embeddings=None,
-            attention_kwargs=None, return_dict=True
+            attention_kwargs=None, return_dict=True,
+            run_context=None
     ):
 
         if attention_kwargs is None:
             attention_kwargs = {}
+        ctx = run_context if run_context is not None else self.default_run_context
 
         batch_size, num_channels, num_frames, height, width = hidden_states.shape
         p, p_t = self.config['patch_size'], self.config['patch_size_t']
@@ -918,6 +938,11 @@ class HunyuanVideoTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin,
                 encoder_hidden_states = encoder_hidden_states[:, :text_len]
                 attention_mask = None, None, None, None
             else:
+                # the padding every sample has is cropped, the rest is masked
+                text_len = encoder_attention_mask.sum(dim=1).max().item()
+                encoder_hidden_states = encoder_hidden_states[:, :text_len]
+                encoder_attention_mask = encoder_attention_mask[:, :text_len]
+
                 img_seq_len = hidden_states.shape[1]
                 txt_seq_len = encoder_hidden_states.shape[1]
 
@@ -928,28 +953,29 @@ class HunyuanVideoTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin,
 
                 attention_mask = cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv
 
-        if self.enable_teacache:
+        if ctx.enable_teacache:
             modulated_inp = self.transformer_blocks[0].norm1(hidden_states, emb=temb)[0]
 
-            if self.cnt == 0 or self.cnt == self.num_steps-1:
+            # the batch changes when batched CFG falls back to separate forwards
+            if ctx.cnt == 0 or ctx.cnt == ctx.num_steps-1 or ctx.previous_modulated_input.shape != modulated_inp.shape:
                 should_calc = True
-                self.accumulated_rel_l1_distance = 0
+                ctx.accumulated_rel_l1_distance = 0
             else:
-                curr_rel_l1 = ((modulated_inp - self.previous_modulated_input).abs().mean() / self.previous_modulated_input.abs().mean()).cpu().item()
-                self.accumulated_rel_l1_distance += self.teacache_rescale_func(curr_rel_l1)
-                should_calc = self.accumulated_rel_l1_distance >= self.rel_l1_thresh
+                curr_rel_l1 = ((modulated_inp - ctx.previous_modulated_input).abs().mean() / ctx.previous_modulated_input.abs().mean()).cpu().item()
+                ctx.accumulated_rel_l1_distance += TEACACHE_RESCALE_FUNC(curr_rel_l1)
+                should_calc = ctx.accumulated_rel_l1_distance >= ctx.rel_l1_thresh
 
                 if should_calc:
-                    self.accumulated_rel_l1_distance = 0
+                    ctx.accumulated_rel_l1_distance = 0
 
-            self.previous_modulated_input = modulated_inp
-            self.cnt += 1
+            ctx.previous_modulated_input = modulated_inp
+            ctx.cnt += 1
 
-            if self.cnt == self.num_steps:
-                self.cnt = 0
+            if ctx.cnt == ctx.num_steps:
+                ctx.cnt = 0
 
             if not should_calc:
-                hidden_states = hidden_states + self.previous_residual
+                hidden_states = hidden_states + ctx.previous_residual
             else:
                 ori_hidden_states = hidden_states.clone()
 
@@ -973,7 +999,7 @@ class HunyuanVideoTransformer3DModel(ModelMixin, ConfigMixin, PeftAdapterMixin,
                         rope_freqs
                     )
 
-                self.previous_residual = hidden_states - ori_hidden_states
+                ctx.previous_residual = hidden_states - ori_hidden_states
         else:
             for block_id, block in enumerate(self.transformer_blocks):
                 hidden_states, encoder_hidden_states = self.gradient_checkpointing_method(
@@ -51,6 +51,8 @@ def sample_hunyuan(
         device=None,
         negative_kwargs=None,
         callback=None,
+        run_context=None,
+        batched_cfg=False,
         **kwargs,
 ):
     device = device or transformer.device
@@ -70,7 +72,7 @@ def sample_hunyuan(
 
     sigmas = get_flux_sigmas_from_mu(num_inference_steps, mu).to(device)
 
-    k_model = fm_wrapper(transformer)
+    k_model = fm_wrapper(transformer, run_context=run_context, batched_cfg=batched_cfg)
 
     if initial_latent is not None:
         sigmas = sigmas * strength
@@ -0,0 +1,311 @@
+import os
+import time
+import atexit
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from .utils import log
+
+GB = 1024 ** 3
+_spill_counter = itertools.count()
+
+
+def _mapped_ranges(source):
+    """(start, end) addresses of the memory-mapped files behind a SafetensorsFile or ShardedSafetensors."""
+    ranges = []
+    for f in getattr(source, "files", [source]):
+        buffer = getattr(f, "buffer", None)
+        if buffer is not None:
+            ranges.append((buffer.data_ptr(), buffer.data_ptr() + buffer.numel()))
+    return ranges
+
+
+def get_spill_path(owner):
+    from .model_cache import get_cache_dir
+    spill_dir = os.path.join(get_cache_dir(), "offload")
+    os.makedirs(spill_dir, exist_ok=True)
+    return os.path.join(spill_dir, f"{os.getpid()}_{id(owner):x}_{next(_spill_counter)}.safetensors")
+
+
+def _remove_later(path):
+    try:
+        # the mapping stays valid after the file is unlinked (not on Windows, there it goes at exit)
+        os.remove(path)
+    except OSError:
+        atexit.register(lambda: os.path.exists(path) and os.remove(path))
+
+
+class DiskOffloadTier:
+    """
+    A third offload tier below the CPU: the streamed blocks' weights stay in memory-mapped safetensors on disk
+    and are paged in per forward through an LRU cache of at most max_bytes of (pinned) host memory.
+
+    Every tensor of a block keeps a view into the mapping of the checkpoint it was loaded from. Tensors that
+    aren't such a view (quantized or cast on load, fused LoRAs, loaded to the GPU) are written once to a spill
+    file and mapped from there. When a block is about to run its tensors are copied from the mapping into
+    the cache and the parameters point at the copies, evicting the least recently used blocks first; once
+    evicted they point at the mapping again, whose clean pages the OS reclaims when it runs low on memory.
+    A reader thread pages in the next read_ahead blocks in execution order (wrapping around to the first
+    ones for the next step) while the current one runs. Blocks on the GPU are skipped, and tensors are only
+    swapped on the main thread so that a copy in flight never sees its source replaced.
+    """
+    def __init__(self, model, source, max_bytes, read_ahead=2, spill_path=None, pin_memory=True):
+        from .diffusers_helper.memory import get_block_names
+        from .model_loading import SafetensorsFile, save_safetensors_streaming
+
+        self.max_bytes = max_bytes
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.names = get_block_names(model)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk_offload")
+        self.cache = OrderedDict()
+        self.loading = {}
+        self.fresh = set()
+        self.bytes = 0
+        self.hooks = []
+        self._reset_stats()
+
+        ranges = _mapped_ranges(source) if source is not None else []
+        entries = {}
+        spill = {}
+        for name in self.names:
+            block = model.get_submodule(name)
+            entries[name] = []
+            for module_name, module in block.named_modules():
+                for kind in ("_parameters", "_buffers"):
+                    for tensor_name, t in getattr(module, kind).items():
+                        if t is None:
+                            continue
+                        full_name = ".".join(n for n in (name, module_name, tensor_name) if n)
+                        entries[name].append([module, kind, tensor_name, t, full_name])
+                        if t.device.type != "cpu" or not any(start <= t.data_ptr() < end for start, end in ranges):
+                            spill[full_name] = t.data
+
+        self.spilled_bytes = sum(t.nelement() * t.element_size() for t in spill.values())
+        if spill:
+            spill_path = spill_path or get_spill_path(model)
+            log.info(f"Writing {len(spill)} tensors ({self.spilled_bytes / GB:.2f} GB) that aren't stored as-is in the checkpoint to {spill_path}")
+            # larger elements first keeps every tensor aligned, so they map without a copy
+            order = sorted(spill, key=lambda k: -spill[k].element_size())
+            save_safetensors_streaming({k: spill[k] for k in order}, spill_path)
+            self.spill_file = SafetensorsFile(spill_path)
+            _remove_later(spill_path)
+
+        self.entries = {}
+        for name, block_entries in entries.items():
+            for entry in block_entries:
+                t, full_name = entry[3], entry[4]
+                entry[4] = self.spill_file.get_tensor(full_name) if full_name in spill else t.data
+                t.data = entry[4]
+            self.entries[name] = [tuple(entry) for entry in block_entries]
+        self.block_bytes = {name: sum(view.nelement() * view.element_size() for *_, view in block_entries)
+                            for name, block_entries in self.entries.items()}
+        largest = max(self.block_bytes.values(), default=0)
+        self.read_ahead = max(min(read_ahead, max_bytes // largest - 1 if largest else 0), 0)
+        if max_bytes < largest:
+            log.warning(f"The disk offload cache ({max_bytes / GB:.2f} GB) is smaller than a block ({largest / GB:.2f} GB), blocks are paged in one at a time")
+
+        for name in self.names:
+            self.hooks.append(model.get_submodule(name).register_forward_pre_hook(lambda module, args, name=name: self.ensure(name)))
+
+    @staticmethod
+    def install(model, source, max_bytes, read_ahead=2, spill_path=None):
+        """Moves the blocks' weights of a model loaded from `source` to the disk tier, with a host cache of max_bytes."""
+        if "disk_tier" in model.__dict__:
+            return model.__dict__["disk_tier"]
+        tier = DiskOffloadTier(model, source, max_bytes, read_ahead=read_ahead, spill_path=spill_path)
+        model.__dict__["disk_tier"] = tier
+        log.info(f"Disk offload: {len(tier.names)} blocks ({sum(tier.block_bytes.values()) / GB:.2f} GB) paged in through a "
+                 f"{max_bytes / GB:.2f} GB host cache with {tier.read_ahead} blocks of read-ahead")
+        return tier
+
+    def _reset_stats(self):
+        self.hits = 0
+        self.late = 0
+        self.misses = 0
+        self.evictions = 0
+        self.paged_in_bytes = 0
+        self.page_in_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def _on_host(self, name):
+        return all(t.device.type == "cpu" for _, _, _, t, _ in self.entries[name])
+
+    def _read(self, name):
+        """Copies a block from the mapping into host memory, runs on the reader thread or the main thread on a miss."""
+        start = time.perf_counter()
+        copies = []
+        for *_, view in self.entries[name]:
+            copy = torch.empty(view.shape, dtype=view.dtype, pin_memory=self.pin_memory)
+            copy.copy_(view)
+            copies.append(copy)
+        return copies, time.perf_counter() - start
+
+    def _evict(self, name):
+        copies = self.cache.pop(name)
+        self.fresh.discard(name)
+        for (_, _, _, t, view), copy in zip(self.entries[name], copies):
+            if t.data_ptr() == copy.data_ptr():
+                t.data = view
+        self.bytes -= self.block_bytes[name]
+        self.evictions += 1
+
+    def _make_room(self, nbytes, protected):
+        """Evicts least recently used blocks outside `protected` until nbytes more fit, returns whether they do."""
+        loading_bytes = sum(self.block_bytes[name] for name in self.loading)
+        for name in list(self.cache):
+            if self.bytes + loading_bytes + nbytes <= self.max_bytes:
+                break
+            if name not in protected:
+                self._evict(name)
+        return self.bytes + loading_bytes + nbytes <= self.max_bytes
+
+    def _upcoming(self, name):
+        i = self.names.index(name)
+        return [self.names[(i + k) % len(self.names)] for k in range(1, self.read_ahead + 1)]
+
+    def ensure(self, name, count=True):
+        """
+        Makes sure a block's weights are in the host cache before it runs, and reads ahead the next ones.
+        BlockPrefetcher calls this with count=False before it uploads a block, the block's own forward
+        pre-hook counts the use.
+        """
+        if name not in self.entries or not self._on_host(name):
+            return
+        with self.lock:
+            cached = name in self.cache
+            if cached:
+                self.cache.move_to_end(name)
+                if count and name in self.fresh:
+                    # paged in ahead of this use by BlockPrefetcher, counted then
+                    self.fresh.discard(name)
+                elif count:
+                    self.hits += 1
+            future = None if cached else self.loading.pop(name, None)
+        if not cached:
+            if future is None:
+                self.misses += 1
+                copies, seconds = self._read(name)
+                self.wait_seconds += seconds
+            else:
+                if future.done():
+                    self.hits += 1
+                else:
+                    self.late += 1
+                wait_start = time.perf_counter()
+                copies, seconds = future.result()
+                self.wait_seconds += time.perf_counter() - wait_start
+            self.paged_in_bytes += self.block_bytes[name]
+            self.page_in_seconds += seconds
+            with self.lock:
+                # the running block has to be paged in even if the cache is too small for it
+                self._make_room(self.block_bytes[name], protected={name, *self._upcoming(name)})
+                for (_, _, _, t, view), copy in zip(self.entries[name], copies):
+                    if t.data_ptr() == view.data_ptr():
+                        t.data = copy
+                self.cache[name] = copies
+                self.bytes += self.block_bytes[name]
+                if not count:
+                    self.fresh.add(name)
+        self._schedule_read_ahead(name)
+
+    def _schedule_read_ahead(self, name):
+        upcoming = self._upcoming(name)
+        with self.lock:
+            for next_name in upcoming:
+                if next_name == name or next_name in self.cache or next_name in self.loading or not self._on_host(next_name):
+                    continue
+                if not self._make_room(self.block_bytes[next_name], protected={name, *upcoming}):
+                    break
+                self.loading[next_name] = self.executor.submit(self._read, next_name)
+
+    def offload(self, host_only=False, modules=None):
+        """Points the tensors of `modules` (default all) that were moved to the GPU back at their mapping, nothing is copied."""
+        for name, block_entries in self.entries.items():
+            for module, kind, tensor_name, t, view in block_entries:
+                if (modules is not None and module not in modules) or t.device.type == "cpu" or host_only:
+                    continue
+                if t.shape == view.shape and t.dtype == view.dtype:
+                    t.data = view
+
+    def write_back(self, modules):
+        """
+        Called after the weights of `modules` were patched in place (e.g. a fused LoRA changed). The new values
+        are written to a spill file of their own and mapped from there, never into the checkpoint's mapping,
+        which other readers (LoraManager's clean base weights) may share. Buffers that were replaced instead
+        are no longer tiered.
+        """
+        from .model_loading import SafetensorsFile, save_safetensors_streaming
+
+        modules = set(modules)
+        affected = [name for name, block_entries in self.entries.items() if any(m in modules for m, *_ in block_entries)]
+        if not affected:
+            return
+        for name in affected:
+            with self.lock:
+                future = self.loading.pop(name, None)
+            if future is not None:
+                future.result()
+
+        spill = {}
+        for name in affected:
+            for i, (m, kind, tensor_name, t, view) in enumerate(self.entries[name]):
+                if m in modules and getattr(m, kind).get(tensor_name) is t:
+                    # wherever the tensor is now (cache copy, the device or the mapping), it has the patched values
+                    spill[f"{name}.{i}"] = t.data
+        spill_file = None
+        if spill:
+            spill_path = get_spill_path(self)
+            # larger elements first keeps every tensor aligned, so they map without a copy
+            order = sorted(spill, key=lambda k: -spill[k].element_size())
+            save_safetensors_streaming({k: spill[k] for k in order}, spill_path)
+            # the views keep the mapping alive, it goes once no tensor points into it anymore
+            spill_file = SafetensorsFile(spill_path)
+            _remove_later(spill_path)
+            self.spilled_bytes += sum(t.nelement() * t.element_size() for t in spill.values())
+
+        with self.lock:
+            for name in affected:
+                if name in self.cache:
+                    self._evict(name)
+                kept = []
+                for i, entry in enumerate(self.entries[name]):
+                    m, kind, tensor_name, t, view = entry
+                    if m not in modules:
+                        kept.append(entry)
+                    elif f"{name}.{i}" in spill:
+                        new_view = spill_file.get_tensor(f"{name}.{i}")
+                        if t.device.type == "cpu":
+                            t.data = new_view
+                        kept.append((m, kind, tensor_name, t, new_view))
+                self.entries[name] = kept
+                self.block_bytes[name] = sum(view.nelement() * view.element_size() for *_, view in kept)
+
+    def remove(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks.clear()
+        self.executor.shutdown(wait=True)
+        self.loading.clear()
+
+    def get_stats(self):
+        """Page-in statistics since the last call, hit_rate counts blocks that were in the cache (or read ahead in time) when they ran."""
+        uses = self.hits + self.late + self.misses
+        stats = {
+            "hits": self.hits,
+            "late": self.late,
+            "misses": self.misses,
+            "hit_rate": self.hits / uses if uses else 1.0,
+            "evictions": self.evictions,
+            "paged_in_gb": self.paged_in_bytes / GB,
+            "page_in_gb_per_s": self.paged_in_bytes / GB / self.page_in_seconds if self.page_in_seconds > 0 else 0.0,
+            "wait_ms": self.wait_seconds * 1000,
+            "cached_gb": self.bytes / GB,
+            "spilled_gb": self.spilled_bytes / GB,
+        }
+        self._reset_stats()
+        return stats
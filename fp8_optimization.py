@@ -2,35 +2,201 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+from .utils import log
+
+FP8_DTYPES = (torch.float8_e4m3fn, torch.float8_e5m2)
+
+_fp8_matmul_devices = {}
+_ones = {}
+_rowwise_scaling = True
+# what torch._scaled_mm says (depending on the version) when the GPU or build has no row-wise scaled kernel
+_ROWWISE_UNSUPPORTED = ("rowwise", "row-wise", "scaling configuration", "compute capability")
+
+def quantize_fp8(weight, dtype, per_channel=False):
+    """Quantizes a weight to fp8 with an absmax scale, per tensor or per output channel. Returns (weight, scale)."""
+    weight = weight.to(torch.float32)
+    if per_channel:
+        amax = weight.abs().amax(dim=1, keepdim=True)
+    else:
+        amax = weight.abs().amax().reshape(1)
+    fp8_max = torch.finfo(dtype).max
+    scale = (amax / fp8_max).clamp(min=1e-12)
+    return (weight / scale).clamp(-fp8_max, fp8_max).to(dtype), scale
+
+def quantize_fp8_activation(input, dtype=torch.float8_e4m3fn, per_token=True):
+    """Dynamic activation quantization of a 2-D input, scale is (tokens, 1) per token or (1, 1) per tensor."""
+    input = input.to(torch.float32)
+    if per_token:
+        amax = input.abs().amax(dim=1, keepdim=True)
+    else:
+        amax = input.abs().amax().reshape(1, 1)
+    fp8_max = torch.finfo(dtype).max
+    scale = (amax / fp8_max).clamp(min=1e-12)
+    return (input / scale).clamp(-fp8_max, fp8_max).to(dtype), scale
+
+def dequantize_fp8(weight, scale, dtype):
+    weight = weight.to(dtype)
+    return weight if scale is None else weight * scale.to(dtype)
+
+def has_fp8_matmul(device):
+    if device.type != "cuda":
+        return False
+    index = device.index if device.index is not None else torch.cuda.current_device()
+    if index not in _fp8_matmul_devices:
+        _fp8_matmul_devices[index] = torch.cuda.get_device_capability(index) >= (8, 9)
+    return _fp8_matmul_devices[index]
+
+def _get_one(device):
+    if device not in _ones:
+        _ones[device] = torch.ones((1), device=device, dtype=torch.float32)
+    return _ones[device]
+
+def _prepare_fp8_weight(weight, scale_weight, device):
+    scale_row = None
+    if scale_weight is not None:
+        scale_row = scale_weight.to(device, torch.float32).reshape(1, -1).expand(1, weight.shape[0]).contiguous()
+    return weight.t(), scale_row
+
+def get_fp8_weight(cls, device):
+    """
+    Returns the transposed weight and the weight scale as a (1, out_features) float32 row.
+
+    For weights that stay on the compute device these are cached on the module and only rebuilt when the
+    weight or its scale is replaced, weights patched in place (a LoRA fused in) have to drop fp8_weight_cache.
+    Weights streamed in by DynamicSwapInstaller are a new copy on every call and are not cached, holding on to
+    them would keep the whole model on the GPU.
+    """
+    param = cls._parameters["weight"]
+    scale_weight = cls._buffers.get("scale_weight")
+    if param.device != device:
+        return _prepare_fp8_weight(cls.weight, scale_weight, device)
+    key = (param.data_ptr(), param._version, id(scale_weight))
+    cache = cls.__dict__.get("fp8_weight_cache")
+    if cache is None or cache[0] != key:
+        cache = (key, ) + _prepare_fp8_weight(param, scale_weight, device)
+        cls.__dict__["fp8_weight_cache"] = cache
+    return cache[1], cache[2]
+
+def fp8_scaled_mm(input, w_t, scale_row, out_dtype, per_channel):
+    """fp8 GEMM of a 2-D input with an fp8 weight (given transposed) and its scale, activations are quantized on the fly."""
+    global _rowwise_scaling
+    if _rowwise_scaling and w_t.dtype == torch.float8_e4m3fn:
+        inn, scale_a = quantize_fp8_activation(input, per_token=True)
+        try:
+            return torch._scaled_mm(inn, w_t, out_dtype=out_dtype, scale_a=scale_a, scale_b=scale_row)
+        except RuntimeError as e:
+            if not any(keyword in str(e).lower() for keyword in _ROWWISE_UNSUPPORTED):
+                raise
+            _rowwise_scaling = False
+            log.warning(f"Row-wise scaled fp8 matmul not supported, falling back to per-tensor activation scales: {e}")
+
+    inn, scale_a = quantize_fp8_activation(input, per_token=False)
+    if per_channel:
+        o = torch._scaled_mm(inn, w_t, out_dtype=out_dtype, scale_a=scale_a.reshape(1), scale_b=_get_one(input.device))
+        if isinstance(o, tuple):
+            o = o[0]
+        return o * scale_row.to(out_dtype)
+    return torch._scaled_mm(inn, w_t, out_dtype=out_dtype, scale_a=scale_a.reshape(1), scale_b=scale_row[:, :1].reshape(1))
+
+def fp8_linear_emulated(input, weight, scale_weight, bias, out_dtype):
+    """
+    float32 reference of fp8_linear_forward's matmul, used on the CPU.
+
+    Quantizes the activations exactly like the GPU path does, so the numerics of the fp8 path can be
+    checked without a GPU.
+    """
+    inn = input.reshape(-1, input.shape[-1])
+    if scale_weight is None:
+        target_dtype = torch.float8_e5m2 if weight.dtype == torch.float8_e4m3fn else torch.float8_e4m3fn
+        inn = inn.to(target_dtype).to(torch.float32)
+    else:
+        inn, scale_a = quantize_fp8_activation(inn, per_token=weight.dtype == torch.float8_e4m3fn)
+        inn = inn.to(torch.float32) * scale_a
+    o = inn @ dequantize_fp8(weight, scale_weight, torch.float32).t()
+    if bias is not None:
+        o = o + bias.to(torch.float32)
+    return o.to(out_dtype).reshape(*input.shape[:-1], weight.shape[0])
+
+def fp8_scaled_linear_forward(cls, original_dtype, input):
+    # fp8 weight with a scale, but no fp8 matmul: dequantize and run a regular linear
+    weight = dequantize_fp8(cls.weight, getattr(cls, "scale_weight", None), original_dtype)
+    bias = cls.bias.to(original_dtype) if cls.bias is not None else None
+    return F.linear(input.to(original_dtype), weight, bias)
 
 def fp8_linear_forward(cls, original_dtype, input):
-    weight_dtype = cls.weight.dtype
-    if weight_dtype in [torch.float8_e4m3fn, torch.float8_e5m2]:
-        if len(input.shape) == 3:
-            target_dtype = torch.float8_e5m2 if weight_dtype == torch.float8_e4m3fn else torch.float8_e4m3fn
-            inn = input.reshape(-1, input.shape[2]).to(target_dtype)
-            w = cls.weight.t()
+    weight_dtype = cls._parameters["weight"].dtype
+    if weight_dtype in FP8_DTYPES:
+        scale_weight = getattr(cls, "scale_weight", None)
+        if input.device.type == "cpu":
+            return fp8_linear_emulated(input, cls.weight, scale_weight, cls.bias, original_dtype)
+        if not has_fp8_matmul(input.device):
+            if scale_weight is not None:
+                return fp8_scaled_linear_forward(cls, original_dtype, input)
+            return cls.original_forward(input.to(original_dtype))
 
-            scale = torch.ones((1), device=input.device, dtype=torch.float32)
-            bias = cls.bias.to(original_dtype) if cls.bias is not None else None
+        inn = input.reshape(-1, input.shape[-1])
+        w_t, scale_row = get_fp8_weight(cls, input.device)
+        bias = cls.bias.to(original_dtype) if cls.bias is not None else None
 
+        if scale_weight is None:
+            # unscaled weights, the activations are cast without a scale
+            target_dtype = torch.float8_e5m2 if weight_dtype == torch.float8_e4m3fn else torch.float8_e4m3fn
+            scale = _get_one(input.device)
             if bias is not None:
-                o = torch._scaled_mm(inn, w, out_dtype=original_dtype, bias=bias, scale_a=scale, scale_b=scale)
+                o = torch._scaled_mm(inn.to(target_dtype), w_t, out_dtype=original_dtype, bias=bias, scale_a=scale, scale_b=scale)
             else:
-                o = torch._scaled_mm(inn, w, out_dtype=original_dtype, scale_a=scale, scale_b=scale)
-
+                o = torch._scaled_mm(inn.to(target_dtype), w_t, out_dtype=original_dtype, scale_a=scale, scale_b=scale)
+        else:
+            o = fp8_scaled_mm(inn, w_t, scale_row, original_dtype, per_channel=scale_weight.numel() > 1)
             if isinstance(o, tuple):
                 o = o[0]
+            if bias is not None:
+                o = o + bias
 
-            return o.reshape((-1, input.shape[1], cls.weight.shape[0]))
-        else:
-            return cls.original_forward(input.to(original_dtype))
+        if isinstance(o, tuple):
+            o = o[0]
+
+        return o.reshape(*input.shape[:-1], w_t.shape[1])
     else:
         return cls.original_forward(input)
 
+def fp8_scaled_quantize_fn(model, dtype=torch.float8_e4m3fn, per_channel=False, params_to_keep={}):
+    """
+    Returns a quantize_fn for load_state_dict_streaming that quantizes the Linear weights to fp8 with
+    a scale_weight buffer (fp8_scaled). Weights that are already fp8 are loaded as they are.
+    """
+    names = {f"{name}.weight" for name, module in model.named_modules()
+             if isinstance(module, nn.Linear) and not any(keyword in name for keyword in params_to_keep)}
+
+    def quantize_fn(name, tensor):
+        if name not in names or tensor.dtype in FP8_DTYPES:
+            return None
+        weight, scale = quantize_fp8(tensor, dtype, per_channel=per_channel)
+        return weight, {"scale_weight": scale}
+    return quantize_fn
+
+def install_fp8_scaled_forward(module, compute_dtype):
+    """Makes a Linear with an fp8 weight honour its scale_weight, unless the fp8 matmul forward (which does) is already in use."""
+    if "original_forward" in module.__dict__:
+        return
+    # below the runtime LoRA wrapper if there is one
+    forward_attr = "lora_base_forward" if "lora_base_forward" in module.__dict__ else "forward"
+    module.original_forward = getattr(module, forward_attr)
+    setattr(module, forward_attr, lambda input, m=module: fp8_scaled_linear_forward(m, compute_dtype, input))
+
+def load_fp8_scales(model, source, compute_dtype):
+    """Restores the scale_weight buffers of scaled fp8 (and int8) weights, e.g. the ones saved by the model cache."""
+    modules = dict(model.named_modules())
+    for name in source.keys():
+        if name.endswith(".scale_weight") and name[:-len(".scale_weight")] in modules:
+            module = modules[name[:-len(".scale_weight")]]
+            module.register_buffer("scale_weight", source.get_tensor(name).to(module._parameters["weight"].device), persistent=False)
+            if module._parameters["weight"].dtype in FP8_DTYPES:
+                install_fp8_scaled_forward(module, compute_dtype)
+
 def convert_fp8_linear(module, original_dtype, params_to_keep={}):
-    setattr(module, "fp8_matmul_enabled", True)
-   
     for name, module in module.named_modules():
         if not any(keyword in name for keyword in params_to_keep):
             if isinstance(module, nn.Linear):
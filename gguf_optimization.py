@@ -0,0 +1,251 @@
+import os
+import struct
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+GGUF_MAGIC = b"GGUF"
+GGUF_DEFAULT_ALIGNMENT = 32
+QK_K = 256
+
+GGML_TYPES = {0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 6: "Q5_0", 7: "Q5_1", 8: "Q8_0", 12: "Q4_K", 13: "Q5_K", 14: "Q6_K", 30: "BF16"}
+# (elements per block, bytes per block)
+GGML_BLOCK_SIZES = {
+    "F32": (1, 4),
+    "F16": (1, 2),
+    "BF16": (1, 2),
+    "Q4_0": (32, 18),
+    "Q4_1": (32, 20),
+    "Q5_0": (32, 22),
+    "Q5_1": (32, 24),
+    "Q8_0": (32, 34),
+    "Q4_K": (QK_K, 144),
+    "Q5_K": (QK_K, 176),
+    "Q6_K": (QK_K, 210),
+}
+UNQUANTIZED_TYPES = {"F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16}
+
+# gguf metadata value types: struct format, or None for the variable sized ones
+_VALUE_FORMATS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 8: None, 9: None, 10: "<Q", 11: "<q", 12: "<d"}
+
+
+def _read(f, fmt):
+    return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+
+def _read_string(f):
+    return f.read(_read(f, "<Q")).decode("utf-8", errors="replace")
+
+def _read_value(f, value_type):
+    if value_type == 8:
+        return _read_string(f)
+    if value_type == 9:
+        item_type = _read(f, "<I")
+        return [_read_value(f, item_type) for _ in range(_read(f, "<Q"))]
+    return _read(f, _VALUE_FORMATS[value_type])
+
+
+class GGUFFile:
+    """
+    Memory-mapped .gguf file behind the SafetensorsFile interface.
+
+    Unquantized tensors are returned as regular tensors, quantized ones as their raw blocks:
+    a uint8 tensor of shape (rows, bytes per row), see qtype_of() and shape_of().
+    """
+    def __init__(self, path):
+        self.path = path
+        self.metadata = {}
+        self.header = {}
+        with open(path, "rb") as f:
+            if f.read(4) != GGUF_MAGIC:
+                raise ValueError(f"{path} is not a GGUF file")
+            version = _read(f, "<I")
+            if version < 2:
+                raise ValueError(f"GGUF version {version} of {path} is not supported")
+            tensor_count = _read(f, "<Q")
+            kv_count = _read(f, "<Q")
+            for _ in range(kv_count):
+                key = _read_string(f)
+                self.metadata[key] = _read_value(f, _read(f, "<I"))
+            for _ in range(tensor_count):
+                name = _read_string(f)
+                n_dims = _read(f, "<I")
+                dims = [_read(f, "<Q") for _ in range(n_dims)]
+                qtype = _read(f, "<I")
+                offset = _read(f, "<Q")
+                if qtype not in GGML_TYPES:
+                    raise ValueError(f"Unsupported GGML type {qtype} for tensor {name} in {path}")
+                # ggml lists the dimensions innermost first
+                self.header[name] = {"qtype": GGML_TYPES[qtype], "shape": list(reversed(dims)), "offset": offset}
+            alignment = self.metadata.get("general.alignment", GGUF_DEFAULT_ALIGNMENT)
+            self.data_offset = (f.tell() + alignment - 1) // alignment * alignment
+
+        storage = torch.UntypedStorage.from_file(path, False, os.path.getsize(path))
+        self.buffer = torch.empty((0,), dtype=torch.uint8).set_(storage)
+
+    def keys(self):
+        return self.header.keys()
+
+    def __contains__(self, name):
+        return name in self.header
+
+    def qtype_of(self, name):
+        return self.header[name]["qtype"]
+
+    def shape_of(self, name):
+        return self.header[name]["shape"]
+
+    def is_quantized(self, name):
+        return self.qtype_of(name) not in UNQUANTIZED_TYPES
+
+    def dtype_of(self, name):
+        return UNQUANTIZED_TYPES.get(self.qtype_of(name), torch.uint8)
+
+    def nbytes_of(self, name):
+        block_size, type_size = GGML_BLOCK_SIZES[self.qtype_of(name)]
+        numel = 1
+        for d in self.shape_of(name):
+            numel *= d
+        return numel // block_size * type_size
+
+    def location_of(self, name):
+        return (0, self.header[name]["offset"])
+
+    def get_tensor(self, name):
+        info = self.header[name]
+        start = self.data_offset + info["offset"]
+        data = self.buffer[start:start + self.nbytes_of(name)]
+        if info["qtype"] in UNQUANTIZED_TYPES:
+            dtype = UNQUANTIZED_TYPES[info["qtype"]]
+            if start % torch.empty((), dtype=dtype).element_size() != 0:
+                data = data.clone()
+            return data.view(dtype).view(info["shape"])
+        return data.view(-1, self.nbytes_of(name) // info["shape"][0]) if len(info["shape"]) > 1 else data
+
+
+def _f16(x):
+    return x.view(torch.float16).to(torch.float32)
+
+def _get_scale_min(scales):
+    # 8 6-bit scales and mins packed into 12 bytes (K-quants)
+    n_blocks = scales.shape[0]
+    d, m, m_d = torch.split(scales.reshape(n_blocks, 3, 4), 1, dim=-2)
+    sc = torch.cat([d & 0x3F, (m_d & 0x0F) | ((d >> 2) & 0x30)], dim=-1)
+    mn = torch.cat([m & 0x3F, (m_d >> 4) | ((m >> 2) & 0x30)], dim=-1)
+    return sc.reshape(n_blocks, 8).to(torch.float32), mn.reshape(n_blocks, 8).to(torch.float32)
+
+def _nibbles(qs, groups):
+    # low nibbles of each group of bytes first, then the high ones
+    n_blocks = qs.shape[0]
+    shifts = torch.tensor([0, 4], dtype=torch.uint8, device=qs.device).reshape(1, 1, 2, 1)
+    return ((qs.reshape(n_blocks, groups, 1, -1) >> shifts) & 0x0F).reshape(n_blocks, -1)
+
+def _bits(qh, count):
+    n_blocks = qh.shape[0]
+    shifts = torch.arange(8, dtype=torch.uint8, device=qh.device).reshape(1, 1, 8)
+    return ((qh.reshape(n_blocks, -1, 1) >> shifts) & 1).reshape(n_blocks, -1)[:, :count]
+
+def _dequantize_q8_0(blocks):
+    d, qs = torch.split(blocks, [2, 32], dim=1)
+    return _f16(d) * qs.view(torch.int8).to(torch.float32)
+
+def _dequantize_q4_0(blocks):
+    d, qs = torch.split(blocks, [2, 16], dim=1)
+    return _f16(d) * (_nibbles(qs, 1).to(torch.float32) - 8)
+
+def _dequantize_q4_1(blocks):
+    d, m, qs = torch.split(blocks, [2, 2, 16], dim=1)
+    return _f16(d) * _nibbles(qs, 1).to(torch.float32) + _f16(m)
+
+def _dequantize_q5_0(blocks):
+    d, qh, qs = torch.split(blocks, [2, 4, 16], dim=1)
+    q = _nibbles(qs, 1) | (_bits(qh, 32) << 4)
+    return _f16(d) * (q.to(torch.float32) - 16)
+
+def _dequantize_q5_1(blocks):
+    d, m, qh, qs = torch.split(blocks, [2, 2, 4, 16], dim=1)
+    q = _nibbles(qs, 1) | (_bits(qh, 32) << 4)
+    return _f16(d) * q.to(torch.float32) + _f16(m)
+
+def _dequantize_q4_k(blocks):
+    n_blocks = blocks.shape[0]
+    d, dmin, scales, qs = torch.split(blocks, [2, 2, 12, QK_K // 2], dim=1)
+    sc, mn = _get_scale_min(scales)
+    d = (_f16(d) * sc).reshape(n_blocks, 8, 1)
+    dm = (_f16(dmin) * mn).reshape(n_blocks, 8, 1)
+    q = _nibbles(qs, 4).reshape(n_blocks, 8, 32).to(torch.float32)
+    return (d * q - dm).reshape(n_blocks, QK_K)
+
+def _dequantize_q5_k(blocks):
+    n_blocks = blocks.shape[0]
+    d, dmin, scales, qh, qs = torch.split(blocks, [2, 2, 12, QK_K // 8, QK_K // 2], dim=1)
+    sc, mn = _get_scale_min(scales)
+    d = (_f16(d) * sc).reshape(n_blocks, 8, 1)
+    dm = (_f16(dmin) * mn).reshape(n_blocks, 8, 1)
+    ql = _nibbles(qs, 4).reshape(n_blocks, 8, 32)
+    # bit i of qh[l] is the high bit of element l of sub-block i
+    shifts = torch.arange(8, dtype=torch.uint8, device=qh.device).reshape(1, 8, 1)
+    high = (qh.reshape(n_blocks, 1, 32) >> shifts) & 1
+    q = (ql | (high << 4)).to(torch.float32)
+    return (d * q - dm).reshape(n_blocks, QK_K)
+
+def _dequantize_q6_k(blocks):
+    n_blocks = blocks.shape[0]
+    ql, qh, scales, d = torch.split(blocks, [QK_K // 2, QK_K // 4, QK_K // 16, 2], dim=1)
+    d = (_f16(d) * scales.view(torch.int8).to(torch.float32)).reshape(n_blocks, QK_K // 16, 1)
+    ql = _nibbles(ql, 2).reshape(n_blocks, -1, 32)
+    shifts = torch.tensor([0, 2, 4, 6], dtype=torch.uint8, device=qh.device).reshape(1, 1, 4, 1)
+    qh = ((qh.reshape(n_blocks, -1, 1, 32) >> shifts) & 0x03).reshape(n_blocks, -1, 32)
+    q = ((ql | (qh << 4)).to(torch.float32) - 32).reshape(n_blocks, QK_K // 16, -1)
+    return (d * q).reshape(n_blocks, QK_K)
+
+DEQUANTIZE_FUNCTIONS = {
+    "Q4_0": _dequantize_q4_0,
+    "Q4_1": _dequantize_q4_1,
+    "Q5_0": _dequantize_q5_0,
+    "Q5_1": _dequantize_q5_1,
+    "Q8_0": _dequantize_q8_0,
+    "Q4_K": _dequantize_q4_k,
+    "Q5_K": _dequantize_q5_k,
+    "Q6_K": _dequantize_q6_k,
+}
+
+def dequantize_gguf(data, qtype, shape, dtype):
+    """Dequantizes the raw blocks of a GGUF tensor, block by block, on the device they are on."""
+    if qtype in UNQUANTIZED_TYPES:
+        return data.to(dtype)
+    blocks = data.reshape(-1, GGML_BLOCK_SIZES[qtype][1])
+    return DEQUANTIZE_FUNCTIONS[qtype](blocks).to(dtype).reshape(shape)
+
+def gguf_linear_forward(cls, original_dtype, input):
+    # cls.weight are the raw blocks, which is also what DynamicSwapInstaller moves to the GPU
+    weight = dequantize_gguf(cls.weight, cls.gguf_qtype, cls.gguf_shape, original_dtype)
+    bias = cls.bias.to(original_dtype) if cls.bias is not None else None
+    return F.linear(input.to(original_dtype), weight, bias)
+
+def gguf_quantize_fn(model, source, dtype, params_to_keep={}):
+    """
+    Returns a quantize_fn for load_state_dict_streaming that keeps the quantized Linear weights of a GGUF file
+    as raw blocks. Other quantized tensors are dequantized to `dtype` while loading.
+    """
+    names = {f"{name}.weight" for name, module in model.named_modules()
+             if isinstance(module, nn.Linear) and not any(keyword in name for keyword in params_to_keep)}
+
+    def quantize_fn(name, tensor):
+        if not source.is_quantized(name):
+            return None
+        if name in names:
+            return tensor, {}
+        return dequantize_gguf(tensor, source.qtype_of(name), source.shape_of(name), dtype), {}
+    return quantize_fn
+
+def convert_gguf_linear(module, source, original_dtype):
+    """Makes the Linears whose weights were kept quantized dequantize them at forward time."""
+    for name, module in module.named_modules():
+        if isinstance(module, nn.Linear) and module._parameters["weight"].dtype == torch.uint8:
+            weight_name = f"{name}.weight"
+            module.gguf_qtype = source.qtype_of(weight_name)
+            module.gguf_shape = tuple(source.shape_of(weight_name))
+            original_forward = module.forward
+            setattr(module, "original_forward", original_forward)
+            setattr(module, "forward", lambda input, m=module: gguf_linear_forward(m, original_dtype, input))
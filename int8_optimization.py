@@ -0,0 +1,74 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .utils import log
+
+_int_mm_supported = {}
+# what torch._int_mm says (depending on the version) on a device or build without the kernel, or for a shape it rejects
+_INT_MM_UNSUPPORTED = ("could not run", "not implemented", "not compiled", "not supported", "needs to be")
+
+def quantize_int8(weight):
+    """Symmetric per-output-channel int8 quantization of a weight. Returns (weight, scale), scale is (out_features, 1)."""
+    weight = weight.to(torch.float32)
+    scale = (weight.abs().amax(dim=1, keepdim=True) / 127).clamp(min=1e-12)
+    return torch.round(weight / scale).clamp(-127, 127).to(torch.int8), scale
+
+def quantize_int8_activation(input):
+    """Dynamic per-token int8 quantization of a 2-D input. Returns (input, scale), scale is (tokens, 1)."""
+    input = input.to(torch.float32)
+    scale = (input.abs().amax(dim=1, keepdim=True) / 127).clamp(min=1e-12)
+    return torch.round(input / scale).clamp(-127, 127).to(torch.int8), scale
+
+def int8_matmul(a, w):
+    """a @ w.t() for int8 a (M, K) and w (N, K), as float32."""
+    device_type = a.device.type
+    # _int_mm needs more than 16 rows and K, N divisible by 8
+    if _int_mm_supported.get(device_type, True) and a.shape[0] > 16 and a.shape[1] % 8 == 0 and w.shape[0] % 8 == 0:
+        try:
+            return torch._int_mm(a, w.t()).to(torch.float32)
+        except RuntimeError as e:
+            if not any(keyword in str(e).lower() for keyword in _INT_MM_UNSUPPORTED):
+                raise
+            _int_mm_supported[device_type] = False
+            log.warning(f"int8 GEMM not available on {device_type}, using a float32 matmul instead: {e}")
+    return a.to(torch.float32) @ w.to(torch.float32).t()
+
+def int8_linear_forward(cls, original_dtype, input, dynamic_activations=False):
+    weight = cls.weight
+    scale_weight = cls.scale_weight
+    bias = cls.bias.to(original_dtype) if cls.bias is not None else None
+    if not dynamic_activations:
+        # weight-only: dequantize and run the matmul in the compute dtype
+        return F.linear(input.to(original_dtype), weight.to(original_dtype) * scale_weight.to(original_dtype), bias)
+
+    inn, scale_a = quantize_int8_activation(input.reshape(-1, input.shape[-1]))
+    o = (int8_matmul(inn, weight) * scale_a * scale_weight.to(torch.float32).view(1, -1)).to(original_dtype)
+    if bias is not None:
+        o = o + bias
+    return o.reshape(*input.shape[:-1], weight.shape[0])
+
+def int8_quantize_fn(model, params_to_keep={}):
+    """
+    Returns a quantize_fn for load_state_dict_streaming that stores the Linear weights as int8 with a
+    per-channel scale_weight buffer. Weights that are already int8 (model cache) are loaded as they are.
+    """
+    names = {f"{name}.weight" for name, module in model.named_modules()
+             if isinstance(module, nn.Linear) and not any(keyword in name for keyword in params_to_keep)}
+
+    def quantize_fn(name, tensor):
+        if name not in names:
+            return None
+        if tensor.dtype == torch.int8:
+            return tensor, {}
+        weight, scale = quantize_int8(tensor)
+        return weight, {"scale_weight": scale}
+    return quantize_fn
+
+def convert_int8_linear(module, original_dtype, params_to_keep={}, dynamic_activations=False):
+    for name, module in module.named_modules():
+        if not any(keyword in name for keyword in params_to_keep):
+            if isinstance(module, nn.Linear):
+                original_forward = module.forward
+                setattr(module, "original_forward", original_forward)
+                setattr(module, "forward", lambda input, m=module: int8_linear_forward(m, original_dtype, input, dynamic_activations))
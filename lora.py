@@ -0,0 +1,374 @@
+import os
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+from .utils import log
+from .fp8_optimization import FP8_DTYPES, quantize_fp8, install_fp8_scaled_forward
+from .int8_optimization import quantize_int8
+
+DEFAULT_DELTA_CACHE_GB = 4.0
+MAX_LOADED_LORAS = 8
+DELTA_DTYPE = torch.bfloat16
+
+
+LORA_CACHE_VERSION = 1
+
+
+def convert_lora_state_dict(lora_sd, path=None):
+    """Converts a LoRA state dict to the diffusers format (transformer.<module>.lora_A/lora_B.weight)."""
+    if "lora_unet_single_transformer_blocks_0_attn_to_k.lora_up.weight" in lora_sd:
+        from .utils import convert_to_diffusers
+        lora_sd = convert_to_diffusers("lora_unet_", lora_sd)
+
+    if not "transformer.single_transformer_blocks.0.attn_to.k.lora_A.weight" in lora_sd:
+        from diffusers.loaders.lora_conversion_utils import _convert_hunyuan_video_lora_to_diffusers
+        log.info(f"Converting LoRA weights from {path} to diffusers format...")
+        lora_sd = _convert_hunyuan_video_lora_to_diffusers(lora_sd)
+
+    return lora_sd
+
+
+def validate_lora_keys(lora_sd, param_names, path=None):
+    """
+    Checks that the modules a converted LoRA targets exist in the transformer.
+
+    Raises if nothing matches (wrong model or an unknown key format) and warns about the modules
+    that don't, which would otherwise just be ignored.
+    """
+    param_names = {_clean_param_name(name) for name in param_names}
+    modules = [key[:-len(".lora_A.weight")] for key in lora_sd if key.endswith(".lora_A.weight")]
+    missing = [m for m in modules if f"{_strip_prefix(m)}.weight" not in param_names]
+    if not modules or len(missing) == len(modules):
+        raise ValueError(f"None of the LoRA weights in {path} match the transformer, e.g. {(missing or list(lora_sd.keys()))[:5]}")
+    if missing:
+        log.warning(f"{len(missing)} of {len(modules)} LoRA modules in {path} don't exist in the transformer and are ignored, e.g. {missing[:5]}")
+
+
+def get_cached_lora_path(path):
+    from .model_cache import get_cache_dir, get_file_hash
+    lora_cache_dir = os.path.join(get_cache_dir(), "loras")
+    os.makedirs(lora_cache_dir, exist_ok=True)
+    return os.path.join(lora_cache_dir, f"{get_file_hash(path)}_v{LORA_CACHE_VERSION}.safetensors")
+
+
+def load_lora_state_dict(path, param_names=None):
+    """
+    Loads a LoRA file in the diffusers format.
+
+    The converted weights of each LoRA file are written once to the model cache, keyed by the file's hash,
+    later loads memory-map that file and skip the conversion. If param_names is given, the keys are validated
+    against them.
+    """
+    from .model_loading import SafetensorsFile, save_safetensors_streaming
+
+    cached_path = get_cached_lora_path(path)
+    if os.path.exists(cached_path):
+        f = SafetensorsFile(cached_path)
+        lora_sd = {name: f.get_tensor(name) for name in f.keys()}
+    else:
+        from comfy.utils import load_torch_file
+        lora_sd = convert_lora_state_dict(load_torch_file(path), path)
+        lora_sd = {k: v.contiguous() for k, v in lora_sd.items()}
+        if param_names is not None:
+            validate_lora_keys(lora_sd, param_names, path)
+        tmp_path = f"{cached_path}.{os.getpid()}.tmp"
+        try:
+            save_safetensors_streaming(lora_sd, tmp_path, metadata={"source": os.path.basename(path)})
+            os.replace(tmp_path, cached_path)
+        except OSError as e:
+            log.warning(f"Could not write converted LoRA {cached_path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return lora_sd
+
+    if param_names is not None:
+        validate_lora_keys(lora_sd, param_names, path)
+    return lora_sd
+
+
+def get_lora_rank(lora_sd):
+    for key, val in lora_sd.items():
+        if "lora_B" in key or "lora_up" in key:
+            return val.shape[1]
+    return None
+
+
+def get_lora_factors(lora_sd):
+    """Splits a diffusers format LoRA state dict into {module name: (lora_A, lora_B, scale)}."""
+    factors = {}
+    for key, down in lora_sd.items():
+        if not key.endswith(".lora_A.weight"):
+            continue
+        module_name = key[:-len(".lora_A.weight")]
+        up = lora_sd.get(f"{module_name}.lora_B.weight")
+        if up is None or down.ndim != 2:
+            log.warning(f"Skipping unsupported LoRA weights for {module_name}")
+            continue
+        alpha = lora_sd.get(f"{module_name}.alpha")
+        scale = alpha.item() / down.shape[0] if alpha is not None else 1.0
+        factors[_strip_prefix(module_name)] = (down, up, scale)
+    return factors
+
+
+def open_base_source(source):
+    """
+    A second private mapping of the checkpoint the model was loaded from, for LoraManager to read the clean
+    weights from. Parameters loaded without a cast are views into the loader's mapping and are patched in
+    place, so that one can't be. None for sources that can't be mapped again, their weights are backed up.
+    """
+    from .model_loading import SafetensorsFile, ShardedSafetensors
+    if isinstance(source, SafetensorsFile):
+        return SafetensorsFile(source.path)
+    if isinstance(source, ShardedSafetensors):
+        return ShardedSafetensors([f.path for f in source.files])
+    return None
+
+
+def _strip_prefix(module_name):
+    return module_name[len("transformer."):] if module_name.startswith("transformer.") else module_name
+
+
+def _clean_param_name(name):
+    # torch.compile'd blocks and PEFT wrapped layers add these to the parameter names
+    return name.replace("._orig_mod", "").replace(".base_layer", "")
+
+
+class LoraManager:
+    """
+    Fuses LoRAs into a loaded transformer in place and takes them out again, without reloading the base model.
+
+    The clean weight of a patched Linear is re-read from a mapping of the checkpoint the model was loaded from
+    (see open_base_source, never the one the parameters are views of), so changing the LoRA stack or a strength costs one read from the page cache and one add per affected Linear
+    and never drifts. Without a checkpoint to read from (e.g. .pt files) the affected weights are backed up instead.
+    The computed B @ A deltas are kept in an LRU cache in host memory limited to delta_cache_gb, and moved to
+    the weight's device one at a time when they are applied.
+
+    fp8 and int8 weights are dequantized, fused in float32 and requantized with a fresh scale (per tensor or
+    per output channel for fp8, per channel for int8), stored as a scale_weight buffer next to the weight.
+
+    Unfused LoRAs leave the weights alone and run next to the Linear at runtime instead, which also works
+    with fp8 weights.
+    """
+    def __init__(self, base_source=None, compute_dtype=torch.bfloat16, fp8_scale="per_tensor", delta_cache_gb=DEFAULT_DELTA_CACHE_GB):
+        self.base_source = base_source
+        self.compute_dtype = compute_dtype
+        self.fp8_scale = fp8_scale
+        self.backups = {}
+        self.factors = OrderedDict()
+        self.deltas = OrderedDict()
+        self.delta_bytes = 0
+        self.delta_cache_bytes = int(delta_cache_gb * 1024 ** 3)
+        self.applied = {}
+        self.stacked = {}
+
+    def get_factors(self, path, param_names=None):
+        factors = self.factors.get(path)
+        if factors is None:
+            factors = get_lora_factors(load_lora_state_dict(path, param_names))
+            self.factors[path] = factors
+            while len(self.factors) > MAX_LOADED_LORAS:
+                self.factors.popitem(last=False)
+        self.factors.move_to_end(path)
+        return factors
+
+    def get_delta(self, path, module_name, device):
+        key = (path, module_name)
+        delta = self.deltas.get(key)
+        if delta is not None:
+            self.deltas.move_to_end(key)
+            return delta.to(device)
+
+        down, up, scale = self.get_factors(path)[module_name]
+        delta = (up.to(device, torch.float32) @ down.to(device, torch.float32)).mul_(scale).to(DELTA_DTYPE)
+        nbytes = delta.nelement() * delta.element_size()
+        if nbytes <= self.delta_cache_bytes:
+            # the cache would otherwise hold up to delta_cache_gb of VRAM next to a model loaded to the GPU
+            self.deltas[key] = delta.to("cpu")
+            self.delta_bytes += nbytes
+            while self.delta_bytes > self.delta_cache_bytes:
+                _, evicted = self.deltas.popitem(last=False)
+                self.delta_bytes -= evicted.nelement() * evicted.element_size()
+        return delta
+
+    def get_fused_weight(self, base_weight, base_scale, stack, module_name, device):
+        weight = base_weight.to(device=device, dtype=torch.float32, copy=True)
+        if base_scale is not None:
+            weight.mul_(base_scale.to(device, torch.float32))
+        for path, strength in stack:
+            weight.add_(self.get_delta(path, module_name, device), alpha=strength)
+        return weight
+
+    def get_base_weight(self, name, param, module):
+        """Returns the clean (weight, scale_weight) of a Linear, the scale is None for unscaled weights."""
+        scale_name = f"{name[:-len('weight')]}scale_weight"
+        if self.base_source is not None:
+            scale = self.base_source.get_tensor(scale_name) if scale_name in self.base_source else None
+            return self.base_source.get_tensor(name), scale
+        if name not in self.backups:
+            scale = module._buffers.get("scale_weight")
+            self.backups[name] = (param.data.to("cpu", copy=True), None if scale is None else scale.to("cpu", copy=True))
+        return self.backups[name]
+
+    def _get_stacks(self, param_names, loras):
+        """The (path, strength) stacks per module of the fused and of the unfused LoRAs."""
+        wanted = {}
+        wanted_unfused = {}
+        for l in loras:
+            if l["strength"] == 0:
+                continue
+            target = wanted if l["fuse_lora"] else wanted_unfused
+            for module_name in self.get_factors(l["path"], param_names):
+                target.setdefault(module_name, []).append((l["path"], l["strength"]))
+        return {k: tuple(v) for k, v in wanted.items()}, {k: tuple(v) for k, v in wanted_unfused.items()}
+
+    def assume_fused(self, model, loras):
+        """
+        Records the fused LoRAs the loaded weights already have in them (e.g. shared by another process) as
+        applied, without patching. Without a base_source they can't be taken out again, the loader keys such
+        models by their fused stack.
+        """
+        param_names = [_clean_param_name(name) for name, _ in model.named_parameters()]
+        self.applied, _ = self._get_stacks(param_names, [l for l in loras if l["fuse_lora"]])
+
+    @torch.no_grad()
+    def set_loras(self, model, loras, rank=None):
+        """
+        Makes the LoRAs of the model exactly `loras` (list of FPLORA entries), patching only what changed.
+
+        Fused LoRAs are added to the weights, the unfused ones are stacked into one low-rank pair per Linear
+        (see stack_lora_factors), optionally re-compressed to `rank`.
+        """
+        params = {_clean_param_name(name): param for name, param in model.named_parameters()}
+        wanted, wanted_unfused = self._get_stacks(params.keys(), loras)
+        wanted_unfused = {k: (v, rank or None) for k, v in wanted_unfused.items()}
+
+        changed = [name for name in set(wanted) | set(self.applied) if wanted.get(name) != self.applied.get(name)]
+        modules = {_clean_param_name(name): module for name, module in model.named_modules()}
+        patched = []
+        for module_name in changed:
+            name = f"{module_name}.weight"
+            param = params.get(name)
+            if param is None:
+                log.warning(f"LoRA module {module_name} not found in the model, skipping")
+                continue
+            module = modules[module_name]
+            if "gguf_qtype" in module.__dict__:
+                raise ValueError("Fusing LoRA into GGUF quantized weights is not supported, disable fuse_lora to run the LoRA unfused.")
+            base_weight, base_scale = self.get_base_weight(name, param, module)
+            stack = wanted.get(module_name, ())
+            patched.append(module)
+            if not stack and base_weight.dtype == param.dtype:
+                # exact restore of the stored weight
+                param.data.copy_(base_weight.to(param.device))
+                if base_scale is not None:
+                    module.register_buffer("scale_weight", base_scale.to(param.device), persistent=False)
+                else:
+                    module._buffers.pop("scale_weight", None)
+                continue
+
+            weight = self.get_fused_weight(base_weight, base_scale, stack, module_name, param.device)
+            if param.dtype in FP8_DTYPES:
+                weight, scale = quantize_fp8(weight, param.dtype, per_channel=self.fp8_scale == "per_channel")
+                install_fp8_scaled_forward(module, self.compute_dtype)
+            elif param.dtype == torch.int8:
+                weight, scale = quantize_int8(weight)
+            else:
+                weight, scale = weight.to(param.dtype), None
+            param.data.copy_(weight)
+            if scale is not None:
+                module.register_buffer("scale_weight", scale, persistent=False)
+        for module in patched:
+            # copy_ doesn't bump the weight's version, and a new scale can reuse a freed one's id
+            module.__dict__.pop("fp8_weight_cache", None)
+        self.applied = wanted
+        disk_tier = model.__dict__.get("disk_tier")
+        if disk_tier is not None:
+            # the weights were patched wherever they currently are, the tier's mapping has to follow
+            disk_tier.write_back(patched)
+        codec = model.__dict__.get("transfer_codec")
+        if codec is not None:
+            for module in patched:
+                codec.invalidate(module)
+
+        changed_unfused = [name for name in set(wanted_unfused) | set(self.stacked) if wanted_unfused.get(name) != self.stacked.get(name)]
+        for module_name in changed_unfused:
+            module = modules.get(module_name)
+            if module is None:
+                log.warning(f"LoRA module {module_name} not found in the model, skipping")
+                continue
+            if module_name in wanted_unfused:
+                stack, stack_rank = wanted_unfused[module_name]
+                lora_A, lora_B = stack_lora_factors(
+                    [self.get_factors(path)[module_name] + (strength,) for path, strength in stack], stack_rank)
+                device = module._parameters["weight"].device
+                install_lora_linear(module, lora_A.to(device), lora_B.to(device))
+            else:
+                uninstall_lora_linear(module)
+        self.stacked = wanted_unfused
+
+        if changed or changed_unfused:
+            from .diffusers_helper.memory import clear_weight_cache
+            # the swap cache's device copies have the old weights
+            clear_weight_cache(model)
+            log.info(f"Patched {len(changed)} weights and {len(changed_unfused)} runtime LoRA stacks for {len(loras)} LoRA(s)")
+
+
+def stack_lora_factors(factors, rank=None):
+    """
+    Stacks the (lora_A, lora_B, scale, strength) factors of several LoRAs of one Linear into a single pair,
+    so that lora_B @ lora_A == sum(strength * scale * B_i @ A_i) and the layer needs one low-rank GEMM pair
+    no matter how many LoRAs are active.
+
+    If `rank` is smaller than the summed rank, the stack is re-compressed to its best rank `rank` approximation
+    with a QR + SVD of the small core instead of decomposing the full (out, in) delta.
+    """
+    lora_A = torch.cat([down.to(torch.float32) for down, _, _, _ in factors], dim=0)
+    lora_B = torch.cat([up.to(torch.float32) * (scale * strength) for _, up, scale, strength in factors], dim=1)
+    if rank is not None and rank < lora_A.shape[0]:
+        q_b, r_b = torch.linalg.qr(lora_B)
+        q_a, r_a = torch.linalg.qr(lora_A.t())
+        u, sigma, vh = torch.linalg.svd(r_b @ r_a.t())
+        lora_B = q_b @ (u[:, :rank] * sigma[:rank])
+        lora_A = (q_a @ vh[:rank].t()).t()
+    return lora_A.to(DELTA_DTYPE).contiguous(), lora_B.to(DELTA_DTYPE).contiguous()
+
+
+def lora_linear_forward(cls, input):
+    out = cls.lora_base_forward(input)
+    lora_A = cls.lora_A
+    lora_B = cls.lora_B
+    return out + F.linear(F.linear(input.to(lora_A.dtype), lora_A), lora_B).to(out.dtype)
+
+
+def install_lora_linear(module, lora_A, lora_B):
+    """
+    Adds a runtime LoRA to a Linear. The pair is registered as buffers so DynamicSwapInstaller moves it along
+    with the weight, and the current forward (e.g. the fp8 matmul one) is kept as the base.
+    """
+    module.register_buffer("lora_A", lora_A, persistent=False)
+    module.register_buffer("lora_B", lora_B, persistent=False)
+    if "lora_base_forward" not in module.__dict__:
+        module.lora_base_forward = module.forward
+        module.forward = lambda input, m=module: lora_linear_forward(m, input)
+
+
+def uninstall_lora_linear(module):
+    if "lora_base_forward" in module.__dict__:
+        module.forward = module.__dict__.pop("lora_base_forward")
+    module._buffers.pop("lora_A", None)
+    module._buffers.pop("lora_B", None)
+
+
+def get_lora_key(model):
+    """The LoRAs a FramePackMODEL applies, jobs with equal keys can share its transformer's weights."""
+    return tuple((l["path"], l["strength"], l["fuse_lora"]) for l in model.get("loras", [])), model.get("lora_rank")
+
+
+def apply_model_loras(model):
+    """Makes sure the transformer of a FramePackMODEL has the LoRAs this pipe asked for applied."""
+    transformer = model["transformer"]
+    lora_manager = transformer.__dict__.get("lora_manager")
+    if lora_manager is not None:
+        lora_manager.set_loras(transformer, model.get("loras", []), model.get("lora_rank"))
@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+
+from .utils import log
+from .model_loading import save_safetensors_streaming
+
+CACHE_VERSION = 2
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def get_cache_dir():
+    cache_dir = os.environ.get("FRAMEPACK_CACHE_DIR")
+    if not cache_dir:
+        import folder_paths
+        cache_dir = os.path.join(folder_paths.models_dir, "framepack_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def _write_json_atomic(data, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def get_file_hash(path):
+    """
+    sha256 of a file's contents.
+
+    Hashing a multi-GB checkpoint takes a while, so results are remembered in the cache dir keyed by
+    path, size and mtime, and a file is only hashed again after it has changed.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    index_path = os.path.join(get_cache_dir(), "file_hashes.json")
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+
+    entry = index.get(path)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    log.info(f"Hashing {path}...")
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    index[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha.hexdigest()}
+    _write_json_atomic(index, index_path)
+    return index[path]["sha256"]
+
+
+def get_recipe(model_path, loras, quantization, base_precision, fp8_scale="per_tensor", precision_policy=None):
+    recipe = {
+        "version": CACHE_VERSION,
+        "model": get_file_hash(model_path),
+        "loras": [{"sha256": get_file_hash(l["path"]), "strength": l["strength"]} for l in (loras or [])],
+        "quantization": quantization,
+        "base_precision": base_precision,
+        "fp8_scale": fp8_scale,
+    }
+    # only part of the recipe when set, so caches built without a policy stay valid
+    if precision_policy:
+        recipe["precision_policy"] = precision_policy
+    return recipe
+
+
+def get_recipe_key(recipe):
+    return hashlib.sha256(json.dumps(recipe, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_cached_model_path(key):
+    """Returns the path of the cached weights for a recipe key, or None if it hasn't been built yet."""
+    path = os.path.join(get_cache_dir(), f"{key}.safetensors")
+    return path if os.path.exists(path) else None
+
+
+def save_cached_model(key, model, recipe):
+    path = os.path.join(get_cache_dir(), f"{key}.safetensors")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    log.info(f"Saving transformer to model cache: {path}")
+    try:
+        tensors = {name: param for name, param in model.named_parameters()}
+        # scales of fp8 weights with fused LoRAs
+        tensors.update({name: buffer for name, buffer in model.named_buffers() if name.endswith(".scale_weight")})
+        save_safetensors_streaming(tensors, tmp_path, metadata={"framepack_recipe": json.dumps(recipe, sort_keys=True)})
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning(f"Could not write model cache {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    return path
@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import struct
+import weakref
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from tqdm import tqdm
+from accelerate.utils import set_module_tensor_to_device
+
+from .utils import log
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "F8_E4M3": torch.float8_e4m3fn,
+    "F8_E5M2": torch.float8_e5m2,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+class SafetensorsFile:
+    """Memory-mapped .safetensors file.
+
+    Tensors returned by get_tensor() are views into a private (copy-on-write) mapping of the file,
+    so nothing is read from disk until the data is actually touched and no state dict is built.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_size))
+        self.metadata = header.pop("__metadata__", None) or {}
+        self.header = header
+        self.data_offset = 8 + header_size
+
+        storage = torch.UntypedStorage.from_file(path, False, os.path.getsize(path))
+        self.buffer = torch.empty((0,), dtype=torch.uint8).set_(storage)
+
+    def keys(self):
+        return self.header.keys()
+
+    def __contains__(self, name):
+        return name in self.header
+
+    def dtype_of(self, name):
+        return SAFETENSORS_DTYPES[self.header[name]["dtype"]]
+
+    def nbytes_of(self, name):
+        start, end = self.header[name]["data_offsets"]
+        return end - start
+
+    def location_of(self, name):
+        return (0, self.header[name]["data_offsets"][0])
+
+    def get_tensor(self, name):
+        info = self.header[name]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        data = self.buffer[self.data_offset + start:self.data_offset + end]
+        if (self.data_offset + start) % torch.empty((), dtype=dtype).element_size() != 0:
+            # unaligned tensor, needs a copy before it can be reinterpreted
+            data = data.clone()
+        return data.view(dtype).view(info["shape"])
+
+
+class ShardedSafetensors:
+    """Several safetensors shards, e.g. of a diffusers snapshot, behind the SafetensorsFile interface."""
+    def __init__(self, paths):
+        self.files = [SafetensorsFile(path) for path in paths]
+        self.file_index = {name: i for i, f in enumerate(self.files) for name in f.keys()}
+
+    def keys(self):
+        return self.file_index.keys()
+
+    def __contains__(self, name):
+        return name in self.file_index
+
+    def dtype_of(self, name):
+        return self.files[self.file_index[name]].dtype_of(name)
+
+    def nbytes_of(self, name):
+        return self.files[self.file_index[name]].nbytes_of(name)
+
+    def location_of(self, name):
+        i = self.file_index[name]
+        return (i, self.files[i].location_of(name)[1])
+
+    def get_tensor(self, name):
+        return self.files[self.file_index[name]].get_tensor(name)
+
+
+class StateDictSource:
+    """Adapts an already loaded state dict to the SafetensorsFile interface."""
+    def __init__(self, sd):
+        self.sd = sd
+
+    def keys(self):
+        return self.sd.keys()
+
+    def __contains__(self, name):
+        return name in self.sd
+
+    def dtype_of(self, name):
+        return self.sd[name].dtype
+
+    def nbytes_of(self, name):
+        t = self.sd[name]
+        return t.nelement() * t.element_size()
+
+    def location_of(self, name):
+        return (0, 0)
+
+    def get_tensor(self, name):
+        return self.sd[name]
+
+
+def open_state_dict(path):
+    if path.endswith(".safetensors"):
+        return SafetensorsFile(path)
+    if path.endswith(".gguf"):
+        from .gguf_optimization import GGUFFile
+        return GGUFFile(path)
+    from comfy.utils import load_torch_file
+    return StateDictSource(load_torch_file(path, safe_load=True))
+
+
+def open_diffusers_snapshot(model_path, weights_name="diffusion_pytorch_model"):
+    index_path = os.path.join(model_path, f"{weights_name}.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            shards = sorted(set(json.load(f)["weight_map"].values()))
+    else:
+        shards = [f"{weights_name}.safetensors"]
+    return ShardedSafetensors([os.path.join(model_path, shard) for shard in shards])
+
+
+def load_diffusers_config(model_path):
+    with open(os.path.join(model_path, "config.json"), "r") as f:
+        config = json.load(f)
+    return {k: v for k, v in config.items() if not k.startswith("_")}
+
+
+def load_state_dict_streaming(model, source, device, dtype_fn=None, num_workers=None, desc=None, quantize_fn=None):
+    """
+    Streams every parameter of a model created under init_empty_weights() straight from `source`.
+
+    Reading and the dtype cast/quantization run on a thread pool, only a bounded number of tensors
+    is in flight at any time, so peak host memory stays close to the size of the final model.
+    dtype_fn(name) returns the target dtype of a parameter, or None to keep the stored dtype.
+    quantize_fn(name, tensor) can instead return (tensor, {buffer name: tensor}) for a parameter, the buffers
+    (e.g. quantization scales) are registered on the parameter's module. If it returns None, dtype_fn is used.
+    """
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    # inference only, this also allows integer (quantized) parameters
+    model.requires_grad_(False)
+    names = [name for name, _ in model.named_parameters()]
+    missing = [name for name in names if name not in source]
+    if missing:
+        raise KeyError(f"Missing {len(missing)} tensors in checkpoint, e.g. {missing[:5]}")
+    # read shard by shard in file order, which keeps disk reads sequential
+    names.sort(key=source.location_of)
+
+    def prepare(name):
+        tensor = source.get_tensor(name)
+        if quantize_fn is not None:
+            quantized = quantize_fn(name, tensor.to(device))
+            if quantized is not None:
+                value, buffers = quantized
+                return value.to(device), {k: v.to(device) for k, v in buffers.items()}
+        dtype = dtype_fn(name) if dtype_fn is not None else None
+        return tensor.to(device=device, dtype=dtype or tensor.dtype), None
+
+    total_bytes = 0
+    start_time = time.perf_counter()
+    inflight = deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor, tqdm(total=len(names), desc=desc or f"Loading transformer parameters to {device}", leave=True) as pbar:
+        for name in names:
+            inflight.append((name, executor.submit(prepare, name)))
+            if len(inflight) >= num_workers * 2:
+                total_bytes += _assign_next(model, source, inflight, pbar)
+        while inflight:
+            total_bytes += _assign_next(model, source, inflight, pbar)
+
+    elapsed = time.perf_counter() - start_time
+    stats = {
+        "tensors": len(names),
+        "bytes": total_bytes,
+        "seconds": elapsed,
+        "gb_per_s": total_bytes / (1024 ** 3) / max(elapsed, 1e-9),
+    }
+    log.info(f"Loaded {stats['tensors']} tensors ({total_bytes / (1024 ** 3):.2f} GB) in {elapsed:.2f}s ({stats['gb_per_s']:.2f} GB/s)")
+    return stats
+
+
+def _assign_next(model, source, inflight, pbar):
+    name, future = inflight.popleft()
+    value, buffers = future.result()
+    module_name, param_name = name.rsplit(".", 1)
+    module = model.get_submodule(module_name)
+    if value.shape != module._parameters[param_name].shape:
+        # packed quantized weights (e.g. GGUF blocks) don't have the shape of the parameter they replace
+        module._parameters[param_name] = torch.nn.Parameter(value, requires_grad=False)
+    else:
+        set_module_tensor_to_device(model, name, device=value.device, dtype=value.dtype, value=value)
+    if buffers:
+        for buffer_name, buffer in buffers.items():
+            module.register_buffer(buffer_name, buffer, persistent=False)
+    pbar.update(1)
+    return source.nbytes_of(name)
+
+
+def save_safetensors_streaming(tensors, path, metadata=None):
+    """
+    Writes a .safetensors file one tensor at a time, so saving a model that lives on the GPU
+    never needs a second full copy of it in host memory.
+    """
+    dtype_names = {v: k for k, v in SAFETENSORS_DTYPES.items()}
+    header = {}
+    offset = 0
+    for name, tensor in tensors.items():
+        nbytes = tensor.nelement() * tensor.element_size()
+        header[name] = {"dtype": dtype_names[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    if metadata:
+        header["__metadata__"] = {k: str(v) for k, v in metadata.items()}
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for tensor in tensors.values():
+            data = tensor.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8)
+            f.write(data.numpy().tobytes())
+
+
+def get_load_key(**recipe):
+    """Turns a load recipe (paths, precision settings, LoRA list, compile args...) into a hashable key."""
+    def freeze(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(freeze(v) for v in value)
+        return value
+    return freeze(recipe)
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of loaded transformers keyed by their load recipe.
+
+    Loader nodes asking for the same recipe get the same instance instead of building another copy.
+    Entries are weak references, so a transformer is evicted as soon as nothing refers to it anymore.
+    """
+    def __init__(self):
+        self.models = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            model = self.models.get(key)
+            if model is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return model
+
+    def put(self, key, model):
+        with self.lock:
+            self.models[key] = model
+        return model
+
+    def get_stats(self):
+        with self.lock:
+            return {"models": len(self.models), "hits": self.hits, "misses": self.misses}
+
+
+model_registry = ModelRegistry()
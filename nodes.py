@@ -1,14 +1,10 @@
 import os
 import torch
 import math
-from tqdm import tqdm
-
-from accelerate import init_empty_weights
-from accelerate.utils import set_module_tensor_to_device
 
 import folder_paths
 import comfy.model_management as mm
-from comfy.utils import load_torch_file, ProgressBar, common_upscale
+from comfy.utils import ProgressBar, common_upscale
 import comfy.model_base
 import comfy.latent_formats
 from comfy.cli_args import args, LatentPreviewMethod
@@ -18,13 +14,15 @@ from .utils import log
 script_directory = os.path.dirname(os.path.abspath(__file__))
 vae_scaling_factor = 0.476986
 
-from .diffusers_helper.models.hunyuan_video_packed import HunyuanVideoTransformer3DModel
-from .diffusers_helper.memory import DynamicSwapInstaller, move_model_to_device_with_memory_preservation
-from .diffusers_helper.pipelines.k_diffusion_hunyuan import sample_hunyuan
-from .diffusers_helper.utils import crop_or_pad_yield_mask
 from .diffusers_helper.bucket_tools import find_nearest_bucket
 
-from diffusers.loaders.lora_conversion_utils import _convert_hunyuan_video_lora_to_diffusers
+# The transformer, diffusers, accelerate and the attention backends are imported on first use
+# inside the loaders and samplers, so registering the nodes doesn't slow down ComfyUI startup.
+
+# GGUF quantized transformers live in the diffusion_models folders too, but get their own entry so that
+# ComfyUI's own loaders don't list them
+if "diffusion_models" in folder_paths.folder_names_and_paths and "diffusion_models_gguf" not in folder_paths.folder_names_and_paths:
+    folder_paths.folder_names_and_paths["diffusion_models_gguf"] = (folder_paths.folder_names_and_paths["diffusion_models"][0], {".gguf"})
 
 class HyVideoModel(comfy.model_base.BaseModel):
     def __init__(self, *args, **kwargs):
@@ -84,6 +82,26 @@ class FramePackTorchCompileSettings:
 
         return (compile_args, )
 
+class FramePackPrecisionPolicy:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "rules": ("STRING", {"multiline": True, "default": "transformer_blocks.[01] = bf16\ntransformer_blocks.1[89] = bf16\nproj_out = fp32\n* = fp8_scaled",
+                                     "tooltip": "One 'pattern = scheme' rule per line, the first rule matching a parameter name wins. Patterns are globs (a module name also matches its parameters) or regexes prefixed with 're:'. Schemes: base, fp32, bf16, fp16, fp8_e4m3fn, fp8_e4m3fn_fast, fp8_e5m2, fp8_scaled, int8_weight_only, int8_dynamic. Parameters without a matching rule use the loader's quantization"}),
+            },
+        }
+    RETURN_TYPES = ("FPPRECISIONPOLICY",)
+    RETURN_NAMES = ("precision_policy",)
+    FUNCTION = "loadmodel"
+    CATEGORY = "FramePackWrapper"
+    DESCRIPTION = "Per-layer precision for the model loaders, e.g. keeping the most sensitive blocks in bf16 and quantizing the rest. benchmark.py sensitivity ranks the blocks and generates a policy for a memory budget"
+
+    def loadmodel(self, rules):
+        from .precision_policy import PrecisionPolicy
+        # parse here so that a bad rule fails on this node
+        return (PrecisionPolicy.parse(rules).to_text(), )
+
 #region Model loading
 class DownloadAndLoadFramePackModel:
     @classmethod
@@ -93,7 +111,7 @@ class DownloadAndLoadFramePackModel:
                 "model": (["lllyasviel/FramePackI2V_HY"],),
 
             "base_precision": (["fp32", "bf16", "fp16"], {"default": "bf16"}),
-            "quantization": (['disabled', 'fp8_e4m3fn', 'fp8_e4m3fn_fast', 'fp8_e5m2'], {"default": 'disabled', "tooltip": "optional quantization method"}),
+            "quantization": (['disabled', 'fp8_e4m3fn', 'fp8_e4m3fn_fast', 'fp8_e5m2', 'fp8_scaled', 'int8_weight_only', 'int8_dynamic'], {"default": 'disabled', "tooltip": "optional quantization method, fp8_scaled quantizes the weights with a per-tensor or per-channel scale and runs fp8 matmuls with dynamic per-token activation scales. int8_weight_only stores the Linear weights as int8 with per-channel scales and dequantizes them on the fly, int8_dynamic also quantizes the activations and runs int8 matmuls, both are meant for CPU"}),
             },
             "optional": {
                 "attention_mode": ([
@@ -102,6 +120,12 @@ class DownloadAndLoadFramePackModel:
                     "sageattn",
                     ], {"default": "sdpa"}),
                 "compile_args": ("FRAMEPACKCOMPILEARGS", ),
+                "fp8_scale": (["per_tensor", "per_channel"], {"default": "per_tensor", "tooltip": "Scale granularity of fp8_scaled weights"}),
+                "precision_policy": ("FPPRECISIONPOLICY", {"tooltip": "Per-layer precision rules, layers they don't cover use the quantization setting"}),
+                "swap_cache_gb": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 64.0, "step": 0.1, "tooltip": "GPU memory for reusing the copies of offloaded weights within one transformer forward, 0 copies a weight on every read"}),
+                "pinned_memory_gb": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 256.0, "step": 0.5, "tooltip": "Keep up to this much of the offloaded weights in one pinned (page-locked) host allocation, so that uploading them to the GPU is asynchronous and faster. Weights that don't fit stay in pageable memory, 0 disables"}),
+                "disk_offload_gb": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 256.0, "step": 0.5, "tooltip": "For hosts with less RAM than the model: the offloaded blocks stay memory-mapped on disk and are paged in per forward through a host cache of this many GB. Weights that aren't stored as-is in the checkpoint (quantized or cast on load) are written to a spill file in the framepack_cache folder first, fused LoRAs stay in RAM unless model_cache is used. Replaces pinned_memory_gb, 0 disables"}),
+                "transfer_compression": (["disabled", "fp8", "int8"], {"default": "disabled", "tooltip": "Upload the weights of streamed (offloaded) blocks as fp8 or int8 with per-channel scales and dequantize them on the GPU right before the block runs, about half the PCIe traffic of bf16 weights. Compute stays in base_precision and resident blocks keep their original weights. The compact copies take extra host memory, half the size of the streamed bf16 weights. Needs prefetch_blocks > 0 in the sampler, int8 is the more accurate mode"}),
             }
         }
 
@@ -111,7 +135,13 @@ class DownloadAndLoadFramePackModel:
     CATEGORY = "FramePackWrapper"
 
     def loadmodel(self, model, base_precision, quantization,
-                  compile_args=None, attention_mode="sdpa"):
+                  compile_args=None, attention_mode="sdpa", fp8_scale="per_tensor", precision_policy=None, swap_cache_gb=0.0, pinned_memory_gb=0.0, disk_offload_gb=0.0, transfer_compression="disabled"):
+        from accelerate import init_empty_weights
+        from .diffusers_helper.models.hunyuan_video_packed import HunyuanVideoTransformer3DModel
+        from .diffusers_helper.memory import DynamicSwapInstaller, WeightCache, PinnedHostPool
+        from .transfer_compression import TransferCodec
+        from .model_loading import open_diffusers_snapshot, load_diffusers_config, load_state_dict_streaming, get_load_key, model_registry
+        from .precision_policy import get_policy
 
         base_dtype = {"fp8_e4m3fn": torch.float8_e4m3fn, "fp8_e4m3fn_fast": torch.float8_e4m3fn, "bf16": torch.bfloat16, "fp16": torch.float16, "fp16_fast": torch.float16, "fp32": torch.float32}[base_precision]
 
@@ -127,19 +157,49 @@ class DownloadAndLoadFramePackModel:
                 local_dir_use_symlinks=False,
             )
 
-        transformer = HunyuanVideoTransformer3DModel.from_pretrained(model_path, torch_dtype=base_dtype, attention_mode=attention_mode).cpu()
-        params_to_keep = {"norm", "bias", "time_in", "vector_in", "guidance_in", "txt_in", "img_in"}
-        if quantization == 'fp8_e4m3fn' or quantization == 'fp8_e4m3fn_fast':
-            transformer = transformer.to(torch.float8_e4m3fn)
-            if quantization == "fp8_e4m3fn_fast":
-                from .fp8_optimization import convert_fp8_linear
-                convert_fp8_linear(transformer, base_dtype, params_to_keep=params_to_keep)
-        elif quantization == 'fp8_e5m2':
-            transformer = transformer.to(torch.float8_e5m2)
-        else:
-            transformer = transformer.to(base_dtype)
+        load_key = get_load_key(loader="DownloadAndLoadFramePackModel", model_path=model_path, base_precision=base_precision,
+                                quantization=quantization, attention_mode=attention_mode, compile_args=compile_args, fp8_scale=fp8_scale,
+                                precision_policy=precision_policy, swap_cache_gb=swap_cache_gb,
+                                pinned_memory_gb=pinned_memory_gb, disk_offload_gb=disk_offload_gb, transfer_compression=transfer_compression)
+        transformer = model_registry.get(load_key)
+        if transformer is not None:
+            log.info("Reusing already loaded transformer with the same load settings")
+            return ({"transformer": transformer, "dtype": base_dtype, "quantization": quantization}, )
+
+        # a transformer kept resident by an earlier job would only be in the way of the new one
+        from .residency import residency_manager
+        residency_manager.evict_all()
 
-        DynamicSwapInstaller.install_model(transformer, device=device)
+        with init_empty_weights():
+            transformer = HunyuanVideoTransformer3DModel(**load_diffusers_config(model_path), attention_mode=attention_mode)
+
+        policy = get_policy(quantization, precision_policy)
+
+        sd = open_diffusers_snapshot(model_path)
+        print("Streaming model weights from the diffusers snapshot and assigning them to device...")
+        load_state_dict_streaming(
+            transformer, sd, mm.unet_offload_device(),
+            dtype_fn=policy.dtype_fn(base_dtype, transformer),
+            quantize_fn=policy.quantize_fn(transformer, fp8_scale),
+        )
+
+        policy.convert(transformer, base_dtype)
+
+        if disk_offload_gb > 0:
+            if pinned_memory_gb > 0:
+                log.warning("The disk offload tier pages weights into its own pinned cache, ignoring pinned_memory_gb")
+                pinned_memory_gb = 0.0
+            from .disk_offload import DiskOffloadTier
+            DiskOffloadTier.install(transformer, sd, int(disk_offload_gb * 1024**3))
+        del sd
+
+        PinnedHostPool.install(transformer, int(pinned_memory_gb * 1024**3))
+        if transfer_compression != "disabled" and disk_offload_gb > 0:
+            log.warning("Transfer compression keeps compact copies of the streamed weights in RAM, which disk offloading is meant to avoid, disabling it")
+            transfer_compression = "disabled"
+        TransferCodec.install(transformer, transfer_compression)
+        DynamicSwapInstaller.install_model(transformer, device=device, non_blocking=True,
+                                           weight_cache=WeightCache(int(swap_cache_gb * 1024**3)) if swap_cache_gb > 0 else None)
 
         if compile_args is not None:
             if compile_args["compile_single_blocks"]:
@@ -152,8 +212,9 @@ class DownloadAndLoadFramePackModel:
             #transformer = torch.compile(transformer, fullgraph=compile_args["fullgraph"], dynamic=compile_args["dynamic"], backend=compile_args["backend"], mode=compile_args["mode"])
 
         pipe = {
-            "transformer": transformer.eval(),
+            "transformer": model_registry.put(load_key, transformer.eval()),
             "dtype": base_dtype,
+            "quantization": quantization,
         }
         return (pipe, )
 
@@ -198,10 +259,10 @@ class LoadFramePackModel:
     def INPUT_TYPES(s):
         return {
             "required": {
-                "model": (folder_paths.get_filename_list("diffusion_models"), {"tooltip": "These models are loaded from the 'ComfyUI/models/diffusion_models' -folder",}),
+                "model": (folder_paths.get_filename_list("diffusion_models") + folder_paths.get_filename_list("diffusion_models_gguf"), {"tooltip": "These models are loaded from the 'ComfyUI/models/diffusion_models' -folder, .gguf files keep their quantized weights in memory",}),
 
             "base_precision": (["fp32", "bf16", "fp16"], {"default": "bf16"}),
-            "quantization": (['disabled', 'fp8_e4m3fn', 'fp8_e4m3fn_fast', 'fp8_e5m2'], {"default": 'disabled', "tooltip": "optional quantization method"}),
+            "quantization": (['disabled', 'fp8_e4m3fn', 'fp8_e4m3fn_fast', 'fp8_e5m2', 'fp8_scaled', 'int8_weight_only', 'int8_dynamic'], {"default": 'disabled', "tooltip": "optional quantization method, fp8_scaled quantizes the weights with a per-tensor or per-channel scale and runs fp8 matmuls with dynamic per-token activation scales. int8_weight_only stores the Linear weights as int8 with per-channel scales and dequantizes them on the fly, int8_dynamic also quantizes the activations and runs int8 matmuls, both are meant for CPU"}),
             "load_device": (["main_device", "offload_device"], {"default": "cuda", "tooltip": "Initialize the model on the main device or offload device"}),
             },
             "optional": {
@@ -212,6 +273,15 @@ class LoadFramePackModel:
                     ], {"default": "sdpa"}),
                 "compile_args": ("FRAMEPACKCOMPILEARGS", ),
                 "lora": ("FPLORA", {"default": None, "tooltip": "LORA model to load"}),
+                "model_cache": ("BOOLEAN", {"default": False, "tooltip": "Save the transformer with fused LoRAs (after quantization) to ComfyUI/models/framepack_cache and load it from there when the same model, LoRAs, strengths and precision settings are used again"}),
+                "fp8_scale": (["per_tensor", "per_channel"], {"default": "per_tensor", "tooltip": "Scale granularity of fp8_scaled weights and of LoRAs fused into fp8 weights"}),
+                "lora_rank": ("INT", {"default": 0, "min": 0, "max": 1024, "step": 1, "tooltip": "Re-compress the stacked unfused LoRAs of each layer to this rank with SVD, 0 keeps the full summed rank"}),
+                "precision_policy": ("FPPRECISIONPOLICY", {"tooltip": "Per-layer precision rules, layers they don't cover use the quantization setting. Not used with .gguf models"}),
+                "swap_cache_gb": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 64.0, "step": 0.1, "tooltip": "GPU memory for reusing the copies of offloaded weights within one transformer forward, 0 copies a weight on every read"}),
+                "pinned_memory_gb": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 256.0, "step": 0.5, "tooltip": "Keep up to this much of the offloaded weights in one pinned (page-locked) host allocation, so that uploading them to the GPU is asynchronous and faster. Weights that don't fit stay in pageable memory, 0 disables"}),
+                "disk_offload_gb": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 256.0, "step": 0.5, "tooltip": "For hosts with less RAM than the model: the offloaded blocks stay memory-mapped on disk and are paged in per forward through a host cache of this many GB. Weights that aren't stored as-is in the checkpoint (quantized or cast on load) are written to a spill file in the framepack_cache folder first, fused LoRAs stay in RAM unless model_cache is used. Replaces pinned_memory_gb, 0 disables"}),
+                "transfer_compression": (["disabled", "fp8", "int8"], {"default": "disabled", "tooltip": "Upload the weights of streamed (offloaded) blocks as fp8 or int8 with per-channel scales and dequantize them on the GPU right before the block runs, about half the PCIe traffic of bf16 weights. Compute stays in base_precision and resident blocks keep their original weights. The compact copies take extra host memory, half the size of the streamed bf16 weights. Needs prefetch_blocks > 0 in the sampler, int8 is the more accurate mode"}),
+                "share_weights": ("BOOLEAN", {"default": False, "tooltip": "Share the loaded (quantized, LoRA fused) host weights with the other ComfyUI processes on this machine through /dev/shm: the first process to load a model publishes it, the others loading it with the same settings wait for it and map the same memory instead of keeping their own copy. Needs load_device offload_device, not available on Windows or for .gguf models"}),
             }
         }
 
@@ -221,7 +291,15 @@ class LoadFramePackModel:
     CATEGORY = "FramePackWrapper"
 
     def loadmodel(self, model, base_precision, quantization,
-                  compile_args=None, attention_mode="sdpa", lora=None, load_device="main_device"):
+                  compile_args=None, attention_mode="sdpa", lora=None, load_device="main_device", model_cache=False, lora_rank=0, fp8_scale="per_tensor", precision_policy=None, swap_cache_gb=0.0, pinned_memory_gb=0.0, disk_offload_gb=0.0,
+                  share_weights=False, transfer_compression="disabled"):
+        from accelerate import init_empty_weights
+        from .diffusers_helper.models.hunyuan_video_packed import HunyuanVideoTransformer3DModel
+        from .diffusers_helper.memory import DynamicSwapInstaller, WeightCache, PinnedHostPool
+        from .transfer_compression import TransferCodec
+        from .model_loading import open_state_dict, load_state_dict_streaming, get_load_key, model_registry
+        from .quantization import PARAMS_TO_KEEP
+        from .precision_policy import get_policy
 
         base_dtype = {"fp8_e4m3fn": torch.float8_e4m3fn, "fp8_e4m3fn_fast": torch.float8_e4m3fn, "bf16": torch.bfloat16, "fp16": torch.float16, "fp16_fast": torch.float16, "fp32": torch.float32}[base_precision]
 
@@ -232,93 +310,134 @@ class LoadFramePackModel:
         else:
             transformer_load_device = offload_device
 
-        model_path = folder_paths.get_full_path_or_raise("diffusion_models", model)
+        model_path = folder_paths.get_full_path_or_raise("diffusion_models_gguf" if model.endswith(".gguf") else "diffusion_models", model)
+
+        # LoRAs are applied by the model's LoraManager and can be swapped without a reload: fused ones are patched
+        # into the weights, unfused ones run as one stacked low-rank pair per Linear
+        lora = lora or []
+        fused_loras = [l for l in lora if l["fuse_lora"]]
+
+        recipe = None
+        cached_model_path = None
+        if model_cache and fused_loras:
+            from .model_cache import get_recipe, get_recipe_key, get_cached_model_path
+            recipe = get_recipe(model_path, fused_loras, quantization, base_precision, fp8_scale, precision_policy)
+            cached_model_path = get_cached_model_path(get_recipe_key(recipe))
+
+        shared_key = None
+        if share_weights and not model_path.endswith(".gguf"):
+            from .model_cache import get_recipe, get_recipe_key
+            # the shared weights have the fused LoRAs of their recipe baked in, so each recipe is its own transformer
+            shared_key = get_recipe_key(recipe or get_recipe(model_path, fused_loras, quantization, base_precision, fp8_scale, precision_policy))
+
+        load_key = get_load_key(loader="LoadFramePackModel", model_path=model_path, model_mtime=os.path.getmtime(model_path),
+                                base_precision=base_precision, quantization=quantization, attention_mode=attention_mode,
+                                load_device=load_device, compile_args=compile_args, fp8_scale=fp8_scale,
+                                # the recipe, not whether its cache file exists yet, a model built before the cache is the same model
+                                model_cache_key=get_recipe_key(recipe) if recipe is not None else None,
+                                precision_policy=precision_policy, swap_cache_gb=swap_cache_gb,
+                                pinned_memory_gb=pinned_memory_gb, disk_offload_gb=disk_offload_gb, shared_key=shared_key,
+                                transfer_compression=transfer_compression)
+
+        transformer = model_registry.get(load_key)
+        if transformer is not None:
+            log.info("Reusing already loaded transformer with the same load settings")
+            return ({"transformer": transformer, "dtype": base_dtype, "quantization": quantization, "loras": lora, "lora_rank": lora_rank}, )
+
+        # a transformer kept resident by an earlier job would only be in the way of the new one
+        from .residency import residency_manager
+        residency_manager.evict_all()
+
+        shared = None
+        if shared_key is not None:
+            from .shared_weights import SharedWeights
+            # waits while another process loads the same recipe
+            shared = SharedWeights.open(shared_key)
+        attached = shared is not None and shared.published
+
         model_config_path = os.path.join(script_directory, "transformer_config.json")
         import json
         with open(model_config_path, "r") as f:
             config = json.load(f)
-        sd = load_torch_file(model_path, device=offload_device, safe_load=True)
-        model_weight_dtype = sd['single_transformer_blocks.0.attn.to_k.weight'].dtype
+
+        if cached_model_path is not None:
+            log.info(f"Using cached transformer with fused LoRAs: {cached_model_path}")
+            model_path = cached_model_path
+        if attached:
+            # the shared weights map without a copy
+            model_path = shared.path
+        # the cached and the shared weights already have the fused LoRAs in them
+        baked_loras = fused_loras if cached_model_path is not None or attached else []
+
+        sd = open_state_dict(model_path)
+        is_gguf = model_path.endswith(".gguf")
+        if is_gguf and quantization != "disabled":
+            log.warning(f"GGUF weights are already quantized, ignoring quantization {quantization}")
+            quantization = "disabled"
+        if is_gguf and precision_policy:
+            log.warning("GGUF weights are already quantized, ignoring the precision policy")
+            precision_policy = None
 
         with init_empty_weights():
             transformer = HunyuanVideoTransformer3DModel(**config, attention_mode=attention_mode)
 
-        params_to_keep = {"norm", "bias", "time_in", "vector_in", "guidance_in", "txt_in", "img_in"}
-        if quantization == "fp8_e4m3fn" or quantization == "fp8_e4m3fn_fast" or quantization == "fp8_scaled":
-            dtype = torch.float8_e4m3fn
-        elif quantization == "fp8_e5m2":
-            dtype = torch.float8_e5m2
+        policy = get_policy(quantization, precision_policy)
+        if is_gguf:
+            from .gguf_optimization import gguf_quantize_fn
+            quantize_fn = gguf_quantize_fn(transformer, sd, base_dtype, params_to_keep=PARAMS_TO_KEEP)
         else:
-            dtype = base_dtype
-
-        if lora is not None:
-            after_lora_dtype = dtype
-            dtype = base_dtype
-
-        print("Using accelerate to load and assign model weights to device...")
-        param_count = sum(1 for _ in transformer.named_parameters())
-        for name, param in tqdm(transformer.named_parameters(),
-                desc=f"Loading transformer parameters to {transformer_load_device}",
-                total=param_count,
-                leave=True):
-            dtype_to_use = base_dtype if any(keyword in name for keyword in params_to_keep) else dtype
-
-            set_module_tensor_to_device(transformer, name, device=transformer_load_device, dtype=dtype_to_use, value=sd[name])
-
-        if lora is not None:
-            adapter_list = []
-            adapter_weights = []
-
-            for l in lora:
-                fuse = True if l["fuse_lora"] else False
-                lora_sd = load_torch_file(l["path"])
-
-                if "lora_unet_single_transformer_blocks_0_attn_to_k.lora_up.weight" in lora_sd:
-                    from .utils import convert_to_diffusers
-                    lora_sd = convert_to_diffusers("lora_unet_", lora_sd)
-
-                if not "transformer.single_transformer_blocks.0.attn_to.k.lora_A.weight" in lora_sd:
-                    log.info(f"Converting LoRA weights from {l['path']} to diffusers format...")
-                    lora_sd = _convert_hunyuan_video_lora_to_diffusers(lora_sd)
-
-                lora_rank = None
-                for key, val in lora_sd.items():
-                    if "lora_B" in key or "lora_up" in key:
-                        lora_rank = val.shape[1]
-                        break
-                if lora_rank is not None:
-                    log.info(f"Merging rank {lora_rank} LoRA weights from {l['path']} with strength {l['strength']}")
-                    adapter_name = l['path'].split("/")[-1].split(".")[0]
-                    adapter_weight = l['strength']
-                    transformer.load_lora_adapter(lora_sd, weight_name=l['path'].split("/")[-1], lora_rank=lora_rank, adapter_name=adapter_name)
-
-                    adapter_list.append(adapter_name)
-                    adapter_weights.append(adapter_weight)
-
-                del lora_sd
-                mm.soft_empty_cache()
-            if adapter_list:
-                transformer.set_adapters(adapter_list, weights=adapter_weights)
-                if fuse:
-                    if model_weight_dtype not in [torch.float32, torch.float16, torch.bfloat16]:
-                        raise ValueError("Fusing LoRA doesn't work well with fp8 model weights. Please use a bf16 model file, or disable LoRA fusing.")
-                    lora_scale = 1
-                    transformer.fuse_lora(lora_scale=lora_scale)
-                    transformer.delete_adapters(adapter_list)
-
-            if quantization == "fp8_e4m3fn" or quantization == "fp8_e4m3fn_fast" or quantization == "fp8_e5m2":
-                params_to_keep = {"norm", "bias", "time_in", "vector_in", "guidance_in", "txt_in", "img_in"}
-                for name, param in transformer.named_parameters():
-                    # Make sure to not cast the LoRA weights to fp8.
-                    if not any(keyword in name for keyword in params_to_keep) and not 'lora' in name:
-                        param.data = param.data.to(after_lora_dtype)
-
-        if quantization == "fp8_e4m3fn_fast":
-            from .fp8_optimization import convert_fp8_linear
-            convert_fp8_linear(transformer, base_dtype, params_to_keep=params_to_keep)
-
-
-        DynamicSwapInstaller.install_model(transformer, device=device)
+            quantize_fn = policy.quantize_fn(transformer, fp8_scale)
+
+        print("Streaming model weights from disk and assigning them to device...")
+        load_state_dict_streaming(
+            transformer, sd, transformer_load_device,
+            dtype_fn=policy.dtype_fn(base_dtype, transformer),
+            quantize_fn=quantize_fn,
+        )
+
+        if is_gguf:
+            from .gguf_optimization import convert_gguf_linear
+            convert_gguf_linear(transformer, sd, base_dtype)
+        else:
+            policy.convert(transformer, base_dtype)
+
+        # after the fp8 conversion, so runtime LoRAs wrap the fp8 forward
+        from .fp8_optimization import load_fp8_scales
+        from .lora import LoraManager, open_base_source
+        load_fp8_scales(transformer, sd, base_dtype)
+        transformer.lora_manager = LoraManager(base_source=None if cached_model_path is not None or attached else open_base_source(sd),
+                                               compute_dtype=base_dtype, fp8_scale=fp8_scale)
+        # the pipe keeps its fused LoRAs, set_loras leaves the weights alone as long as they stay the same
+        transformer.lora_manager.assume_fused(transformer, baked_loras)
+        transformer.lora_manager.set_loras(transformer, lora, lora_rank)
+
+        if recipe is not None and cached_model_path is None:
+            from .model_cache import get_recipe_key, save_cached_model
+            save_cached_model(get_recipe_key(recipe), transformer, recipe)
+
+        if shared is not None:
+            shared_bytes = shared.publish(transformer)
+            log.info(f"{shared_bytes / 1024**3:.2f} GB of host weights shared with other processes")
+            if shared.source is not None:
+                sd = shared.source
+            if pinned_memory_gb > 0:
+                log.warning("pinned_memory_gb copies the shared weights into memory of this process only")
+
+        if disk_offload_gb > 0:
+            if pinned_memory_gb > 0:
+                log.warning("The disk offload tier pages weights into its own pinned cache, ignoring pinned_memory_gb")
+                pinned_memory_gb = 0.0
+            from .disk_offload import DiskOffloadTier
+            DiskOffloadTier.install(transformer, sd, int(disk_offload_gb * 1024**3))
+        del sd
+
+        PinnedHostPool.install(transformer, int(pinned_memory_gb * 1024**3))
+        if transfer_compression != "disabled" and disk_offload_gb > 0:
+            log.warning("Transfer compression keeps compact copies of the streamed weights in RAM, which disk offloading is meant to avoid, disabling it")
+            transfer_compression = "disabled"
+        TransferCodec.install(transformer, transfer_compression)
+        DynamicSwapInstaller.install_model(transformer, device=device, non_blocking=True,
+                                           weight_cache=WeightCache(int(swap_cache_gb * 1024**3)) if swap_cache_gb > 0 else None)
 
         if compile_args is not None:
             if compile_args["compile_single_blocks"]:
@@ -331,11 +450,48 @@ class LoadFramePackModel:
             #transformer = torch.compile(transformer, fullgraph=compile_args["fullgraph"], dynamic=compile_args["dynamic"], backend=compile_args["backend"], mode=compile_args["mode"])
 
         pipe = {
-            "transformer": transformer.eval(),
+            "transformer": model_registry.put(load_key, transformer.eval()),
             "dtype": base_dtype,
+            "quantization": quantization,
+            "loras": lora,
+            "lora_rank": lora_rank,
         }
         return (pipe, )
 
+class FramePackPreflight:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "model": ("FramePackMODEL",),
+                "width": ("INT", {"default": 640, "min": 64, "max": 4096, "step": 16}),
+                "height": ("INT", {"default": 640, "min": 64, "max": 4096, "step": 16}),
+                "latent_window_size": ("INT", {"default": 9, "min": 1, "max": 33, "step": 1}),
+                "cfg": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 30.0, "step": 0.01}),
+                "use_teacache": ("BOOLEAN", {"default": True}),
+                "gpu_memory_preservation": ("FLOAT", {"default": 6.0, "min": 0.0, "max": 128.0, "step": 0.1}),
+                "prefetch_blocks": ("INT", {"default": 2, "min": 0, "max": 16, "step": 1}),
+            },
+            "optional": {
+                "vram_gb": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 256.0, "step": 0.5, "tooltip": "Memory of the card to estimate for, 0 uses the current device"}),
+                "batched_cfg": ("BOOLEAN", {"default": True, "tooltip": "Whether the sampler runs the positive and negative prompt as one forward"}),
+            }
+        }
+
+    RETURN_TYPES = ("FramePackMODEL", "STRING",)
+    RETURN_NAMES = ("model", "report",)
+    FUNCTION = "process"
+    CATEGORY = "FramePackWrapper"
+    DESCRIPTION = "Estimates the peak activation memory, weight residency and step time of the sampler settings by tracing the transformer on the meta device, and recommends offload and quantization settings. Passes the model through, so it can sit between the loader and the sampler"
+
+    def process(self, model, width, height, latent_window_size, cfg, use_teacache, gpu_memory_preservation, prefetch_blocks, vram_gb=0.0, batched_cfg=True):
+        from .preflight import estimate, format_report
+        result = estimate(dict(model["transformer"].config), width, height, latent_window_size, cfg=cfg, use_teacache=use_teacache,
+                          gpu_memory_preservation=gpu_memory_preservation, vram_gb=vram_gb or None, base_dtype=model["dtype"],
+                          quantization=model.get("quantization", "disabled"), prefetch_blocks=prefetch_blocks, device=mm.get_torch_device(),
+                          batched_cfg=batched_cfg)
+        return (model, format_report(result), )
+
 class FramePackFindNearestBucket:
     @classmethod
     def INPUT_TYPES(s):
@@ -392,6 +548,9 @@ class FramePackSampler:
                 "start_embed_strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "Weighted average constant for image embed interpolation. If end image is not set, the embed's strength won't be affected"}),
                 "initial_samples": ("LATENT", {"tooltip": "init Latents to use for video2video"} ),
                 "denoise_strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "prefetch_blocks": ("INT", {"default": 2, "min": 0, "max": 16, "step": 1, "tooltip": "Number of offloaded transformer blocks kept on the GPU while their weights are copied ahead of use on a separate stream, 0 copies every weight when it is used"}),
+                "keep_model_loaded": ("BOOLEAN", {"default": True, "tooltip": "Keep the transformer on the GPU after sampling for the next job. It is offloaded after FRAMEPACK_IDLE_TIMEOUT seconds (default 300) without use, or when other models need the memory"}),
+                "batched_cfg": ("BOOLEAN", {"default": True, "tooltip": "With cfg other than 1, run the positive and negative prompt as one forward of batch size 2, so offloaded weights are streamed once per step instead of twice. Falls back to separate forwards when it runs out of memory"}),
             }
         }
 
@@ -401,7 +560,12 @@ class FramePackSampler:
     CATEGORY = "FramePackWrapper"
 
     def process(self, model, shift, positive, negative, latent_window_size, use_teacache, total_second_length, teacache_rel_l1_thresh, steps, cfg,
-                guidance_scale, seed, sampler, gpu_memory_preservation, start_latent=None, image_embeds=None, end_latent=None, end_image_embeds=None, embed_interpolation="linear", start_embed_strength=1.0, initial_samples=None, denoise_strength=1.0):
+                guidance_scale, seed, sampler, gpu_memory_preservation, start_latent=None, image_embeds=None, end_latent=None, end_image_embeds=None, embed_interpolation="linear", start_embed_strength=1.0, initial_samples=None, denoise_strength=1.0, prefetch_blocks=2, keep_model_loaded=True, batched_cfg=True):
+        from .residency import residency_manager
+        from .diffusers_helper.pipelines.k_diffusion_hunyuan import sample_hunyuan
+        from .diffusers_helper.models.hunyuan_video_packed import TransformerRunContext
+        from .diffusers_helper.utils import crop_or_pad_yield_mask
+
         total_latent_sections = (total_second_length * 30) / (latent_window_size * 4)
         total_latent_sections = int(max(round(total_latent_sections), 1))
         print("total_latent_sections: ", total_latent_sections)
@@ -412,9 +576,8 @@ class FramePackSampler:
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
 
-        mm.unload_all_models()
+        # the residency manager frees only the memory the transformer needs when it is loaded
         mm.cleanup_models()
-        mm.soft_empty_cache()
 
         if start_latent is not None:
             start_latent = start_latent["samples"] * vae_scaling_factor
@@ -473,131 +636,130 @@ class FramePackSampler:
         from latent_preview import prepare_callback
         callback = prepare_callback(patcher, steps)
 
-        move_model_to_device_with_memory_preservation(transformer, target_device=device, preserved_memory_gb=gpu_memory_preservation)
-
-        if total_latent_sections > 4:
-            # In theory the latent_paddings should follow the above sequence, but it seems that duplicating some
-            # items looks better than expanding it when total_latent_sections > 4
-            # One can try to remove below trick and just
-            # use `latent_paddings = list(reversed(range(total_latent_sections)))` to compare
-            latent_paddings = [3] + [2] * (total_latent_sections - 3) + [1, 0]
-            latent_paddings_list = latent_paddings.copy()
-
-        for i, latent_padding in enumerate(latent_paddings):
-            print(f"latent_padding: {latent_padding}")
-            is_last_section = latent_padding == 0
-            is_first_section = latent_padding == latent_paddings[0]
-            latent_padding_size = latent_padding * latent_window_size
-
-            if image_embeds is not None:
-                if embed_interpolation != "disabled":
-                    if embed_interpolation == "linear":
-                        if total_latent_sections <= 1:
-                            frac = 1.0  # Handle case with only one section
+        residency_manager.acquire(transformer, device, offload_device, preserved_memory_gb=gpu_memory_preservation, stream_buffers=prefetch_blocks, pipe=model)
+        try:
+            if total_latent_sections > 4:
+                # In theory the latent_paddings should follow the above sequence, but it seems that duplicating some
+                # items looks better than expanding it when total_latent_sections > 4
+                # One can try to remove below trick and just
+                # use `latent_paddings = list(reversed(range(total_latent_sections)))` to compare
+                latent_paddings = [3] + [2] * (total_latent_sections - 3) + [1, 0]
+                latent_paddings_list = latent_paddings.copy()
+
+            for i, latent_padding in enumerate(latent_paddings):
+                print(f"latent_padding: {latent_padding}")
+                is_last_section = latent_padding == 0
+                is_first_section = latent_padding == latent_paddings[0]
+                latent_padding_size = latent_padding * latent_window_size
+
+                if image_embeds is not None:
+                    if embed_interpolation != "disabled":
+                        if embed_interpolation == "linear":
+                            if total_latent_sections <= 1:
+                                frac = 1.0  # Handle case with only one section
+                            else:
+                                frac = 1 - i / (total_latent_sections - 1)  # going backwards
                         else:
-                            frac = 1 - i / (total_latent_sections - 1)  # going backwards
-                    else:
-                        frac = start_embed_strength if has_end_image else 1.0
+                            frac = start_embed_strength if has_end_image else 1.0
 
-                    image_encoder_last_hidden_state = start_image_encoder_last_hidden_state * frac + (1 - frac) * end_image_encoder_last_hidden_state
+                        image_encoder_last_hidden_state = start_image_encoder_last_hidden_state * frac + (1 - frac) * end_image_encoder_last_hidden_state
+                    else:
+                        image_encoder_last_hidden_state = start_image_encoder_last_hidden_state * start_embed_strength
                 else:
-                    image_encoder_last_hidden_state = start_image_encoder_last_hidden_state * start_embed_strength
-            else:
-                image_encoder_last_hidden_state = None
-
-            print(f'latent_padding_size = {latent_padding_size}, is_last_section = {is_last_section}, is_first_section = {is_first_section}')
+                    image_encoder_last_hidden_state = None
 
-            start_latent_frames = T  # 0 or 1
-            indices = torch.arange(0, sum([start_latent_frames, latent_padding_size, latent_window_size, 1, 2, 16])).unsqueeze(0)
-            clean_latent_indices_pre, blank_indices, latent_indices, clean_latent_indices_post, clean_latent_2x_indices, clean_latent_4x_indices = indices.split([start_latent_frames, latent_padding_size, latent_window_size, 1, 2, 16], dim=1)
-            clean_latent_indices = torch.cat([clean_latent_indices_pre, clean_latent_indices_post], dim=1)
+                print(f'latent_padding_size = {latent_padding_size}, is_last_section = {is_last_section}, is_first_section = {is_first_section}')
 
-            clean_latents_pre = start_latent.to(history_latents)
-            clean_latents_post, clean_latents_2x, clean_latents_4x = history_latents[:, :, :1 + 2 + 16, :, :].split([1, 2, 16], dim=2)
-            clean_latents = torch.cat([clean_latents_pre, clean_latents_post], dim=2)
+                start_latent_frames = T  # 0 or 1
+                indices = torch.arange(0, sum([start_latent_frames, latent_padding_size, latent_window_size, 1, 2, 16])).unsqueeze(0)
+                clean_latent_indices_pre, blank_indices, latent_indices, clean_latent_indices_post, clean_latent_2x_indices, clean_latent_4x_indices = indices.split([start_latent_frames, latent_padding_size, latent_window_size, 1, 2, 16], dim=1)
+                clean_latent_indices = torch.cat([clean_latent_indices_pre, clean_latent_indices_post], dim=1)
 
-            # Use end image latent for the first section if provided
-            if has_end_image and is_first_section:
-                clean_latents_post = end_latent.to(history_latents)
+                clean_latents_pre = start_latent.to(history_latents)
+                clean_latents_post, clean_latents_2x, clean_latents_4x = history_latents[:, :, :1 + 2 + 16, :, :].split([1, 2, 16], dim=2)
                 clean_latents = torch.cat([clean_latents_pre, clean_latents_post], dim=2)
 
-            #vid2vid WIP
+                # Use end image latent for the first section if provided
+                if has_end_image and is_first_section:
+                    clean_latents_post = end_latent.to(history_latents)
+                    clean_latents = torch.cat([clean_latents_pre, clean_latents_post], dim=2)
 
-            if initial_samples is not None:
-                total_length = initial_samples.shape[2]
+                #vid2vid WIP
 
-                # Get the max padding value for normalization
-                max_padding = max(latent_paddings_list)
+                if initial_samples is not None:
+                    total_length = initial_samples.shape[2]
 
-                if is_last_section:
-                    # Last section should capture the end of the sequence
-                    start_idx = max(0, total_length - latent_window_size)
-                else:
-                    # Calculate windows that distribute more evenly across the sequence
-                    # This normalizes the padding values to create appropriate spacing
-                    if max_padding > 0:  # Avoid division by zero
-                        progress = (max_padding - latent_padding) / max_padding
-                        start_idx = int(progress * max(0, total_length - latent_window_size))
-                    else:
-                        start_idx = 0
+                    # Get the max padding value for normalization
+                    max_padding = max(latent_paddings_list)
 
-                end_idx = min(start_idx + latent_window_size, total_length)
-                print(f"start_idx: {start_idx}, end_idx: {end_idx}, total_length: {total_length}")
-                input_init_latents = initial_samples[:, :, start_idx:end_idx, :, :].to(device)
-
-
-            if use_teacache:
-                transformer.initialize_teacache(enable_teacache=True, num_steps=steps, rel_l1_thresh=teacache_rel_l1_thresh)
-            else:
-                transformer.initialize_teacache(enable_teacache=False)
-
-            with torch.autocast(device_type=mm.get_autocast_device(device), dtype=base_dtype, enabled=True):
-                generated_latents = sample_hunyuan(
-                    transformer=transformer,
-                    sampler=sampler,
-                    initial_latent=input_init_latents if initial_samples is not None else None,
-                    strength=denoise_strength,
-                    width=W * 8,
-                    height=H * 8,
-                    frames=num_frames,
-                    real_guidance_scale=cfg,
-                    distilled_guidance_scale=guidance_scale,
-                    guidance_rescale=0,
-                    shift=shift if shift != 0 else None,
-                    num_inference_steps=steps,
-                    generator=rnd,
-                    prompt_embeds=llama_vec,
-                    prompt_embeds_mask=llama_attention_mask,
-                    prompt_poolers=clip_l_pooler,
-                    negative_prompt_embeds=llama_vec_n,
-                    negative_prompt_embeds_mask=llama_attention_mask_n,
-                    negative_prompt_poolers=clip_l_pooler_n,
-                    device=device,
-                    dtype=base_dtype,
-                    image_embeddings=image_encoder_last_hidden_state,
-                    latent_indices=latent_indices,
-                    clean_latents=clean_latents,
-                    clean_latent_indices=clean_latent_indices,
-                    clean_latents_2x=clean_latents_2x,
-                    clean_latent_2x_indices=clean_latent_2x_indices,
-                    clean_latents_4x=clean_latents_4x,
-                    clean_latent_4x_indices=clean_latent_4x_indices,
-                    callback=callback,
-                )
-
-            if is_last_section:
-                generated_latents = torch.cat([start_latent.to(generated_latents), generated_latents], dim=2)
+                    if is_last_section:
+                        # Last section should capture the end of the sequence
+                        start_idx = max(0, total_length - latent_window_size)
+                    else:
+                        # Calculate windows that distribute more evenly across the sequence
+                        # This normalizes the padding values to create appropriate spacing
+                        if max_padding > 0:  # Avoid division by zero
+                            progress = (max_padding - latent_padding) / max_padding
+                            start_idx = int(progress * max(0, total_length - latent_window_size))
+                        else:
+                            start_idx = 0
+
+                    end_idx = min(start_idx + latent_window_size, total_length)
+                    print(f"start_idx: {start_idx}, end_idx: {end_idx}, total_length: {total_length}")
+                    input_init_latents = initial_samples[:, :, start_idx:end_idx, :, :].to(device)
+
+
+                # per section state, the transformer itself is shared with every other run
+                run_context = TransformerRunContext(enable_teacache=use_teacache, num_steps=steps, rel_l1_thresh=teacache_rel_l1_thresh)
+
+                with torch.autocast(device_type=mm.get_autocast_device(device), dtype=base_dtype, enabled=True):
+                    generated_latents = sample_hunyuan(
+                        transformer=transformer,
+                        run_context=run_context,
+                        batched_cfg=batched_cfg,
+                        sampler=sampler,
+                        initial_latent=input_init_latents if initial_samples is not None else None,
+                        strength=denoise_strength,
+                        width=W * 8,
+                        height=H * 8,
+                        frames=num_frames,
+                        real_guidance_scale=cfg,
+                        distilled_guidance_scale=guidance_scale,
+                        guidance_rescale=0,
+                        shift=shift if shift != 0 else None,
+                        num_inference_steps=steps,
+                        generator=rnd,
+                        prompt_embeds=llama_vec,
+                        prompt_embeds_mask=llama_attention_mask,
+                        prompt_poolers=clip_l_pooler,
+                        negative_prompt_embeds=llama_vec_n,
+                        negative_prompt_embeds_mask=llama_attention_mask_n,
+                        negative_prompt_poolers=clip_l_pooler_n,
+                        device=device,
+                        dtype=base_dtype,
+                        image_embeddings=image_encoder_last_hidden_state,
+                        latent_indices=latent_indices,
+                        clean_latents=clean_latents,
+                        clean_latent_indices=clean_latent_indices,
+                        clean_latents_2x=clean_latents_2x,
+                        clean_latent_2x_indices=clean_latent_2x_indices,
+                        clean_latents_4x=clean_latents_4x,
+                        clean_latent_4x_indices=clean_latent_4x_indices,
+                        callback=callback,
+                    )
 
-            total_generated_latent_frames += int(generated_latents.shape[2])
-            history_latents = torch.cat([generated_latents.to(history_latents), history_latents], dim=2)
+                if is_last_section:
+                    generated_latents = torch.cat([start_latent.to(generated_latents), generated_latents], dim=2)
 
-            real_history_latents = history_latents[:, :, :total_generated_latent_frames, :, :]
+                total_generated_latent_frames += int(generated_latents.shape[2])
+                history_latents = torch.cat([generated_latents.to(history_latents), history_latents], dim=2)
 
-            if is_last_section:
-                break
+                real_history_latents = history_latents[:, :, :total_generated_latent_frames, :, :]
 
-        transformer.to(offload_device)
-        mm.soft_empty_cache()
+                if is_last_section:
+                    break
+        finally:
+            residency_manager.release(transformer, keep_resident=keep_model_loaded)
 
         return {"samples": real_history_latents / vae_scaling_factor},
 
@@ -626,6 +788,9 @@ class FramePackSingleFrameSampler:
                 "image_embeds": ("CLIP_VISION_OUTPUT",),
                 "initial_samples": ("LATENT", {"tooltip": "init Latents to use for image2image variation"}),
                 "denoise_strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "prefetch_blocks": ("INT", {"default": 2, "min": 0, "max": 16, "step": 1, "tooltip": "Number of offloaded transformer blocks kept on the GPU while their weights are copied ahead of use on a separate stream, 0 copies every weight when it is used"}),
+                "keep_model_loaded": ("BOOLEAN", {"default": True, "tooltip": "Keep the transformer on the GPU after sampling for the next job. It is offloaded after FRAMEPACK_IDLE_TIMEOUT seconds (default 300) without use, or when other models need the memory"}),
+                "batched_cfg": ("BOOLEAN", {"default": True, "tooltip": "With cfg other than 1, run the positive and negative prompt as one forward of batch size 2, so offloaded weights are streamed once per step instead of twice. Falls back to separate forwards when it runs out of memory"}),
                 "reference_latent": ("LATENT", {"tooltip": "Reference image latent for kisekaeichi mode"}),
                 "reference_image_embeds": ("CLIP_VISION_OUTPUT", {"tooltip": "Reference image CLIP embeds for kisekaeichi mode"}),
                 "target_index": ("INT", {"default": 1, "min": 0, "max": 8, "step": 1, "tooltip": "Target index for kisekaeichi (recommended: 1)"}),
@@ -643,16 +808,19 @@ class FramePackSingleFrameSampler:
 
     def process(self, model, shift, positive, negative, latent_window_size, use_teacache, teacache_rel_l1_thresh, steps, cfg, guidance_scale, seed,
         sampler, gpu_memory_preservation,start_latent=None, image_embeds=None, initial_samples=None, denoise_strength=1.0, use_kisekaeichi=False,
-        reference_latent=None, reference_image_embeds=None, target_index=1, history_index=13, input_mask=None, reference_mask=None):
+        reference_latent=None, reference_image_embeds=None, target_index=1, history_index=13, input_mask=None, reference_mask=None, prefetch_blocks=2, keep_model_loaded=True, batched_cfg=True):
+        from .residency import residency_manager
+        from .diffusers_helper.pipelines.k_diffusion_hunyuan import sample_hunyuan
+        from .diffusers_helper.models.hunyuan_video_packed import TransformerRunContext
+        from .diffusers_helper.utils import crop_or_pad_yield_mask
 
         transformer = model["transformer"]
         base_dtype = model["dtype"]
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
 
-        mm.unload_all_models()
+        # the residency manager frees only the memory the transformer needs when it is loaded
         mm.cleanup_models()
-        mm.soft_empty_cache()
 
         # Latent processing
         if start_latent is not None:
@@ -844,57 +1012,58 @@ class FramePackSingleFrameSampler:
 
         callback = prepare_callback(patcher, steps)
 
-        move_model_to_device_with_memory_preservation(
+        residency_manager.acquire(
             transformer,
-            target_device=device,
+            device,
+            offload_device,
             preserved_memory_gb=gpu_memory_preservation,
+            stream_buffers=prefetch_blocks,
+            pipe=model,
         )
-
-        if use_teacache:
-            transformer.initialize_teacache(
-                enable_teacache=True,
+        try:
+            run_context = TransformerRunContext(
+                enable_teacache=use_teacache,
                 num_steps=steps,
                 rel_l1_thresh=teacache_rel_l1_thresh,
             )
-        else:
-            transformer.initialize_teacache(enable_teacache=False)
-
-        with torch.autocast(device_type=mm.get_autocast_device(device), dtype=base_dtype, enabled=True):
-            generated_latents = sample_hunyuan(
-                transformer=transformer,
-                sampler=sampler,
-                initial_latent=input_init_latents,
-                strength=denoise_strength,
-                width=W * 8,
-                height=H * 8,
-                frames=sample_num_frames, 
-                real_guidance_scale=cfg,
-                distilled_guidance_scale=guidance_scale,
-                guidance_rescale=0,
-                shift=shift if shift != 0 else None,
-                num_inference_steps=steps,
-                generator=rnd,
-                prompt_embeds=llama_vec,
-                prompt_embeds_mask=llama_attention_mask,
-                prompt_poolers=clip_l_pooler,
-                negative_prompt_embeds=llama_vec_n,
-                negative_prompt_embeds_mask=llama_attention_mask_n,
-                negative_prompt_poolers=clip_l_pooler_n,
-                device=device,
-                dtype=base_dtype,
-                image_embeddings=image_encoder_last_hidden_state,
-                latent_indices=latent_indices,
-                clean_latents=clean_latents,
-                clean_latent_indices=clean_latent_indices,
-                clean_latents_2x=None,
-                clean_latent_2x_indices=None,
-                clean_latents_4x=None,
-                clean_latent_4x_indices=None,
-                callback=callback,
-            )
 
-        transformer.to(offload_device)
-        mm.soft_empty_cache()
+            with torch.autocast(device_type=mm.get_autocast_device(device), dtype=base_dtype, enabled=True):
+                generated_latents = sample_hunyuan(
+                    transformer=transformer,
+                    run_context=run_context,
+                    batched_cfg=batched_cfg,
+                    sampler=sampler,
+                    initial_latent=input_init_latents,
+                    strength=denoise_strength,
+                    width=W * 8,
+                    height=H * 8,
+                    frames=sample_num_frames, 
+                    real_guidance_scale=cfg,
+                    distilled_guidance_scale=guidance_scale,
+                    guidance_rescale=0,
+                    shift=shift if shift != 0 else None,
+                    num_inference_steps=steps,
+                    generator=rnd,
+                    prompt_embeds=llama_vec,
+                    prompt_embeds_mask=llama_attention_mask,
+                    prompt_poolers=clip_l_pooler,
+                    negative_prompt_embeds=llama_vec_n,
+                    negative_prompt_embeds_mask=llama_attention_mask_n,
+                    negative_prompt_poolers=clip_l_pooler_n,
+                    device=device,
+                    dtype=base_dtype,
+                    image_embeddings=image_encoder_last_hidden_state,
+                    latent_indices=latent_indices,
+                    clean_latents=clean_latents,
+                    clean_latent_indices=clean_latent_indices,
+                    clean_latents_2x=None,
+                    clean_latent_2x_indices=None,
+                    clean_latents_4x=None,
+                    clean_latent_4x_indices=None,
+                    callback=callback,
+                )
+        finally:
+            residency_manager.release(transformer, keep_resident=keep_model_loaded)
 
         return ({"samples": generated_latents / vae_scaling_factor},)
 
@@ -931,6 +1100,9 @@ class FramePackLoopSampler:
                 "start_embed_strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "Weighted average constant for image embed interpolation. If end image is not set, the embed's strength won't be affected"}),
                 "initial_samples": ("LATENT", {"tooltip": "init Latents to use for video2video"} ),
                 "denoise_strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                "prefetch_blocks": ("INT", {"default": 2, "min": 0, "max": 16, "step": 1, "tooltip": "Number of offloaded transformer blocks kept on the GPU while their weights are copied ahead of use on a separate stream, 0 copies every weight when it is used"}),
+                "keep_model_loaded": ("BOOLEAN", {"default": True, "tooltip": "Keep the transformer on the GPU after sampling for the next job. It is offloaded after FRAMEPACK_IDLE_TIMEOUT seconds (default 300) without use, or when other models need the memory"}),
+                "batched_cfg": ("BOOLEAN", {"default": True, "tooltip": "With cfg other than 1, run the positive and negative prompt as one forward of batch size 2, so offloaded weights are streamed once per step instead of twice. Falls back to separate forwards when it runs out of memory"}),
                 "connection_second_length": ("FLOAT", {"default": 1.0, "min": 1, "max": 5, "step": 0.1, "tooltip": "The connection length of the video in seconds."}),
             }
         }
@@ -941,7 +1113,12 @@ class FramePackLoopSampler:
     CATEGORY = "FramePackWrapper"
 
     def process(self, model, shift, positive, negative, latent_window_size, use_teacache, total_second_length, teacache_rel_l1_thresh, steps, cfg,
-                guidance_scale, seed, sampler, gpu_memory_preservation, start_latent=None, image_embeds=None, end_latent=None, end_image_embeds=None, embed_interpolation="linear", start_embed_strength=1.0, initial_samples=None, denoise_strength=1.0, connection_second_length=1.0):
+                guidance_scale, seed, sampler, gpu_memory_preservation, start_latent=None, image_embeds=None, end_latent=None, end_image_embeds=None, embed_interpolation="linear", start_embed_strength=1.0, initial_samples=None, denoise_strength=1.0, connection_second_length=1.0, prefetch_blocks=2, keep_model_loaded=True, batched_cfg=True):
+        from .residency import residency_manager
+        from .diffusers_helper.pipelines.k_diffusion_hunyuan import sample_hunyuan
+        from .diffusers_helper.models.hunyuan_video_packed import TransformerRunContext
+        from .diffusers_helper.utils import crop_or_pad_yield_mask
+
         main_latent_sections = (total_second_length * 30) / (latent_window_size * 4)
         main_latent_sections = int(max(round(main_latent_sections), 1))
         connection_latent_sections = (connection_second_length * 30) / (latent_window_size * 4)
@@ -956,9 +1133,8 @@ class FramePackLoopSampler:
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
 
-        mm.unload_all_models()
+        # the residency manager frees only the memory the transformer needs when it is loaded
         mm.cleanup_models()
-        mm.soft_empty_cache()
 
         if start_latent is not None:
             start_latent = start_latent["samples"] * vae_scaling_factor
@@ -1011,277 +1187,276 @@ class FramePackLoopSampler:
         from latent_preview import prepare_callback
         callback = prepare_callback(patcher, steps)
 
-        move_model_to_device_with_memory_preservation(transformer, target_device=device, preserved_memory_gb=gpu_memory_preservation)
-
-        ##C쐬
+        residency_manager.acquire(transformer, device, offload_device, preserved_memory_gb=gpu_memory_preservation, stream_buffers=prefetch_blocks, pipe=model)
+        try:
+            ##C쐬
 
-        history_latents = torch.zeros(size=(1, 16, 1 + 2 + 16, H, W), dtype=torch.float32).cpu()
+            history_latents = torch.zeros(size=(1, 16, 1 + 2 + 16, H, W), dtype=torch.float32).cpu()
 
-        total_generated_latent_frames = 0
+            total_generated_latent_frames = 0
 
-        latent_paddings_list = list(reversed(range(main_latent_sections)))
-        latent_paddings = latent_paddings_list.copy()  # Create a copy for iteration
+            latent_paddings_list = list(reversed(range(main_latent_sections)))
+            latent_paddings = latent_paddings_list.copy()  # Create a copy for iteration
 
-        if main_latent_sections > 4:
-            # In theory the latent_paddings should follow the above sequence, but it seems that duplicating some
-            # items looks better than expanding it when total_latent_sections > 4
-            # One can try to remove below trick and just
-            # use `latent_paddings = list(reversed(range(total_latent_sections)))` to compare
-            latent_paddings = [3] + [2] * (main_latent_sections - 3) + [1, 0]
-            latent_paddings_list = latent_paddings.copy()
+            if main_latent_sections > 4:
+                # In theory the latent_paddings should follow the above sequence, but it seems that duplicating some
+                # items looks better than expanding it when total_latent_sections > 4
+                # One can try to remove below trick and just
+                # use `latent_paddings = list(reversed(range(total_latent_sections)))` to compare
+                latent_paddings = [3] + [2] * (main_latent_sections - 3) + [1, 0]
+                latent_paddings_list = latent_paddings.copy()
 
-        for i, latent_padding in enumerate(latent_paddings):
-            print(f"latent_padding: {latent_padding}")
-            is_last_section = latent_padding == 0
-            is_first_section = latent_padding == latent_paddings[0]
-            latent_padding_init_size = int(padding_second_length * latent_window_size)
+            for i, latent_padding in enumerate(latent_paddings):
+                print(f"latent_padding: {latent_padding}")
+                is_last_section = latent_padding == 0
+                is_first_section = latent_padding == latent_paddings[0]
+                latent_padding_init_size = int(padding_second_length * latent_window_size)
 
-            latent_padding_size = (latent_padding * latent_window_size) + latent_padding_init_size
+                latent_padding_size = (latent_padding * latent_window_size) + latent_padding_init_size
 
 
-            if image_embeds is not None:
-                if embed_interpolation != "disabled":
-                    if embed_interpolation == "linear":
-                        if main_latent_sections <= 1:
-                            frac = 1.0  # Handle case with only one section
+                if image_embeds is not None:
+                    if embed_interpolation != "disabled":
+                        if embed_interpolation == "linear":
+                            if main_latent_sections <= 1:
+                                frac = 1.0  # Handle case with only one section
+                            else:
+                                frac = 1 - i / (main_latent_sections - 1)  # going backwards
                         else:
-                            frac = 1 - i / (main_latent_sections - 1)  # going backwards
-                    else:
-                        frac = start_embed_strength if has_end_image else 1.0
+                            frac = start_embed_strength if has_end_image else 1.0
 
-                    image_encoder_last_hidden_state = start_image_encoder_last_hidden_state * frac + (1 - frac) * end_image_encoder_last_hidden_state
+                        image_encoder_last_hidden_state = start_image_encoder_last_hidden_state * frac + (1 - frac) * end_image_encoder_last_hidden_state
+                    else:
+                        image_encoder_last_hidden_state = start_image_encoder_last_hidden_state * start_embed_strength
                 else:
-                    image_encoder_last_hidden_state = start_image_encoder_last_hidden_state * start_embed_strength
-            else:
-                image_encoder_last_hidden_state = None
+                    image_encoder_last_hidden_state = None
 
-            print(f'latent_padding_size = {latent_padding_size}, is_last_section = {is_last_section}, is_first_section = {is_first_section}')
+                print(f'latent_padding_size = {latent_padding_size}, is_last_section = {is_last_section}, is_first_section = {is_first_section}')
 
-            start_latent_frames = T  # 0 or 1
-            indices = torch.arange(0, sum([start_latent_frames, latent_padding_size, latent_window_size, 1, 2, 16])).unsqueeze(0)
-            clean_latent_indices_pre, blank_indices, latent_indices, clean_latent_indices_post, clean_latent_2x_indices, clean_latent_4x_indices = indices.split([start_latent_frames, latent_padding_size, latent_window_size, 1, 2, 16], dim=1)
-            clean_latent_indices = torch.cat([clean_latent_indices_pre, clean_latent_indices_post], dim=1)
-
-            clean_latents_pre = start_latent.to(history_latents)
-            clean_latents_post, clean_latents_2x, clean_latents_4x = history_latents[:, :, :1 + 2 + 16, :, :].split([1, 2, 16], dim=2)
-            clean_latents = torch.cat([clean_latents_pre, clean_latents_post], dim=2)
+                start_latent_frames = T  # 0 or 1
+                indices = torch.arange(0, sum([start_latent_frames, latent_padding_size, latent_window_size, 1, 2, 16])).unsqueeze(0)
+                clean_latent_indices_pre, blank_indices, latent_indices, clean_latent_indices_post, clean_latent_2x_indices, clean_latent_4x_indices = indices.split([start_latent_frames, latent_padding_size, latent_window_size, 1, 2, 16], dim=1)
+                clean_latent_indices = torch.cat([clean_latent_indices_pre, clean_latent_indices_post], dim=1)
 
-            # Use end image latent for the first section if provided
-            if has_end_image and is_first_section:
-                clean_latents_post = end_latent.to(history_latents)
+                clean_latents_pre = start_latent.to(history_latents)
+                clean_latents_post, clean_latents_2x, clean_latents_4x = history_latents[:, :, :1 + 2 + 16, :, :].split([1, 2, 16], dim=2)
                 clean_latents = torch.cat([clean_latents_pre, clean_latents_post], dim=2)
 
-            #vid2vid WIP
-
-            if initial_samples is not None:
-                total_length = initial_samples.shape[2]
+                # Use end image latent for the first section if provided
+                if has_end_image and is_first_section:
+                    clean_latents_post = end_latent.to(history_latents)
+                    clean_latents = torch.cat([clean_latents_pre, clean_latents_post], dim=2)
 
-                # Get the max padding value for normalization
-                max_padding = max(latent_paddings_list)
-
-                if is_last_section:
-                    # Last section should capture the end of the sequence
-                    start_idx = max(0, total_length - latent_window_size)
-                else:
-                    # Calculate windows that distribute more evenly across the sequence
-                    # This normalizes the padding values to create appropriate spacing
-                    if max_padding > 0:  # Avoid division by zero
-                        progress = (max_padding - latent_padding) / max_padding
-                        start_idx = int(progress * max(0, total_length - latent_window_size))
-                    else:
-                        start_idx = 0
-
-                end_idx = min(start_idx + latent_window_size, total_length)
-                print(f"start_idx: {start_idx}, end_idx: {end_idx}, total_length: {total_length}")
-                input_init_latents = initial_samples[:, :, start_idx:end_idx, :, :].to(device)
-
-
-            if use_teacache:
-                transformer.initialize_teacache(enable_teacache=True, num_steps=steps, rel_l1_thresh=teacache_rel_l1_thresh)
-            else:
-                transformer.initialize_teacache(enable_teacache=False)
-
-            with torch.autocast(device_type=mm.get_autocast_device(device), dtype=base_dtype, enabled=True):
-                generated_latents = sample_hunyuan(
-                    transformer=transformer,
-                    sampler=sampler,
-                    initial_latent=input_init_latents if initial_samples is not None else None,
-                    strength=denoise_strength,
-                    width=W * 8,
-                    height=H * 8,
-                    frames=num_frames,
-                    real_guidance_scale=cfg,
-                    distilled_guidance_scale=guidance_scale,
-                    guidance_rescale=0,
-                    shift=shift if shift != 0 else None,
-                    num_inference_steps=steps,
-                    generator=rnd,
-                    prompt_embeds=llama_vec,
-                    prompt_embeds_mask=llama_attention_mask,
-                    prompt_poolers=clip_l_pooler,
-                    negative_prompt_embeds=llama_vec_n,
-                    negative_prompt_embeds_mask=llama_attention_mask_n,
-                    negative_prompt_poolers=clip_l_pooler_n,
-                    device=device,
-                    dtype=base_dtype,
-                    image_embeddings=image_encoder_last_hidden_state,
-                    latent_indices=latent_indices,
-                    clean_latents=clean_latents,
-                    clean_latent_indices=clean_latent_indices,
-                    clean_latents_2x=clean_latents_2x,
-                    clean_latent_2x_indices=clean_latent_2x_indices,
-                    clean_latents_4x=clean_latents_4x,
-                    clean_latent_4x_indices=clean_latent_4x_indices,
-                    callback=callback,
-                )
+                #vid2vid WIP
 
-            #if is_last_section:
-            #    generated_latents = torch.cat([start_latent.to(generated_latents), generated_latents], dim=2)
+                if initial_samples is not None:
+                    total_length = initial_samples.shape[2]
 
-            total_generated_latent_frames += int(generated_latents.shape[2])
-            history_latents = torch.cat([generated_latents.to(history_latents), history_latents], dim=2)
+                    # Get the max padding value for normalization
+                    max_padding = max(latent_paddings_list)
 
-            real_history_latents = history_latents[:, :, :total_generated_latent_frames, :, :]
+                    if is_last_section:
+                        # Last section should capture the end of the sequence
+                        start_idx = max(0, total_length - latent_window_size)
+                    else:
+                        # Calculate windows that distribute more evenly across the sequence
+                        # This normalizes the padding values to create appropriate spacing
+                        if max_padding > 0:  # Avoid division by zero
+                            progress = (max_padding - latent_padding) / max_padding
+                            start_idx = int(progress * max(0, total_length - latent_window_size))
+                        else:
+                            start_idx = 0
+
+                    end_idx = min(start_idx + latent_window_size, total_length)
+                    print(f"start_idx: {start_idx}, end_idx: {end_idx}, total_length: {total_length}")
+                    input_init_latents = initial_samples[:, :, start_idx:end_idx, :, :].to(device)
+
+
+                # per section state, the transformer itself is shared with every other run
+                run_context = TransformerRunContext(enable_teacache=use_teacache, num_steps=steps, rel_l1_thresh=teacache_rel_l1_thresh)
+
+                with torch.autocast(device_type=mm.get_autocast_device(device), dtype=base_dtype, enabled=True):
+                    generated_latents = sample_hunyuan(
+                        transformer=transformer,
+                        run_context=run_context,
+                        batched_cfg=batched_cfg,
+                        sampler=sampler,
+                        initial_latent=input_init_latents if initial_samples is not None else None,
+                        strength=denoise_strength,
+                        width=W * 8,
+                        height=H * 8,
+                        frames=num_frames,
+                        real_guidance_scale=cfg,
+                        distilled_guidance_scale=guidance_scale,
+                        guidance_rescale=0,
+                        shift=shift if shift != 0 else None,
+                        num_inference_steps=steps,
+                        generator=rnd,
+                        prompt_embeds=llama_vec,
+                        prompt_embeds_mask=llama_attention_mask,
+                        prompt_poolers=clip_l_pooler,
+                        negative_prompt_embeds=llama_vec_n,
+                        negative_prompt_embeds_mask=llama_attention_mask_n,
+                        negative_prompt_poolers=clip_l_pooler_n,
+                        device=device,
+                        dtype=base_dtype,
+                        image_embeddings=image_encoder_last_hidden_state,
+                        latent_indices=latent_indices,
+                        clean_latents=clean_latents,
+                        clean_latent_indices=clean_latent_indices,
+                        clean_latents_2x=clean_latents_2x,
+                        clean_latent_2x_indices=clean_latent_2x_indices,
+                        clean_latents_4x=clean_latents_4x,
+                        clean_latent_4x_indices=clean_latent_4x_indices,
+                        callback=callback,
+                    )
+
+                #if is_last_section:
+                #    generated_latents = torch.cat([start_latent.to(generated_latents), generated_latents], dim=2)
+
+                total_generated_latent_frames += int(generated_latents.shape[2])
+                history_latents = torch.cat([generated_latents.to(history_latents), history_latents], dim=2)
+
+                real_history_latents = history_latents[:, :, :total_generated_latent_frames, :, :]
 
-            if is_last_section:
-                break
+                if is_last_section:
+                    break
 
-        ##RlNV쐬
+            ##RlNV쐬
 
-        #post_history_latents = torch.zeros(size=(1, 16, 1 + 2 + 16, H, W), dtype=torch.float32).cpu()
-        post_history_latents = history_latents[:, :, :total_generated_latent_frames, :, :]
+            #post_history_latents = torch.zeros(size=(1, 16, 1 + 2 + 16, H, W), dtype=torch.float32).cpu()
+            post_history_latents = history_latents[:, :, :total_generated_latent_frames, :, :]
 
-        post_total_generated_latent_frames = total_generated_latent_frames
+            post_total_generated_latent_frames = total_generated_latent_frames
 
-        latent_paddings_list = list(reversed(range(connection_latent_sections)))
-        latent_paddings = latent_paddings_list.copy()  # Create a copy for iteration
+            latent_paddings_list = list(reversed(range(connection_latent_sections)))
+            latent_paddings = latent_paddings_list.copy()  # Create a copy for iteration
 
-        if connection_latent_sections > 4:
-            # In theory the latent_paddings should follow the above sequence, but it seems that duplicating some
-            # items looks better than expanding it when total_latent_sections > 4
-            # One can try to remove below trick and just
-            # use `latent_paddings = list(reversed(range(total_latent_sections)))` to compare
-            latent_paddings = [3] + [2] * (connection_latent_sections - 3) + [1, 0]
-            latent_paddings_list = latent_paddings.copy()
-
-        if total_latent_sections > 2:
-            N = 16
-        elif total_latent_sections == 2:
-            N= 15
-        else:
-            N=6
+            if connection_latent_sections > 4:
+                # In theory the latent_paddings should follow the above sequence, but it seems that duplicating some
+                # items looks better than expanding it when total_latent_sections > 4
+                # One can try to remove below trick and just
+                # use `latent_paddings = list(reversed(range(total_latent_sections)))` to compare
+                latent_paddings = [3] + [2] * (connection_latent_sections - 3) + [1, 0]
+                latent_paddings_list = latent_paddings.copy()
 
-        for i, latent_padding in enumerate(latent_paddings):
-            print(f"latent_padding: {latent_padding}")
-            is_last_section = latent_padding == 0
-            is_first_section = latent_padding == latent_paddings[0]
-            latent_padding_size = latent_padding * latent_window_size
+            if total_latent_sections > 2:
+                N = 16
+            elif total_latent_sections == 2:
+                N= 15
+            else:
+                N=6
 
-            indices = torch.arange(0, sum([1,latent_padding_size, latent_window_size, 1, 2, N])).unsqueeze(0)
-            clean_latent_indices_pre, blank_indices, latent_indices, clean_latent_indices_post, clean_latent_2x_indices, clean_latent_4x_indices = indices.split([1,latent_padding_size, latent_window_size, 1, 2, N], dim=1)
-            clean_latent_indices = torch.cat([clean_latent_indices_pre, clean_latent_indices_post], dim=1)
-            clean_latent_2x_indices = torch.cat([clean_latent_2x_indices], dim=1)
-            clean_latent_4x_indices = torch.cat([clean_latent_4x_indices], dim=1)
+            for i, latent_padding in enumerate(latent_paddings):
+                print(f"latent_padding: {latent_padding}")
+                is_last_section = latent_padding == 0
+                is_first_section = latent_padding == latent_paddings[0]
+                latent_padding_size = latent_padding * latent_window_size
 
+                indices = torch.arange(0, sum([1,latent_padding_size, latent_window_size, 1, 2, N])).unsqueeze(0)
+                clean_latent_indices_pre, blank_indices, latent_indices, clean_latent_indices_post, clean_latent_2x_indices, clean_latent_4x_indices = indices.split([1,latent_padding_size, latent_window_size, 1, 2, N], dim=1)
+                clean_latent_indices = torch.cat([clean_latent_indices_pre, clean_latent_indices_post], dim=1)
+                clean_latent_2x_indices = torch.cat([clean_latent_2x_indices], dim=1)
+                clean_latent_4x_indices = torch.cat([clean_latent_4x_indices], dim=1)
 
-            clean_latents_pre  = post_history_latents[:, :, -1:, :, :]
-            clean_latents_post, clean_latents_2x, clean_latents_4x = post_history_latents[:, :, :1 + 2 + N, :, :].split([1, 2, N], dim=2)
 
-            clean_latents = torch.cat([clean_latents_pre, clean_latents_post], dim=2)
-            clean_latents_2x = torch.cat([clean_latents_2x], dim=2)
-            clean_latents_4x = torch.cat([clean_latents_4x], dim=2)
+                clean_latents_pre  = post_history_latents[:, :, -1:, :, :]
+                clean_latents_post, clean_latents_2x, clean_latents_4x = post_history_latents[:, :, :1 + 2 + N, :, :].split([1, 2, N], dim=2)
 
-            # Use end image latent for the first section if provided
-            if has_end_image and is_first_section:
-                clean_latents_post = end_latent.to(history_latents)
                 clean_latents = torch.cat([clean_latents_pre, clean_latents_post], dim=2)
+                clean_latents_2x = torch.cat([clean_latents_2x], dim=2)
+                clean_latents_4x = torch.cat([clean_latents_4x], dim=2)
 
-            #vid2vid WIP
+                # Use end image latent for the first section if provided
+                if has_end_image and is_first_section:
+                    clean_latents_post = end_latent.to(history_latents)
+                    clean_latents = torch.cat([clean_latents_pre, clean_latents_post], dim=2)
 
-            if initial_samples is not None:
-                total_length = initial_samples.shape[2]
+                #vid2vid WIP
 
-                # Get the max padding value for normalization
-                max_padding = max(latent_paddings_list)
+                if initial_samples is not None:
+                    total_length = initial_samples.shape[2]
 
-                if is_last_section:
-                    # Last section should capture the end of the sequence
-                    start_idx = max(0, total_length - latent_window_size)
-                else:
-                    # Calculate windows that distribute more evenly across the sequence
-                    # This normalizes the padding values to create appropriate spacing
-                    if max_padding > 0:  # Avoid division by zero
-                        progress = (max_padding - latent_padding) / max_padding
-                        start_idx = int(progress * max(0, total_length - latent_window_size))
-                    else:
-                        start_idx = 0
-
-                end_idx = min(start_idx + latent_window_size, total_length)
-                print(f"start_idx: {start_idx}, end_idx: {end_idx}, total_length: {total_length}")
-                input_init_latents = initial_samples[:, :, start_idx:end_idx, :, :].to(device)
-
-
-            if use_teacache:
-                transformer.initialize_teacache(enable_teacache=True, num_steps=steps, rel_l1_thresh=teacache_rel_l1_thresh)
-            else:
-                transformer.initialize_teacache(enable_teacache=False)
+                    # Get the max padding value for normalization
+                    max_padding = max(latent_paddings_list)
 
-            with torch.autocast(device_type=mm.get_autocast_device(device), dtype=base_dtype, enabled=True):
-                generated_latents = sample_hunyuan(
-                    transformer=transformer,
-                    sampler=sampler,
-                    initial_latent=input_init_latents if initial_samples is not None else None,
-                    strength=denoise_strength,
-                    width=W * 8,
-                    height=H * 8,
-                    frames=num_frames,
-                    real_guidance_scale=cfg,
-                    distilled_guidance_scale=guidance_scale,
-                    guidance_rescale=0,
-                    shift=shift if shift != 0 else None,
-                    num_inference_steps=steps,
-                    generator=rnd,
-                    prompt_embeds=llama_vec,
-                    prompt_embeds_mask=llama_attention_mask,
-                    prompt_poolers=clip_l_pooler,
-                    negative_prompt_embeds=llama_vec_n,
-                    negative_prompt_embeds_mask=llama_attention_mask_n,
-                    negative_prompt_poolers=clip_l_pooler_n,
-                    device=device,
-                    dtype=base_dtype,
-                    image_embeddings=image_encoder_last_hidden_state,
-                    latent_indices=latent_indices,
-                    clean_latents=clean_latents,
-                    clean_latent_indices=clean_latent_indices,
-                    clean_latents_2x=clean_latents_2x,
-                    clean_latent_2x_indices=clean_latent_2x_indices,
-                    clean_latents_4x=clean_latents_4x,
-                    clean_latent_4x_indices=clean_latent_4x_indices,
-                    callback=callback,
-                )
-
-            #if is_last_section:
-            #    generated_latents = torch.cat([start_latent.to(generated_latents), generated_latents], dim=2)
-
-            post_total_generated_latent_frames += int(generated_latents.shape[2])
-            post_history_latents = torch.cat([generated_latents.to(post_history_latents), post_history_latents], dim=2)
-
-            post_real_history_latents = post_history_latents[:, :, :post_total_generated_latent_frames, :, :]
-
-            if is_last_section:
-                break
+                    if is_last_section:
+                        # Last section should capture the end of the sequence
+                        start_idx = max(0, total_length - latent_window_size)
+                    else:
+                        # Calculate windows that distribute more evenly across the sequence
+                        # This normalizes the padding values to create appropriate spacing
+                        if max_padding > 0:  # Avoid division by zero
+                            progress = (max_padding - latent_padding) / max_padding
+                            start_idx = int(progress * max(0, total_length - latent_window_size))
+                        else:
+                            start_idx = 0
+
+                    end_idx = min(start_idx + latent_window_size, total_length)
+                    print(f"start_idx: {start_idx}, end_idx: {end_idx}, total_length: {total_length}")
+                    input_init_latents = initial_samples[:, :, start_idx:end_idx, :, :].to(device)
+
+
+                # per section state, the transformer itself is shared with every other run
+                run_context = TransformerRunContext(enable_teacache=use_teacache, num_steps=steps, rel_l1_thresh=teacache_rel_l1_thresh)
+
+                with torch.autocast(device_type=mm.get_autocast_device(device), dtype=base_dtype, enabled=True):
+                    generated_latents = sample_hunyuan(
+                        transformer=transformer,
+                        run_context=run_context,
+                        batched_cfg=batched_cfg,
+                        sampler=sampler,
+                        initial_latent=input_init_latents if initial_samples is not None else None,
+                        strength=denoise_strength,
+                        width=W * 8,
+                        height=H * 8,
+                        frames=num_frames,
+                        real_guidance_scale=cfg,
+                        distilled_guidance_scale=guidance_scale,
+                        guidance_rescale=0,
+                        shift=shift if shift != 0 else None,
+                        num_inference_steps=steps,
+                        generator=rnd,
+                        prompt_embeds=llama_vec,
+                        prompt_embeds_mask=llama_attention_mask,
+                        prompt_poolers=clip_l_pooler,
+                        negative_prompt_embeds=llama_vec_n,
+                        negative_prompt_embeds_mask=llama_attention_mask_n,
+                        negative_prompt_poolers=clip_l_pooler_n,
+                        device=device,
+                        dtype=base_dtype,
+                        image_embeddings=image_encoder_last_hidden_state,
+                        latent_indices=latent_indices,
+                        clean_latents=clean_latents,
+                        clean_latent_indices=clean_latent_indices,
+                        clean_latents_2x=clean_latents_2x,
+                        clean_latent_2x_indices=clean_latent_2x_indices,
+                        clean_latents_4x=clean_latents_4x,
+                        clean_latent_4x_indices=clean_latent_4x_indices,
+                        callback=callback,
+                    )
+
+                #if is_last_section:
+                #    generated_latents = torch.cat([start_latent.to(generated_latents), generated_latents], dim=2)
+
+                post_total_generated_latent_frames += int(generated_latents.shape[2])
+                post_history_latents = torch.cat([generated_latents.to(post_history_latents), post_history_latents], dim=2)
+
+                post_real_history_latents = post_history_latents[:, :, :post_total_generated_latent_frames, :, :]
 
-        #1[v쐬
-        connection_hisotry_latents = post_real_history_latents[:,:,:latent_window_size*connection_latent_sections,:,:]
-        main_history_latents = real_history_latents[:,:,:latent_window_size*total_latent_sections,:,:]
+                if is_last_section:
+                    break
 
-        final_latents = torch.cat([connection_hisotry_latents[:,:,-latent_window_size:,:,:],
-                                    main_history_latents,
-                                    connection_hisotry_latents,
-                                    main_history_latents[:,:,-latent_window_size:,:,:]],dim=2)
+            #1[v쐬
+            connection_hisotry_latents = post_real_history_latents[:,:,:latent_window_size*connection_latent_sections,:,:]
+            main_history_latents = real_history_latents[:,:,:latent_window_size*total_latent_sections,:,:]
 
-        transformer.to(offload_device)
-        mm.soft_empty_cache()
+            final_latents = torch.cat([connection_hisotry_latents[:,:,-latent_window_size:,:,:],
+                                        main_history_latents,
+                                        connection_hisotry_latents,
+                                        main_history_latents[:,:,-latent_window_size:,:,:]],dim=2)
+        finally:
+            residency_manager.release(transformer, keep_resident=keep_model_loaded)
 
         return {"samples": final_latents / vae_scaling_factor}, latent_window_size * 4 - 3, latent_window_size * 4
 
@@ -1317,6 +1492,8 @@ NODE_CLASS_MAPPINGS = {
     "FramePackSingleFrameSampler": FramePackSingleFrameSampler,
     "FramePackLoopSampler": FramePackLoopSampler,
     "SplitLoopFrames": SplitLoopFrames,
+    "FramePackPrecisionPolicy": FramePackPrecisionPolicy,
+    "FramePackPreflight": FramePackPreflight,
     }
 NODE_DISPLAY_NAME_MAPPINGS = {
     "DownloadAndLoadFramePackModel": "(Down)Load FramePackModel",
@@ -1328,5 +1505,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "FramePackSingleFrameSampler": "Single Frame Sampler",
     "FramePackLoopSampler": "FramePackLoopSampler",
     "SplitLoopFrames": "SplitLoopFrames",
+    "FramePackPrecisionPolicy": "Precision Policy",
+    "FramePackPreflight": "Pre-flight Estimate",
     }
 
@@ -0,0 +1,258 @@
+"""
+Per-layer precision policies.
+
+A policy is a list of rules, one per line, mapping parameter names to a precision scheme:
+
+    # first two and last two double blocks in bf16, proj_out in fp32, the rest fp8
+    transformer_blocks.[01] = bf16
+    transformer_blocks.1[89] = bf16
+    proj_out = fp32
+    * = fp8_scaled
+
+Patterns are globs matched against the parameter names (a pattern that matches a module also matches its
+parameters), or regular expressions (re.search) when prefixed with "re:". The first matching rule wins.
+Parameters no rule matches fall back to the loader's quantization setting. The usual exceptions (norms,
+biases, embedders) are kept in base_precision ahead of any rule, and quantization schemes only apply to
+Linear weights, everything else a quantizing rule matches (e.g. the Conv3d patch embedders) stays in base_precision.
+"""
+import re
+import fnmatch
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .utils import log
+from .quantization import QUANTIZATION_MODES, PARAMS_TO_KEEP, get_weight_dtype, get_quantize_fn, convert_quantized_linear
+
+CAST_DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+# "base" (or "disabled") keeps a parameter in base_precision
+SCHEMES = ["base"] + list(CAST_DTYPES) + [m for m in QUANTIZATION_MODES if m != "disabled"]
+
+
+def cast_linear_forward(cls, dtype, input):
+    """Linear whose weight is kept in a different dtype than the compute dtype, e.g. an fp32 proj_out under bf16 autocast."""
+    with torch.autocast(device_type=input.device.type, enabled=False):
+        bias = cls.bias.to(dtype) if cls.bias is not None else None
+        return F.linear(input.to(dtype), cls.weight.to(dtype), bias).to(input.dtype)
+
+
+def get_scheme_dtype(scheme, base_dtype):
+    if scheme in CAST_DTYPES:
+        return CAST_DTYPES[scheme]
+    return get_weight_dtype(scheme, base_dtype)
+
+
+def convert_linear(module, scheme, base_dtype):
+    """Installs the forward of a scheme on a single Linear."""
+    if scheme in CAST_DTYPES:
+        if CAST_DTYPES[scheme] != base_dtype:
+            module.original_forward = module.forward
+            module.forward = lambda input, m=module, dtype=CAST_DTYPES[scheme]: cast_linear_forward(m, dtype, input)
+    else:
+        convert_quantized_linear(module, scheme, base_dtype, params_to_keep=())
+
+
+class PrecisionPolicy:
+    def __init__(self, rules=()):
+        self.rules = []
+        for pattern, scheme in rules:
+            scheme = "base" if scheme == "disabled" else scheme
+            if scheme not in SCHEMES:
+                raise ValueError(f"Unknown precision scheme '{scheme}' for '{pattern}', expected one of {SCHEMES}")
+            if pattern.startswith("re:"):
+                regex = re.compile(pattern[3:])
+                match = regex.search
+            else:
+                match = lambda name, pattern=pattern: fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(name, f"{pattern}.*")
+            self.rules.append((pattern, scheme, match))
+
+    @classmethod
+    def parse(cls, text):
+        """Parses `pattern = scheme` lines (":" works as well), # starts a comment."""
+        rules = []
+        for line_number, line in enumerate(text.splitlines(), 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            separator = "=" if "=" in line else ":"
+            pattern, _, scheme = line.rpartition(separator)
+            if not pattern.strip():
+                raise ValueError(f"Precision policy line {line_number}: expected 'pattern = scheme', got '{line}'")
+            rules.append((pattern.strip(), scheme.strip()))
+        return cls(rules)
+
+    def to_text(self):
+        return "\n".join(f"{pattern} = {scheme}" for pattern, scheme, _ in self.rules)
+
+    def with_defaults(self, quantization, params_to_keep=PARAMS_TO_KEEP):
+        """This policy between the kept parameters, which a catch-all rule must not reach, and the quantization setting."""
+        keep = [(f"*{keyword}*", "base") for keyword in sorted(params_to_keep)]
+        return PrecisionPolicy(keep + [(pattern, scheme) for pattern, scheme, _ in self.rules] + [("*", quantization)])
+
+    def scheme_for(self, name):
+        for _, scheme, match in self.rules:
+            if match(name):
+                return scheme
+        return "base"
+
+    def get_dtype(self, name, base_dtype):
+        return get_scheme_dtype(self.scheme_for(name), base_dtype)
+
+    def scheme_fn(self, model=None):
+        """scheme_for limited to what a scheme can apply to in `model`: quantization only to Linear weights."""
+        if model is None:
+            return self.scheme_for
+        linear_weights = {f"{name}.weight" for name, module in model.named_modules() if isinstance(module, nn.Linear)}
+
+        def scheme_fn(name):
+            scheme = self.scheme_for(name)
+            return scheme if scheme == "base" or scheme in CAST_DTYPES or name in linear_weights else "base"
+        return scheme_fn
+
+    def dtype_fn(self, base_dtype, model=None):
+        scheme_fn = self.scheme_fn(model)
+        return lambda name: get_scheme_dtype(scheme_fn(name), base_dtype)
+
+    def quantize_fn(self, model, fp8_scale="per_tensor"):
+        """quantize_fn for load_state_dict_streaming that quantizes every weight with the scheme of its rule."""
+        quantize_fns = {}
+        for scheme in {self.scheme_for(f"{name}.weight") for name, module in model.named_modules() if isinstance(module, nn.Linear)}:
+            quantize_fn = get_quantize_fn(model, scheme, fp8_scale, params_to_keep=())
+            if quantize_fn is not None:
+                quantize_fns[scheme] = quantize_fn
+        if not quantize_fns:
+            return None
+
+        def quantize_fn(name, tensor):
+            quantize_fn = quantize_fns.get(self.scheme_for(name))
+            return quantize_fn(name, tensor) if quantize_fn is not None else None
+        return quantize_fn
+
+    def convert(self, model, base_dtype):
+        """Installs the Linear forwards of each layer's scheme, the counterpart of convert_quantized_linear."""
+        counts = {}
+        for name, module in model.named_modules():
+            if not isinstance(module, nn.Linear):
+                continue
+            scheme = self.scheme_for(f"{name}.weight")
+            counts[scheme] = counts.get(scheme, 0) + 1
+            convert_linear(module, scheme, base_dtype)
+        log.info(f"Precision policy: {', '.join(f'{count} {scheme}' for scheme, count in sorted(counts.items()))} Linear layers")
+
+
+def get_policy(quantization, precision_policy=None, params_to_keep=PARAMS_TO_KEEP):
+    """The policy the loaders use: the user's rules (text or PrecisionPolicy), then the quantization setting."""
+    if isinstance(precision_policy, str):
+        precision_policy = PrecisionPolicy.parse(precision_policy)
+    return (precision_policy or PrecisionPolicy()).with_defaults(quantization, params_to_keep)
+
+
+def get_block_names(model):
+    """The units a policy is tuned in: every transformer block, and each other top-level module with Linear layers."""
+    names = []
+    for child_name, child in model.named_children():
+        if isinstance(child, nn.ModuleList):
+            names.extend(f"{child_name}.{i}" for i in range(len(child)))
+        elif any(isinstance(m, nn.Linear) for m in child.modules()):
+            names.append(child_name)
+    return names
+
+
+def _stored_bytes(param, dtype, scheme):
+    size = param.nelement() * torch.empty((), dtype=dtype).element_size()
+    if param.dim() == 2 and (scheme == "fp8_scaled" or scheme.startswith("int8")):
+        size += param.shape[0] * 4  # scale_weight, per channel at most
+    return size
+
+
+def get_block_bytes(model, policy, base_dtype):
+    """{block: bytes its parameters take when stored with `policy`}"""
+    sizes = {}
+    scheme_fn = policy.scheme_fn(model)
+    for block in get_block_names(model):
+        module = model.get_submodule(block)
+        sizes[block] = sum(_stored_bytes(p, get_scheme_dtype(scheme_fn(f"{block}.{name}"), base_dtype), scheme_fn(f"{block}.{name}"))
+                           for name, p in module.named_parameters())
+    return sizes
+
+
+def get_model_bytes(model, policy, base_dtype):
+    scheme_fn = policy.scheme_fn(model)
+    return sum(_stored_bytes(p, get_scheme_dtype(scheme_fn(name), base_dtype), scheme_fn(name)) for name, p in model.named_parameters())
+
+
+def _quantize_block(model, block, scheme, base_dtype, fp8_scale, params_to_keep):
+    """Quantizes the Linear layers of one block in place, returns what is needed to undo it."""
+    quantize_fn = get_quantize_fn(model, scheme, fp8_scale, params_to_keep=params_to_keep)
+    dtype = get_scheme_dtype(scheme, base_dtype)
+    saved = []
+    for name, module in model.get_submodule(block).named_modules():
+        full_name = f"{block}.{name}" if name else block
+        if not isinstance(module, nn.Linear) or any(keyword in full_name for keyword in params_to_keep):
+            continue
+        weight = module._parameters["weight"]
+        saved.append((module, weight))
+        result = quantize_fn(f"{full_name}.weight", weight.data) if quantize_fn is not None else None
+        value, buffers = result if result is not None else (weight.data.to(dtype), {})
+        module._parameters["weight"] = nn.Parameter(value.to(weight.device), requires_grad=False)
+        for buffer_name, buffer in buffers.items():
+            module.register_buffer(buffer_name, buffer.to(weight.device), persistent=False)
+        convert_linear(module, scheme, base_dtype)
+    return saved
+
+
+def _restore_block(saved):
+    for module, weight in saved:
+        module._parameters["weight"] = weight
+        module._buffers.pop("scale_weight", None)
+        module.__dict__.pop("forward", None)
+        module.__dict__.pop("original_forward", None)
+        module.__dict__.pop("fp8_weight_cache", None)
+
+
+def block_sensitivity(model, forward_inputs, scheme, base_dtype, fp8_scale="per_tensor", params_to_keep=PARAMS_TO_KEEP, blocks=None):
+    """
+    Quantizes one block at a time to `scheme` and measures the relative error of the transformer output
+    against the unquantized model. `model` has to be loaded in base precision, every block is restored
+    after it was measured. Run it under the same autocast as the samplers. Returns {block: error}, most
+    sensitive first.
+    """
+    def forward():
+        with torch.no_grad():
+            return model(**forward_inputs)[0].float()
+
+    reference = forward()
+    errors = {}
+    for block in blocks or get_block_names(model):
+        saved = _quantize_block(model, block, scheme, base_dtype, fp8_scale, params_to_keep)
+        try:
+            out = forward()
+        finally:
+            _restore_block(saved)
+        errors[block] = ((out - reference).norm() / reference.norm().clamp(min=1e-12)).item()
+        log.info(f"{block}: {errors[block]:.5f}")
+    return dict(sorted(errors.items(), key=lambda item: item[1], reverse=True))
+
+
+def policy_for_budget(model, sensitivity, budget_bytes, scheme, base_dtype, high_scheme="base", params_to_keep=PARAMS_TO_KEEP):
+    """
+    Greedy policy for a memory budget: every block starts out quantized to `scheme`, then the most sensitive
+    blocks (by block_sensitivity) are kept in `high_scheme` for as long as the model still fits in budget_bytes.
+    """
+    low_sizes = get_block_bytes(model, get_policy(scheme, params_to_keep=params_to_keep), base_dtype)
+    high_sizes = get_block_bytes(model, get_policy(high_scheme, params_to_keep=params_to_keep), base_dtype)
+    total = get_model_bytes(model, get_policy(scheme, params_to_keep=params_to_keep), base_dtype)
+    if total > budget_bytes:
+        log.warning(f"The model takes {total / 1024**3:.2f} GB even with every block in {scheme}, more than the {budget_bytes / 1024**3:.2f} GB budget")
+
+    rules = []
+    for block in sensitivity:
+        cost = high_sizes[block] - low_sizes[block]
+        if total + cost <= budget_bytes:
+            rules.append((block, high_scheme))
+            total += cost
+    # keep the generated rules in model order
+    order = {block: i for i, block in enumerate(get_block_names(model))}
+    rules.sort(key=lambda rule: order[rule[0]])
+    return PrecisionPolicy(rules).with_defaults(scheme, params_to_keep), total
@@ -0,0 +1,264 @@
+"""
+Pre-flight estimates for the samplers: peak activation memory, weight residency and step time of a
+set of sampler settings, without running the model.
+
+The transformer is rebuilt on the meta device and one forward is traced with the token layout the
+samplers use: the latent window, the 1x/2x/4x clean latents, the text and the image tokens. Every tensor
+created during the trace is counted while it is alive, which gives the peak activation memory. Attention
+is counted as the fused kernels run it, without the attention matrix. Step time is the traced FLOPs at the
+measured matmul throughput of the device, against the time to stream the weights that don't fit.
+"""
+import math
+import time
+import weakref
+
+import torch
+import torch.nn.functional as F
+from torch.overrides import TorchFunctionMode
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from .utils import log
+
+GB = 1024 ** 3
+# prompts are cropped or padded to this many tokens
+TEXT_TOKENS = 512
+# last_hidden_state of the SigLIP image encoder
+IMAGE_TOKENS = 729
+QUANTIZATION_CANDIDATES = ["disabled", "fp8_scaled", "int8_weight_only"]
+
+
+class _MetaTracer(TorchDispatchMode):
+    """Counts live and peak bytes and matmul/conv FLOPs of a meta device trace, and answers .item() with `scalar`."""
+    def __init__(self, scalar):
+        super().__init__()
+        self.scalar = scalar
+        self.live = 0
+        self.peak = 0
+        self.flops = 0
+
+    def _free(self, nbytes):
+        self.live -= nbytes
+
+    def _count_flops(self, func, args, out):
+        aten = torch.ops.aten
+        if func in (aten.mm.default, aten.bmm.default):
+            self.flops += 2 * out.nelement() * args[0].shape[-1]
+        elif func in (aten.addmm.default, aten.baddbmm.default):
+            self.flops += 2 * out.nelement() * args[1].shape[-1]
+        elif func is aten.convolution.default:
+            weight = args[1]
+            self.flops += 2 * out.nelement() * weight[0].nelement()
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func is torch.ops.aten._local_scalar_dense.default:
+            return self.scalar
+        out = func(*args, **kwargs)
+        self._count_flops(func, args, out)
+        returns = func._schema.returns
+        for i, t in enumerate(out if isinstance(out, (tuple, list)) else (out, )):
+            # views and in-place results don't allocate
+            if isinstance(t, torch.Tensor) and (i >= len(returns) or returns[i].alias_info is None):
+                nbytes = t.nelement() * t.element_size()
+                self.live += nbytes
+                self.peak = max(self.peak, self.live)
+                weakref.finalize(t, self._free, nbytes)
+        return out
+
+
+class _FusedAttention(TorchFunctionMode):
+    """Stands in for scaled_dot_product_attention like a fused kernel: only the output is allocated."""
+    def __init__(self):
+        super().__init__()
+        self.flops = 0
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func is F.scaled_dot_product_attention:
+            q, k, v = args[:3]
+            self.flops += 4 * q.shape[0] * q.shape[1] * q.shape[2] * k.shape[2] * q.shape[3]
+            return q.new_empty((*q.shape[:-1], v.shape[-1]))
+        return func(*args, **kwargs)
+
+
+def get_token_counts(width, height, latent_window_size, text_tokens=TEXT_TOKENS, image_tokens=IMAGE_TOKENS):
+    """Tokens of one transformer forward of FramePackSampler, by kind."""
+    h, w = height // 8, width // 8
+    return {
+        "window": latent_window_size * (h // 2) * (w // 2),
+        "clean_1x": 2 * (h // 2) * (w // 2),
+        "clean_2x": math.ceil(h / 4) * math.ceil(w / 4),
+        "clean_4x": 4 * math.ceil(h / 8) * math.ceil(w / 8),
+        "text": text_tokens,
+        "image": image_tokens,
+    }
+
+
+def build_meta_transformer(config, dtype):
+    from .diffusers_helper.models.hunyuan_video_packed import HunyuanVideoTransformer3DModel
+    with torch.device("meta"):
+        model = HunyuanVideoTransformer3DModel(**{k: v for k, v in config.items() if not k.startswith("_")})
+    return model.to(dtype).eval()
+
+
+def trace_forward(model, width, height, latent_window_size, use_teacache=True, text_tokens=TEXT_TOKENS, image_tokens=IMAGE_TOKENS):
+    """Traces one forward of a meta device transformer. Returns (peak activation bytes, FLOPs)."""
+    dtype = next(model.parameters()).dtype
+    config = model.config
+    h, w = height // 8, width // 8
+    from .diffusers_helper.models.hunyuan_video_packed import TransformerRunContext
+    run_context = TransformerRunContext(enable_teacache=use_teacache, num_steps=2)
+
+    tracer = _MetaTracer(scalar=text_tokens + image_tokens)
+    attention = _FusedAttention()
+    with torch.no_grad(), tracer, attention:
+        meta = lambda *shape, dtype=dtype: torch.empty(shape, dtype=dtype, device="meta")
+        indices = torch.arange(0, 1 + latent_window_size + 1 + 2 + 16, device="meta").unsqueeze(0)
+        clean_latent_indices_pre, latent_indices, clean_latent_indices_post, clean_latent_2x_indices, clean_latent_4x_indices = \
+            indices.split([1, latent_window_size, 1, 2, 16], dim=1)
+        model(
+            hidden_states=meta(1, config["in_channels"], latent_window_size, h, w),
+            timestep=meta(1, dtype=torch.float32),
+            encoder_hidden_states=meta(1, text_tokens, config["text_embed_dim"]),
+            encoder_attention_mask=torch.ones((1, text_tokens), dtype=torch.int64, device="meta"),
+            pooled_projections=meta(1, config["pooled_projection_dim"]),
+            guidance=meta(1),
+            latent_indices=latent_indices,
+            clean_latents=meta(1, config["in_channels"], 2, h, w),
+            clean_latent_indices=torch.cat([clean_latent_indices_pre, clean_latent_indices_post], dim=1),
+            clean_latents_2x=meta(1, config["in_channels"], 2, h, w),
+            clean_latent_2x_indices=clean_latent_2x_indices,
+            clean_latents_4x=meta(1, config["in_channels"], 16, h, w),
+            clean_latent_4x_indices=clean_latent_4x_indices,
+            image_embeddings=meta(1, image_tokens, config["image_proj_dim"]),
+            return_dict=False,
+            run_context=run_context,
+        )
+        peak = tracer.peak
+    return peak, tracer.flops + attention.flops
+
+
+def measure_device(device, dtype=torch.bfloat16):
+    """Measured matmul throughput (FLOP/s) and host to device bandwidth (bytes/s, None on the CPU) of a device."""
+    size = 4096 if device.type == "cuda" else 1024
+    a = torch.randn(size, size, device=device, dtype=dtype)
+    b = torch.randn(size, size, device=device, dtype=dtype)
+    sync = torch.cuda.synchronize if device.type == "cuda" else (lambda: None)
+    a @ b
+    sync()
+    start = time.perf_counter()
+    for _ in range(5):
+        a @ b
+    sync()
+    flops_per_s = 5 * 2 * size ** 3 / (time.perf_counter() - start)
+
+    bandwidth = None
+    if device.type == "cuda":
+        host = torch.empty(256 * 1024 ** 2, dtype=torch.uint8, pin_memory=True)
+        host.to(device, non_blocking=True)
+        sync()
+        start = time.perf_counter()
+        for _ in range(3):
+            host.to(device, non_blocking=True)
+        sync()
+        bandwidth = 3 * host.nelement() / (time.perf_counter() - start)
+    return flops_per_s, bandwidth
+
+
+def estimate(config, width, height, latent_window_size, cfg=1.0, use_teacache=True, gpu_memory_preservation=6.0,
+             vram_gb=None, base_dtype=torch.bfloat16, quantization="disabled", prefetch_blocks=2, device=None,
+             flops_per_s=None, bandwidth=None, text_tokens=TEXT_TOKENS, batched_cfg=True):
+    """
+    Estimates a sampler run and recommends settings. vram_gb defaults to the total memory of the device,
+    flops_per_s and bandwidth to what measure_device measures on it. Quantization only changes the weight
+    sizes here, the matmuls are assumed to run at the same speed. With batched_cfg (and cfg other than 1)
+    a step is one forward of batch size 2, twice the activations and compute of the traced one.
+    """
+    from .precision_policy import get_policy, get_model_bytes
+    from .diffusers_helper.memory import plan_residency
+
+    device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if vram_gb is None:
+        vram_gb = torch.cuda.get_device_properties(device).total_memory / GB if device.type == "cuda" else 0.0
+    if flops_per_s is None or (bandwidth is None and device.type == "cuda"):
+        measured_flops, measured_bandwidth = measure_device(device, base_dtype)
+        flops_per_s = flops_per_s or measured_flops
+        bandwidth = bandwidth or measured_bandwidth
+
+    model = build_meta_transformer(config, base_dtype)
+    peak, flops = trace_forward(model, width, height, latent_window_size, use_teacache, text_tokens)
+    forwards_per_step = 1 if math.isclose(cfg, 1.0) else 2
+    if batched_cfg and forwards_per_step == 2:
+        peak, flops, forwards_per_step = 2 * peak, 2 * flops, 1
+    compute_s = flops / flops_per_s
+
+    # the activations need the memory the sampler preserves, the weights get the rest
+    weight_budget = max(int((vram_gb - max(gpu_memory_preservation, peak / GB)) * GB), 0)
+    candidates = {}
+    for q in dict.fromkeys([quantization] + QUANTIZATION_CANDIDATES):
+        policy = get_policy(q)
+        weight_bytes = get_model_bytes(model, policy, base_dtype)
+        # plan with the quantized sizes: a meta copy of the model in the weight dtypes
+        sized = build_meta_transformer(config, base_dtype)
+        dtype_fn = policy.dtype_fn(base_dtype, sized)
+        for name, p in sized.named_parameters():
+            p.data = p.data.to(dtype_fn(name))
+        plan = plan_residency(sized, weight_budget, stream_buffers=prefetch_blocks)
+        transfer_s = plan.streamed_bytes / bandwidth if bandwidth else 0.0
+        fits = plan.resident_bytes + plan.reserved_bytes <= weight_budget
+        candidates[q] = {
+            "weights_gb": weight_bytes / GB,
+            "resident_gb": plan.resident_bytes / GB,
+            "streamed_gb": plan.streamed_bytes / GB,
+            "streamed_blocks": len(plan.streamed),
+            "fits": fits,
+            # streamed blocks are prefetched behind compute, a forward takes the longer of the two
+            "step_s": forwards_per_step * max(compute_s, transfer_s),
+        }
+
+    recommendations = []
+    if gpu_memory_preservation * GB < peak:
+        recommendations.append(f"gpu_memory_preservation {gpu_memory_preservation:.1f} GB is below the peak activation memory of "
+                               f"{peak / GB:.2f} GB, raise it to at least {math.ceil(peak / GB * 1.1 * 10) / 10:.1f} GB")
+    fitting = {q: c for q, c in candidates.items() if c["fits"]}
+    if not fitting:
+        recommendations.append(f"Even fully streamed the weights don't fit next to the activations in {vram_gb:.1f} GB, "
+                               f"lower latent_window_size or the resolution")
+    else:
+        # the fastest, and among equally fast ones the closest to full precision
+        best = min(fitting, key=lambda q: (round(fitting[q]["step_s"], 2), QUANTIZATION_CANDIDATES.index(q) if q in QUANTIZATION_CANDIDATES else -1))
+        if best != quantization:
+            recommendations.append(f"quantization {best}: {fitting[best]['step_s']:.2f} s/step instead of "
+                                   f"{candidates[quantization]['step_s']:.2f} s/step with {quantization}")
+        if fitting[best]["streamed_blocks"] > 0 and prefetch_blocks == 0:
+            recommendations.append("prefetch_blocks 2 or more, to stream the offloaded blocks behind compute")
+
+    return {
+        "tokens": get_token_counts(width, height, latent_window_size, text_tokens),
+        "peak_activation_gb": peak / GB,
+        "forward_tflops": flops / 1e12,
+        "forwards_per_step": forwards_per_step,
+        "compute_s_per_forward": compute_s,
+        "device_tflops": flops_per_s / 1e12,
+        "bandwidth_gb_s": bandwidth / GB if bandwidth else None,
+        "vram_gb": vram_gb,
+        "weight_budget_gb": weight_budget / GB,
+        "quantization": candidates,
+        "recommendations": recommendations,
+    }
+
+
+def format_report(result):
+    lines = [
+        f"Tokens per forward: {sum(result['tokens'].values())} ({', '.join(f'{k} {v}' for k, v in result['tokens'].items())})",
+        f"Peak activation memory: {result['peak_activation_gb']:.2f} GB",
+        f"Compute: {result['forward_tflops']:.1f} TFLOP per forward, {result['forwards_per_step']} forward(s) per step at {result['device_tflops']:.1f} TFLOP/s",
+        f"Weight budget: {result['weight_budget_gb']:.2f} of {result['vram_gb']:.1f} GB",
+    ]
+    for q, c in result["quantization"].items():
+        lines.append(f"  {q}: {c['weights_gb']:.2f} GB weights, {c['resident_gb']:.2f} GB resident, {c['streamed_gb']:.2f} GB streamed, "
+                     f"{'~' + format(c['step_s'], '.2f') + ' s/step' if c['fits'] else 'does not fit'}")
+    lines += [f"Recommendation: {r}" for r in result["recommendations"]] or ["Recommendation: the current settings fit"]
+    report = "\n".join(lines)
+    log.info(f"Pre-flight estimate:\n{report}")
+    return report
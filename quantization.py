@@ -0,0 +1,35 @@
+import torch
+
+QUANTIZATION_MODES = ['disabled', 'fp8_e4m3fn', 'fp8_e4m3fn_fast', 'fp8_e5m2', 'fp8_scaled', 'int8_weight_only', 'int8_dynamic']
+# parameters that always stay in base_precision
+PARAMS_TO_KEEP = {"norm", "bias", "time_in", "vector_in", "guidance_in", "txt_in", "img_in"}
+
+
+def get_weight_dtype(quantization, base_dtype):
+    """dtype the weights are stored in for a quantization mode (int8 weights are stored by their quantize_fn)."""
+    if quantization == "fp8_e4m3fn" or quantization == "fp8_e4m3fn_fast" or quantization == "fp8_scaled":
+        return torch.float8_e4m3fn
+    elif quantization == "fp8_e5m2":
+        return torch.float8_e5m2
+    return base_dtype
+
+
+def get_quantize_fn(model, quantization, fp8_scale="per_tensor", params_to_keep=PARAMS_TO_KEEP):
+    """quantize_fn for load_state_dict_streaming, or None for the modes that only cast."""
+    if quantization == "fp8_scaled":
+        from .fp8_optimization import fp8_scaled_quantize_fn
+        return fp8_scaled_quantize_fn(model, torch.float8_e4m3fn, per_channel=fp8_scale == "per_channel", params_to_keep=params_to_keep)
+    elif quantization == "int8_weight_only" or quantization == "int8_dynamic":
+        from .int8_optimization import int8_quantize_fn
+        return int8_quantize_fn(model, params_to_keep=params_to_keep)
+    return None
+
+
+def convert_quantized_linear(model, quantization, base_dtype, params_to_keep=PARAMS_TO_KEEP):
+    """Installs the Linear forwards of a quantization mode on a model whose weights have been loaded."""
+    if quantization == "fp8_e4m3fn_fast" or quantization == "fp8_scaled":
+        from .fp8_optimization import convert_fp8_linear
+        convert_fp8_linear(model, base_dtype, params_to_keep=params_to_keep)
+    elif quantization == "int8_weight_only" or quantization == "int8_dynamic":
+        from .int8_optimization import convert_int8_linear
+        convert_int8_linear(model, base_dtype, params_to_keep=params_to_keep, dynamic_activations=quantization == "int8_dynamic")
@@ -0,0 +1,178 @@
+import os
+import time
+import threading
+
+from .utils import log
+
+GB = 1024 ** 3
+# seconds a transformer may stay on the device without a sampler using it
+IDLE_TIMEOUT = float(os.environ.get("FRAMEPACK_IDLE_TIMEOUT", 300))
+POLL_INTERVAL = 5.0
+
+
+class ResidencyManager:
+    """
+    Keeps transformers on the device between sampler runs.
+
+    The samplers used to unload every ComfyUI model before sampling and offload the transformer afterwards,
+    so back-to-back jobs paid for a full upload of the transformer and for reloading the text encoder and
+    VAE. Here a sampler acquires the transformer: only as much ComfyUI memory is freed as the transformer
+    still needs (mm.free_memory unloads the least recently used models first), and whatever is already
+    resident from the previous job stays. On release the transformer stays resident unless free memory is
+    below what the job preserved, and a background check evicts it after IDLE_TIMEOUT seconds without use
+    or as soon as free memory drops below that reserve, e.g. because ComfyUI loaded other models next to it.
+    Samplers running concurrently against the same transformer each acquire it, it is released with the last.
+    Every acquire has to be paired with a release, also when the job fails.
+    """
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, poll_interval=POLL_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.lock = threading.RLock()
+        self.released = threading.Condition(self.lock)
+        self.entries = {}
+        self.timer = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uploaded_bytes = 0
+
+    @staticmethod
+    def _can_join(model, entry, lora_key):
+        # LoRAs are patched into the shared weights, and the running forwards depend on the prefetcher's and
+        # the disk tier's per model state
+        return entry.get("lora_key") == lora_key and "block_prefetcher" not in model.__dict__ and "disk_tier" not in model.__dict__
+
+    def acquire(self, model, device, offload_device, preserved_memory_gb=0, stream_buffers=2, pipe=None):
+        """
+        Applies the LoRAs of `pipe` (the FramePackMODEL), makes the transformer resident per its residency plan
+        and installs a BlockPrefetcher for the streamed blocks, returns the plan.
+
+        A job that starts while others are running against the same transformer joins them as they are: it
+        doesn't patch, plan or move anything and gets the running plan. That is only safe with the same LoRAs
+        and while the transformer keeps no per model streaming state, otherwise the job waits until the running
+        ones released it.
+        """
+        import comfy.model_management as mm
+        from .diffusers_helper.memory import get_tensor_bytes, load_model_with_residency_plan, BlockPrefetcher
+        from .lora import apply_model_loras, get_lora_key
+
+        lora_key = get_lora_key(pipe) if pipe is not None else None
+
+        with self.released:
+            while True:
+                entry = self.entries.setdefault(id(model), {"model": model, "users": set()})
+                if not entry["users"] or self._can_join(model, entry, lora_key):
+                    break
+                log.info("Waiting for the jobs running on this transformer, they use other LoRAs or stream its weights")
+                self.released.wait()
+            joining = bool(entry["users"])
+            entry["users"].add(threading.current_thread())
+            if joining:
+                log.info("Joining the jobs already running on this transformer with its current residency plan")
+                return entry["plan"]
+            entry.update(in_use=True, device=device, offload_device=offload_device, min_free=preserved_memory_gb * GB, lora_key=lora_key)
+
+            # the first job patches, plans and places the transformer, the lock keeps others from joining before that's done
+            try:
+                if pipe is not None:
+                    apply_model_loras(pipe)
+                resident_before = get_tensor_bytes(model, device)
+                needed = get_tensor_bytes(model) - resident_before + preserved_memory_gb * GB
+                if device.type == "cuda" and mm.get_free_memory(device) < needed:
+                    mm.free_memory(needed, device)
+                    mm.soft_empty_cache()
+
+                plan = load_model_with_residency_plan(model, device, offload_device, preserved_memory_gb=preserved_memory_gb, stream_buffers=stream_buffers)
+                BlockPrefetcher.install(model, device, stream_buffers)
+            except BaseException:
+                # the sampler only releases what it acquired
+                self.release(model, keep_resident=False)
+                raise
+            entry["plan"] = plan
+            uploaded = max(plan.resident_bytes - resident_before, 0)
+            self.uploaded_bytes += uploaded
+            if resident_before > 0 and uploaded < plan.resident_bytes:
+                self.hits += 1
+                log.info(f"Transformer still resident from the previous job, uploaded {uploaded / GB:.2f} of {plan.resident_bytes / GB:.2f} GB")
+            else:
+                self.misses += 1
+            return plan
+
+    def release(self, model, keep_resident=True):
+        """Ends a sampler run. The last one to release removes the prefetcher, the transformer stays resident if it can."""
+        import comfy.model_management as mm
+        from .diffusers_helper.memory import BlockPrefetcher
+        with self.released:
+            entry = self.entries.get(id(model))
+            if entry is None:
+                return
+            entry["users"].discard(threading.current_thread())
+            if entry["users"]:
+                return
+            prefetcher = model.__dict__.get("block_prefetcher")
+            if prefetcher is not None:
+                stats = prefetcher.get_stats()
+                # the next residency plan keeps the blocks that stalled the most on the GPU
+                model.__dict__.setdefault("block_costs", {}).update(stats.pop("block_stall_ms"))
+                log.info(f"Block prefetch: {stats}")
+                BlockPrefetcher.uninstall(model)
+            entry.update(in_use=False, last_used=time.monotonic())
+            device = entry["device"]
+            if not keep_resident or device.type != "cuda" or mm.get_free_memory(device) < entry["min_free"]:
+                self._evict(id(model))
+            else:
+                self._schedule()
+            self.released.notify_all()
+        log.info(f"Transformer residency: {self.get_stats()}")
+        disk_tier = model.__dict__.get("disk_tier")
+        if disk_tier is not None:
+            log.info(f"Disk offload: {disk_tier.get_stats()}")
+
+    def evict_all(self):
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if not entry["in_use"]]:
+                self._evict(key)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "uploaded_gb": self.uploaded_bytes / GB,
+                "resident": sum(1 for entry in self.entries.values() if not entry["in_use"]),
+            }
+
+    def _evict(self, key):
+        import comfy.model_management as mm
+        from .diffusers_helper.memory import offload_model
+        entry = self.entries.pop(key)
+        offload_model(entry["model"], entry["offload_device"])
+        mm.soft_empty_cache()
+        self.evictions += 1
+
+    def _schedule(self):
+        if self.timer is None:
+            self.timer = threading.Timer(self.poll_interval, self._check)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _check(self):
+        import comfy.model_management as mm
+        with self.lock:
+            self.timer = None
+            now = time.monotonic()
+            for key, entry in list(self.entries.items()):
+                if entry["in_use"]:
+                    continue
+                if now - entry["last_used"] > self.idle_timeout:
+                    log.info(f"Offloading the transformer after {self.idle_timeout:.0f} s idle")
+                    self._evict(key)
+                elif mm.get_free_memory(entry["device"]) < entry["min_free"]:
+                    log.info("Offloading the transformer, other models need the memory")
+                    self._evict(key)
+            if any(not entry["in_use"] for entry in self.entries.values()):
+                self._schedule()
+
+
+residency_manager = ResidencyManager()
@@ -0,0 +1,171 @@
+import os
+import time
+import weakref
+
+from .utils import log
+from .model_loading import SafetensorsFile, save_safetensors_streaming
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# seconds to wait for another process that is loading the same weights before loading them here as well
+WAIT_TIMEOUT = float(os.environ.get("FRAMEPACK_SHARED_WAIT", 900))
+
+
+def get_shared_dir():
+    """/dev/shm where there is one, so the weights live in shared memory, otherwise a shared file in the model cache dir."""
+    shared_dir = os.environ.get("FRAMEPACK_SHARED_DIR")
+    if not shared_dir:
+        if os.path.isdir("/dev/shm"):
+            shared_dir = "/dev/shm/framepack"
+        else:
+            from .model_cache import get_cache_dir
+            shared_dir = os.path.join(get_cache_dir(), "shared")
+    os.makedirs(shared_dir, exist_ok=True)
+    return shared_dir
+
+
+def get_host_tensors(model):
+    """What is shared: the parameters in host memory and the scales of quantized weights, as the model cache saves them."""
+    tensors = {name: p for name, p in model.named_parameters() if p.device.type == "cpu"}
+    tensors.update({name: b for name, b in model.named_buffers() if name.endswith(".scale_weight") and b.device.type == "cpu"})
+    return tensors
+
+
+class SharedWeights:
+    """
+    Host weights shared by the ComfyUI processes of one machine, e.g. one per GPU.
+
+    The first process to load a recipe publishes its transformer's host weights (quantized, with fused LoRAs)
+    as a .safetensors file in /dev/shm. Every process, the publisher included, then maps the file and points
+    its tensors at the mapping, so the pages exist once on the host however many processes use them. The
+    mapping is private: a process that patches its weights (e.g. another fused LoRA) gets its own copy of
+    the pages it writes and never changes the other processes' weights.
+
+    Each user holds a shared flock on the .ref file for as long as it is attached, the OS drops it when the
+    process exits or crashes. The last user to detach removes the weights. Publishing and attaching are
+    serialized by an exclusive flock on the .lock file, which the publisher holds while it loads, so other
+    processes wait for the weights instead of loading their own copy.
+    """
+    def __init__(self, key):
+        self.key = key
+        shared_dir = get_shared_dir()
+        self.path = os.path.join(shared_dir, f"{key}.safetensors")
+        self.lock_fd = os.open(os.path.join(shared_dir, f"{key}.lock"), os.O_RDWR | os.O_CREAT, 0o666)
+        self.ref_fd = None
+        self.locked = False
+        self.source = None
+        # closing the files releases the locks, also when a failed load drops this object without publishing
+        self.fds = [self.lock_fd]
+        self.close = weakref.finalize(self, lambda fds: [os.close(fd) for fd in fds], self.fds)
+
+    @staticmethod
+    def open(key):
+        """
+        Attaches to the weights of a recipe key. If they are published, returns with .published set, otherwise the
+        caller loads the model and hands it to publish() (or calls unlock() if it can't). None where flock isn't available.
+        """
+        if fcntl is None:
+            log.warning("Sharing weights between processes needs fcntl, which isn't available on this platform")
+            return None
+        shared = SharedWeights(key)
+        if not shared._lock(WAIT_TIMEOUT):
+            log.warning(f"Another process has been loading {shared.path} for more than {WAIT_TIMEOUT:.0f} s, loading the weights here as well")
+        shared.ref_fd = os.open(f"{shared.path[:-len('.safetensors')]}.ref", os.O_RDWR | os.O_CREAT, 0o666)
+        shared.fds.append(shared.ref_fd)
+        fcntl.flock(shared.ref_fd, fcntl.LOCK_SH)
+        if shared.published:
+            shared.unlock()
+            log.info(f"Attaching to the transformer weights shared by another process: {shared.path}")
+        return shared
+
+    @property
+    def published(self):
+        return os.path.exists(self.path)
+
+    def _lock(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.locked = True
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.5)
+
+    def unlock(self):
+        if self.locked:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+            self.locked = False
+
+    def publish(self, model):
+        """
+        Writes the model's host weights to shared memory (unless another process was faster) and points the
+        model at the shared copy. Returns the bytes now shared, 0 if the weights couldn't be written.
+        """
+        tensors = get_host_tensors(model)
+        try:
+            if not self.published:
+                if len(tensors) < len(dict(model.named_parameters())):
+                    # processes attaching later load every parameter from the shared file
+                    log.warning("Only weights in host memory can be shared, load the model to the offload_device to share it")
+                    return 0
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                log.info(f"Sharing {len(tensors)} host tensors with other processes: {self.path}")
+                try:
+                    # larger elements first keeps every tensor aligned, so they map without a copy
+                    order = sorted(tensors, key=lambda k: -tensors[k].element_size())
+                    save_safetensors_streaming({k: tensors[k] for k in order}, tmp_path)
+                    os.replace(tmp_path, self.path)
+                except OSError as e:
+                    log.warning(f"Could not write the shared weights to {self.path}, keeping them private: {e}")
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    return 0
+            shared_bytes = self.attach(model, tensors)
+        finally:
+            self.unlock()
+        return shared_bytes
+
+    def attach(self, model, tensors=None):
+        """Points the model's host tensors at the published weights, those that match by name, shape and dtype."""
+        self.source = SafetensorsFile(self.path)
+        source = self.source
+        tensors = tensors if tensors is not None else get_host_tensors(model)
+        shared_bytes = 0
+        for name, t in tensors.items():
+            if name not in source or source.dtype_of(name) != t.dtype:
+                continue
+            view = source.get_tensor(name)
+            if view.shape == t.shape:
+                t.data = view
+                shared_bytes += source.nbytes_of(name)
+        model.__dict__["shared_weights"] = self
+        weakref.finalize(model, self.detach)
+        return shared_bytes
+
+    def detach(self):
+        """Drops this process' reference, the last one removes the shared weights."""
+        if self.ref_fd is None:
+            return
+        try:
+            fcntl.flock(self.ref_fd, fcntl.LOCK_UN)
+            if not self._lock(0):
+                # another process is publishing or attaching, so it is going to use the weights
+                return
+            try:
+                # only succeeds when no other process holds a reference
+                fcntl.flock(self.ref_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                    log.info(f"Removed the shared transformer weights, no process uses them anymore: {self.path}")
+            except BlockingIOError:
+                pass
+        finally:
+            self.ref_fd = None
+            self.locked = False
+            self.close()
@@ -0,0 +1,71 @@
+import weakref
+
+import torch
+import torch.nn as nn
+
+from .utils import log
+from .quantization import PARAMS_TO_KEEP
+
+TRANSFER_COMPRESSION_MODES = ["disabled", "fp8", "int8"]
+FLOAT_DTYPES = (torch.float32, torch.bfloat16, torch.float16)
+
+
+class TransferCodec:
+    """
+    Compact host copies of the Linear weights of streamed blocks, so that BlockPrefetcher uploads them at 1 byte
+    per parameter instead of 2 (or 4) and dequantizes them into reusable device buffers of the original dtype
+    right before the block runs. The blocks compute in full precision from the dequantized weights, and the
+    resident blocks, which never cross PCIe, keep their original weights.
+
+    The compact copy (fp8 e4m3 or int8, with a per output channel scale) is made the first time a block is
+    streamed and kept in pinned memory next to the original host weight, which stays the master copy for
+    when a block becomes resident. Weights patched in place (fused LoRAs) have to be invalidate()d.
+    """
+    def __init__(self, model, mode, pin_memory=True, params_to_keep=PARAMS_TO_KEEP):
+        if mode not in TRANSFER_COMPRESSION_MODES[1:]:
+            raise ValueError(f"Unknown transfer compression '{mode}', expected one of {TRANSFER_COMPRESSION_MODES[1:]}")
+        self.mode = mode
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.modules = weakref.WeakSet(module for name, module in model.named_modules()
+                                       if isinstance(module, nn.Linear) and not any(keyword in name for keyword in params_to_keep))
+        self.copies = weakref.WeakKeyDictionary()
+        self.encoded_bytes = 0
+
+    @staticmethod
+    def install(model, mode):
+        if mode == "disabled":
+            model.__dict__.pop("transfer_codec", None)
+            return None
+        codec = TransferCodec(model, mode)
+        model.__dict__["transfer_codec"] = codec
+        log.info(f"Streamed blocks are uploaded as {mode}, {len(codec.modules)} Linear layers can be compressed")
+        return codec
+
+    def compresses(self, module, kind, name, t):
+        return kind == "_parameters" and name == "weight" and t.dim() == 2 and t.dtype in FLOAT_DTYPES and module in self.modules
+
+    def encode(self, module, t):
+        """(weight, scale) compact host copy of a module's weight, made on first use."""
+        if module not in self.copies:
+            if self.mode == "fp8":
+                from .fp8_optimization import quantize_fp8
+                weight, scale = quantize_fp8(t.detach(), torch.float8_e4m3fn, per_channel=True)
+            else:
+                from .int8_optimization import quantize_int8
+                weight, scale = quantize_int8(t.detach())
+            if self.pin_memory:
+                weight, scale = weight.pin_memory(), scale.pin_memory()
+            self.copies[module] = (weight, scale)
+            self.encoded_bytes += weight.nelement() * weight.element_size() + scale.nelement() * scale.element_size()
+        return self.copies[module]
+
+    @staticmethod
+    def decode(weight, scale, out):
+        """Dequantizes an uploaded compact weight into `out` in place, on the current stream."""
+        out.copy_(weight)
+        return out.mul_(scale)
+
+    def invalidate(self, module):
+        copy = self.copies.pop(module, None)
+        if copy is not None:
+            self.encoded_bytes -= sum(t.nelement() * t.element_size() for t in copy)